@@ -1,12 +1,42 @@
+import os
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
-import pandas as pd
-import numpy as np
 
-from patientflow.viz.arrival_rates import (
-    plot_arrival_rates,
-    plot_cumulative_arrival_rates,
+from demand import warmup
+from demand.instrument import (
+    ENABLED_BY_DEFAULT,
+    cache_stats,
+    enable,
+    prometheus_text,
+    run_stages,
+    serve_metrics,
+    stage,
+    start_run,
+    trace_memory,
 )
-from patientflow.viz.aspirational_curve_plot import plot_curve
+from demand.store import CubeStore, content_key
+
+# The modules that read files and compute demand (pandas, SciPy, matplotlib and
+# patientflow) take seconds to import, so they are imported where they are first
+# needed, once a file is chosen. The landing page only needs Streamlit, and the
+# pipeline is warmed up in the background while it is shown (see demand.warmup).
+
+# Uploads larger than this are read in chunks by default
+STREAMING_THRESHOLD_BYTES = 200 * 1024 * 1024
+
+# Aggregated uploads are kept on disk, so reopening the same file does not parse it again
+try:
+    STORE = CubeStore()
+except OSError:
+    STORE = None
+
+# Stage timings can be scraped by Prometheus if DEMAND_METRICS_PORT is set
+try:
+    serve_metrics()
+except OSError:
+    pass  # Another app process is already serving them
 
 # Set up session states for step completion and plot storage
 if "step2_completed" not in st.session_state:
@@ -15,93 +45,490 @@ if "step4_completed" not in st.session_state:
     st.session_state.step4_completed = False
 if "plots" not in st.session_state:
     st.session_state.plots = {}
-if "original_df" not in st.session_state:
-    st.session_state.original_df = None
-if "original_df_with_index" not in st.session_state:
-    st.session_state.original_df_with_index = None
-if "filtered_df" not in st.session_state:
-    st.session_state.filtered_df = None
+
+
+def ingest_upload(uploaded_file, head, datetime_col, streaming):
+    """
+    Read, parse and count an uploaded file, or reopen its saved counts if the same file
+    has been read before with the same options.
+
+    Parameters:
+    uploaded_file (UploadedFile): The uploaded CSV file
+    head (pandas.DataFrame): The first rows of the file
+    datetime_col (str): Column containing arrival datetimes
+    streaming (bool): Whether to read the file in chunks
+
+    Returns:
+    tuple: (cube, parse_report, saved_meta, warnings) - saved_meta is None if the file was parsed
+    now; warnings are messages to show, since this may run outside the script's thread
+    """
+    from demand.cube import CountCube
+    from demand.engine import BASE_INTERVAL
+    from demand.ingest import candidate_filter_columns, load_arrivals, stream_arrivals
+
+    key = None
+    if STORE is not None:
+        key = content_key(uploaded_file, datetime_col, streaming, BASE_INTERVAL)
+        if key in STORE:
+            return (*STORE.load(key), [])
+
+    filter_columns = candidate_filter_columns(head, datetime_col)
+    if streaming:
+        cube, parse_report = stream_arrivals(
+            uploaded_file, datetime_col, filter_columns, time_interval=BASE_INTERVAL
+        )
+    else:
+        df, parse_report = load_arrivals(uploaded_file, datetime_col, filter_columns)
+        cube = CountCube.from_frame(df, time_interval=BASE_INTERVAL)
+        del df
+
+    # Counts of a file whose dates could not be parsed are not kept
+    warnings = []
+    if key is not None and cube.num_arrivals:
+        try:
+            STORE.save(
+                key, cube, uploaded_file.name, parse_report, datetime_col=datetime_col
+            )
+        except (OSError, TypeError, ValueError) as e:
+            warnings.append(
+                f"The counts of {uploaded_file.name} could not be saved for next time: {e}"
+            )
+    return cube, parse_report, None, warnings
+
+
+def ingest_uploads(uploaded_files, head, datetime_col, streaming):
+    """
+    Read, parse and count one or more uploaded files. Several files are read in parallel,
+    one per site, and combined with a column naming the site of each arrival.
+
+    Parameters:
+    uploaded_files (list of UploadedFile): The uploaded CSV files
+    head (pandas.DataFrame): The first rows of the first file
+    datetime_col (str): Column containing arrival datetimes
+    streaming (bool): Whether to read the files in chunks
+
+    Returns:
+    tuple: (cube, parse_report, saved_meta, warnings) - saved_meta is None unless every file was
+    reopened; warnings are messages to show from reading any of the files
+    """
+    from demand.compare import combine_sites, site_name
+    from demand.ingest import combine_reports, read_columns
+
+    if len(uploaded_files) == 1:
+        return ingest_upload(uploaded_files[0], head, datetime_col, streaming)
+
+    def ingest(uploaded_file):
+        return ingest_upload(
+            uploaded_file, read_columns(uploaded_file), datetime_col, streaming
+        )
+
+    # Workers have no Streamlit context, so they return their warnings rather than showing them
+    workers = min(len(uploaded_files), os.cpu_count())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(ingest, uploaded_files))
+    names = [site_name(uploaded_file.name) for uploaded_file in uploaded_files]
+    if len(set(names)) < len(names):
+        raise ValueError("Each file must have a different name, to name its site.")
+    cube = combine_sites({name: cube for name, (cube, *_) in zip(names, results)})
+    saved = [saved_meta for _, _, saved_meta, _ in results]
+    saved_meta = None
+    if all(saved):
+        saved_meta = {"name": ", ".join(meta["name"] for meta in saved)}
+    report = combine_reports([report for _, report, _, _ in results])
+    warnings = [warning for *_, file_warnings in results for warning in file_warnings]
+    return cube, report, saved_meta, warnings
 
 
 def generate_and_store_plot(plot_function, plot_key, *args, **kwargs):
-    """Helper function to generate and store plots in session state"""
+    """
+    Helper function to generate and store plots in session state.
+    Plots are stored as PNG images; a plot is only redrawn when its inputs change.
+    """
+    from demand.plots import render_png
+
     try:
-        fig = plot_function(*args, **kwargs)
-        st.session_state.plots[plot_key] = fig
-        return fig
+        png = render_png(plot_function, *args, **kwargs)
+        st.session_state.plots[plot_key] = png
+        return png
     except Exception as e:
         st.error(f"Error generating plot: {str(e)}")
         return None
 
 
-def apply_data_filtering(df, df_with_index):
+def show_plot(plot_function, plot_key, *args, **kwargs):
     """
-    Apply filtering to the dataframe based on user selections.
-    Displays all column names and treats the selected column as categorical.
+    Show a chart as an image drawn on the server, or as an interactive chart drawn in the browser,
+    depending on the chart style chosen in the sidebar, with a download of the values it shows.
 
     Parameters:
-    df (pandas.DataFrame): Original dataframe with arrival_datetime as a column
-    df_with_index (pandas.DataFrame): Dataframe with arrival_datetime as index
+    plot_function (callable): Matplotlib chart function
+    plot_key (str): Name of the chart
+    *args, **kwargs: Arguments for `plot_function`
+    """
+    from demand.charts import chart_table, interactive_chart
+
+    if st.session_state.get("chart_style") == "Interactive":
+        try:
+            chart = interactive_chart(plot_function, *args, **kwargs)
+        except Exception as e:
+            st.error(f"Error generating plot: {str(e)}")
+            return
+        st.altair_chart(chart, width="stretch")
+    else:
+        png = generate_and_store_plot(plot_function, plot_key, *args, **kwargs)
+        if png is None:
+            return
+        st.image(png, width="stretch")
+
+    st.download_button(
+        "Download the values in this chart",
+        chart_table(plot_function, *args, **kwargs).to_csv(index=False),
+        file_name=f"{plot_key}.csv",
+        mime="text/csv",
+        key=f"download_{plot_key}",
+        on_click="ignore",
+    )
+
+
+def apply_data_filtering(index):
+    """
+    Apply filtering to the aggregated arrivals based on user selections.
+    Any number of categorical columns can be combined, including derived attributes
+    of the day (weekday or weekend, day of week, month, bank holiday), together with
+    a range of dates.
+
+    Parameters:
+    index (FilterIndex): Precomputed arrival counts for each category of each column
 
     Returns:
-    tuple: (filtered_df, filtered_df_with_index) - Both the column and index versions of the filtered dataframe
+    tuple or None: (dates, counts, excluded, filters, date_range) - Dates and arrival counts by date
+    and hour for the selected data, which dates the filters left out, and the selection that produced
+    them, or None if no arrivals match it
     """
     # Display filtering options
     st.subheader("Step 1b: Filter your data (optional)")
 
-    # Get all columns except arrival_datetime for filtering
-    filter_columns = [col for col in df.columns if col != "arrival_datetime"]
+    # Display all filterable columns; each one chosen narrows the selection further
+    filter_cols = st.multiselect(
+        "Select columns to filter on:", index.columns, key="filter_columns_multiselect"
+    )
 
-    if not filter_columns:
-        # If no columns, return the original data
-        return df, df_with_index
+    # Display the values of each chosen column in a multi-select dropdown
+    filters = {}
+    for filter_col in filter_cols:
+        unique_values = index.categories[filter_col].tolist()
+        filters[filter_col] = st.multiselect(
+            f"Select values for {filter_col}:",
+            options=unique_values,
+            default=unique_values,
+            key=f"multiselect_{filter_col}",
+        )
 
-    # Display all column names in a dropdown
-    filter_col = st.selectbox(
-        "Select column to filter on:", filter_columns, key="filter_column_selectbox"
+    first_date, last_date = index.dates[0].item(), index.dates[-1].item()
+    date_range = st.date_input(
+        "Select the range of dates to include:",
+        value=(first_date, last_date),
+        min_value=first_date,
+        max_value=last_date,
+        key="date_range_input",
     )
+    if len(date_range) != 2:
+        date_range = None  # The user is part-way through choosing a range
 
-    if not filter_col:
-        # If no filter column selected, return the original data
-        return df, df_with_index
-
-    # Treat all columns as categorical
-    # Extract unique values from the selected column
-    unique_values = df[filter_col].dropna().unique()
+    # Apply the filters based on selected values
+    try:
+        dates, counts, excluded = index.selection(filters, date_range)
+    except ValueError:
+        st.error("No arrivals match the selected filters.")
+        return None
 
-    # Display the unique values in a multi-select dropdown
-    selected_values = st.multiselect(
-        f"Select values for {filter_col}:",
-        options=unique_values,
-        default=unique_values,
-        key=f"multiselect_{filter_col}",
+    # Show the filter effect
+    st.write(
+        f"Filtered data contains {int(counts.sum()):,} records (from original {int(index.totals.sum()):,})"
     )
 
-    # Apply the filter based on selected values
-    if selected_values:
-        filtered_df = df[df[filter_col].isin(selected_values)]
-    else:
-        filtered_df = df  # No filter if nothing is selected
+    return dates, counts, excluded, filters, date_range
 
-    # Update both versions in session state
-    st.session_state.original_df = filtered_df
 
-    # Show the filter effect
+def window_search_section(
+    centile_table, percentage_of_days, start_of_window, end_of_window, start_hour
+):
+    """
+    Rank every decision-making window by the beds to vacate each hour, under the chosen targets.
+
+    Parameters:
+    centile_table (numpy.ndarray): Centile table of cumulative demand, starting at `start_hour`
+    percentage_of_days (float): Consistency target between 0 and 1
+    start_of_window (int): Start of the window chosen in the sidebar
+    end_of_window (int): End of the window chosen in the sidebar
+    start_hour (int): Hour of day at which charts start
+    """
+    from demand.plots import plot_window_heatmap
+    from demand.windows import rank_windows, window_matrix
+
+    with st.expander("Find the decision-making window that needs the fewest discharges each hour"):
+        st.write(
+            "Every window that starts and ends on the hour is compared at once. "
+            "Longer windows always spread the discharges more thinly, so choose the lengths "
+            "and hours your staffing allows."
+        )
+        min_hours, max_hours = st.slider(
+            "Length of the window, in hours",
+            1,
+            23,
+            ((end_of_window - start_of_window) % 24 or 1,) * 2,
+            key="window_search_hours",
+        )
+        earliest_start, latest_end = st.select_slider(
+            "Decision-makers can be on wards between",
+            options=[(start_hour + i) % 24 for i in range(24)],
+            value=(start_hour % 24, (start_hour - 1) % 24),
+            format_func=lambda hour: f"{hour:02d}:00",
+            key="window_search_hours_of_day",
+        )
+        windows = rank_windows(
+            centile_table,
+            start_hour,
+            [percentage_of_days],
+            min_hours,
+            max_hours,
+            earliest_start,
+            latest_end,
+        )
+        if windows.empty:
+            st.error("No window of that length fits between those hours.")
+            return
+        best = windows.iloc[0]
+        best_window = (int(best["start_of_window"]), int(best["end_of_window"]))
+        st.markdown(
+            f"To hit targets on {percentage_of_days*100:.0f}% of days, the best window is "
+            f"**{best_window[0]:02d}:00 to {best_window[1]:02d}:00**, with "
+            f"{best['beds_per_hour']:.1f} beds to vacate each hour."
+        )
+        show_plot(
+            plot_window_heatmap,
+            "window_heatmap_plot",
+            window_matrix(windows),
+            f"Beds to vacate each hour of each decision-making window, if ED targets are to be met on {percentage_of_days*100:.0f}% of days",
+            start_plot_index=start_hour,
+            draw_window=(start_of_window, end_of_window),
+            best_window=best_window,
+        )
+        st.dataframe(
+            windows.drop(columns="centile")
+            .head(10)
+            .rename(
+                columns={
+                    "rank": "Rank",
+                    "start_of_window": "Start",
+                    "end_of_window": "End",
+                    "hours": "Hours",
+                    "beds_by_start_of_window": "Beds by the start",
+                    "beds_by_end_of_window": "Beds by the end",
+                    "beds_per_hour": "Beds to vacate each hour of the window",
+                }
+            ),
+            hide_index=True,
+            column_config={
+                name: st.column_config.NumberColumn(format="%.1f")
+                for name in [
+                    "Beds by the start",
+                    "Beds by the end",
+                    "Beds to vacate each hour of the window",
+                ]
+            },
+        )
+        # The same search at every consistency target, best window for each
+        st.download_button(
+            "Download the best window for every consistency target",
+            rank_windows(
+                centile_table,
+                start_hour,
+                min_hours=min_hours,
+                max_hours=max_hours,
+                earliest_start=earliest_start,
+                latest_end=latest_end,
+            )
+            .query("rank == 1")
+            .drop(columns="rank")
+            .to_csv(index=False),
+            file_name="best_windows.csv",
+            mime="text/csv",
+            key="download_best_windows",
+            on_click="ignore",
+        )
+
+
+def compare_sites_section(
+    index,
+    filters,
+    date_range,
+    curve_params,
+    percentage_of_days,
+    start_of_window,
+    end_of_window,
+    start_hour,
+    centile_method,
+    distribution,
+):
+    """
+    Compare the beds needed at each site, under the same targets and decision-making window.
+
+    Parameters:
+    index (FilterIndex): Precomputed arrival counts for each category of each column
+    filters (dict): Filters chosen in Step 1b, applied to every site
+    date_range (tuple or None): Range of dates chosen in Step 1b
+    curve_params (tuple): (x1, y1, x2, y2) defining the aspirational curve
+    percentage_of_days (float): Consistency target between 0 and 1
+    start_of_window (int): Start of the decision-making window
+    end_of_window (int): End of the decision-making window
+    start_hour (int): Hour of day at which charts start
+    centile_method (str): One of CENTILE_METHODS
+    distribution (str): Count model for the consistency target
+    """
+    from demand.compare import SITE_COLUMN, compare_sites, site_selections
+    from demand.plots import plot_site_comparison
+
+    # Sites can be any column from the data; several files are combined with a Site column
+    columns = [
+        column
+        for column in index.columns
+        if column not in index.day_attributes and len(index.categories[column]) > 1
+    ]
+    if not columns:
+        return
+
+    st.subheader("Step 6: Compare sites (optional)")
     st.write(
-        f"Filtered data contains {len(filtered_df):,} records (from original {len(df):,})"
+        "Upload one file for each site, or a file with a column naming the site, "
+        "to compare the beds each site needs with the same targets and decision-making window."
+    )
+    default = next(
+        (
+            i
+            for i, column in enumerate(columns)
+            if column == SITE_COLUMN or "site" in str(column).lower()
+        ),
+        0,
+    )
+    column = st.selectbox(
+        "Compare the values of this column:", columns, index=default, key="compare_column"
+    )
+    all_sites = index.categories[column].tolist()
+    sites = st.multiselect(
+        "Sites to compare:",
+        all_sites,
+        default=all_sites[:12],
+        key=f"compare_sites_{column}",
+    )
+    layout = st.radio(
+        "Show the sites",
+        ["overlay", "facet"],
+        format_func={"overlay": "On one chart", "facet": "Side by side"}.get,
+        horizontal=True,
+        key="compare_layout",
+    )
+    if not sites:
+        return
+
+    # Each site's demand is computed in a separate worker process, and the
+    # comparison is cached, so changing only the layout does not recompute it
+    profiles, summary = compare_sites(
+        site_selections(index, column, sites, filters, date_range),
+        curve_params,
+        percentage_of_days,
+        (start_of_window, end_of_window),
+        start_hour,
+        centile_method,
+        distribution,
+    )
+    if not profiles:
+        st.error("No arrivals match the selected filters at these sites.")
+        return
+
+    show_plot(
+        plot_site_comparison,
+        "site_comparison_plot",
+        {site: profile["cumulative"] for site, profile in profiles.items()},
+        f"Cumulative number of beds needed at each site, by hour of day, if ED targets are to be met on {percentage_of_days*100:.0f}% of days",
+        start_plot_index=start_hour,
+        draw_window=(start_of_window, end_of_window),
+        layout=layout,
+        annotation_prefix=f"To hit targets on {percentage_of_days*100:.0f}% of days",
+    )
+    st.dataframe(
+        summary.rename(
+            columns={
+                "site": str(column),
+                "num_days": "Days",
+                "arrivals_per_day": "Admissions per day",
+                "mean_beds_per_day": "Beds per day, on average",
+                "mean_beds_by_end_of_window": f"Beds by {end_of_window}:00, on average",
+                "beds_by_start_of_window": f"Beds by {start_of_window}:00",
+                "beds_by_end_of_window": f"Beds by {end_of_window}:00",
+                "beds_per_hour": "Beds to vacate each hour of the window",
+            }
+        ),
+        hide_index=True,
+        column_config={
+            name: st.column_config.NumberColumn(format="%.1f")
+            for name in summary.columns
+            if name not in ("site", "num_days")
+        },
     )
 
-    # Set the filtered data with proper datetime index for visualization
-    filtered_df_with_index = filtered_df.copy()
-
-    # Only set index if arrival_datetime is not already the index
-    if "arrival_datetime" in filtered_df.columns:
-        filtered_df_with_index.set_index("arrival_datetime", inplace=True)
 
-    # Update the indexed version in session state too
-    st.session_state.original_df_with_index = filtered_df_with_index
+def debug_panel():
+    """
+    Collapsible sidebar panel to record how long each stage of this run took, the memory it
+    allocated and how often it was answered from a cache.
+    """
+    with st.sidebar.expander("Debug: timings"):
+        st.checkbox(
+            "Time each stage",
+            value=ENABLED_BY_DEFAULT,
+            key="instrument_enabled",
+        )
+        st.checkbox(
+            "Measure memory",
+            value=tracemalloc.is_tracing(),
+            key="instrument_memory",
+            on_change=lambda: trace_memory(st.session_state.instrument_memory),
+            help="Slows every stage down several times, for all users of this server",
+        )
+        stages = run_stages()
+        if not stages:
+            st.caption("No stages were timed in this run.")
+            return
 
-    return filtered_df, filtered_df_with_index
+        import pandas as pd
+
+        # A stage can run several times in one run, and can contain other stages
+        table = (
+            pd.DataFrame(stages)
+            .groupby("stage", sort=False)
+            .agg(
+                calls=("stage", "size"),
+                wall_ms=("wall_seconds", "sum"),
+                cpu_ms=("cpu_seconds", "sum"),
+                peak_mb=("peak_bytes", "max"),
+                cache_hits=("cache_hits", "sum"),
+                cache_misses=("cache_misses", "sum"),
+            )
+        )
+        table[["wall_ms", "cpu_ms"]] *= 1000
+        table["peak_mb"] /= 1024**2
+        st.dataframe(table.round(1))
+        st.caption("Stages can contain other stages, so their times overlap.")
+        st.dataframe(pd.DataFrame.from_dict(cache_stats(), orient="index"))
+        st.download_button(
+            "Download the metrics in Prometheus format",
+            prometheus_text(),
+            file_name="metrics.txt",
+            mime="text/plain",
+            key="download_metrics",
+            on_click="ignore",
+        )
 
 
 def main():
@@ -151,66 +578,110 @@ def main():
         unsafe_allow_html=True,
     )
 
-    uploaded_file = st.file_uploader(
+    # Several files are compared as separate sites, named after each file
+    uploaded_files = st.file_uploader(
         label="Upload your CSV file",
         type="csv",
         label_visibility="collapsed",
+        accept_multiple_files=True,
     )
+    uploaded_file = uploaded_files[0] if uploaded_files else None
+
+    # Datasets read before can be reopened from the store without uploading them again
+    saved_key = None
+    if uploaded_file is None and STORE is not None:
+        entries = {entry["key"]: entry for entry in STORE.entries()}
+        saved = {
+            key: f"{entry['name']} ({entry.get('datetime_col')}, {entry['num_arrivals']:,} arrivals "
+            f"from {entry['first_date']} to {entry['last_date']})"
+            for key, entry in entries.items()
+        }
+        if saved:
+            saved_key = st.selectbox(
+                "Or reopen a dataset you have loaded before:",
+                [None, *saved],
+                format_func=lambda key: "" if key is None else saved[key],
+                key="saved_dataset_selector",
+            )
+
+    if uploaded_file is None and saved_key is None:
+        # Get the pipeline ready while the user chooses a file
+        warmup.start()
+
+    if uploaded_file is not None or saved_key is not None:
+        from patientflow.viz.aspirational_curve_plot import plot_curve
+
+        from demand.centiles import CENTILE_METHODS, OBSERVED_METHODS, lookup
+        from demand.engine import DemandEngine
+        from demand.filters import FilterIndex
+        from demand.ingest import read_columns
+        from demand.models import MODEL_NAMES
+        from demand.plots import plot_arrival_rates, plot_cumulative_demand
 
-    if uploaded_file is not None:
         try:
-            # First read the CSV file without parsing dates
-            df = pd.read_csv(uploaded_file)
-
-            # Allow user to specify which column contains arrival datetimes
-            st.subheader("Step 1a: Identify arrival datetime column")
-            datetime_col_options = df.columns.tolist()
-            datetime_col = st.selectbox(
-                "Select the column that contains arrival datetimes:",
-                datetime_col_options,
-                index=(
-                    datetime_col_options.index("arrival_datetime")
-                    if "arrival_datetime" in datetime_col_options
-                    else 0
-                ),
-                key="datetime_column_selector",
-            )
+            if uploaded_file is not None:
+                # Read the first rows only, to choose columns before the full read
+                head = read_columns(uploaded_file)
+
+                # Allow user to specify which column contains arrival datetimes
+                st.subheader("Step 1a: Identify arrival datetime column")
+                datetime_col_options = head.columns.tolist()
+                datetime_col = st.selectbox(
+                    "Select the column that contains arrival datetimes:",
+                    datetime_col_options,
+                    index=(
+                        datetime_col_options.index("arrival_datetime")
+                        if "arrival_datetime" in datetime_col_options
+                        else 0
+                    ),
+                    key="datetime_column_selector",
+                )
 
-            # Rename the selected column to arrival_datetime if it's not already named that
-            if datetime_col != "arrival_datetime":
-                df = df.rename(columns={datetime_col: "arrival_datetime"})
-
-            # Now try to parse the arrival_datetime column
-            try:
-                df["arrival_datetime"] = pd.to_datetime(df["arrival_datetime"])
-            except:
-                # If default parsing fails, try multiple common formats
-                for date_format in [
-                    "%d/%m/%Y %H:%M",  # UK/European: 01/03/2024 14:30
-                    "%d/%m/%Y %H:%M:%S",  # UK/European with seconds
-                    "%m/%d/%Y %H:%M",  # US: 03/01/2024 14:30
-                    "%Y-%m-%d %H:%M",  # ISO without seconds
-                    "%d-%m-%Y %H:%M",  # Dash separated UK/European
-                    "%d.%m.%Y %H:%M",  # Dot separated European
-                    "%d/%m/%y %H:%M",  # Two-digit year UK/European
-                ]:
-                    try:
-                        df["arrival_datetime"] = pd.to_datetime(
-                            df["arrival_datetime"], format=date_format, errors="coerce"
+                # Very large files are read in chunks and counted as they are read,
+                # so the whole file is never held in memory
+                streaming = st.checkbox(
+                    "Read the file in chunks (recommended for very large files)",
+                    value=max(f.size for f in uploaded_files) > STREAMING_THRESHOLD_BYTES,
+                    key="streaming_checkbox",
+                )
+                ingest_key = (
+                    tuple(f.file_id for f in uploaded_files),
+                    datetime_col,
+                    streaming,
+                )
+            else:
+                # Feeds are updated in place, so the save time is part of the key
+                ingest_key = ("saved", saved_key, entries[saved_key]["saved"])
+
+            # Read, parse and count the file once per upload and datetime column;
+            # reruns triggered by other widgets reuse the counts
+            if st.session_state.get("ingest_key") != ingest_key:
+                with stage("ingest"):
+                    if uploaded_file is not None:
+                        cube, parse_report, saved_meta, warnings = ingest_uploads(
+                            uploaded_files, head, datetime_col, streaming
                         )
-                        if not df["arrival_datetime"].isna().any():
-                            break
-                    except:
-                        continue
+                        for warning in warnings:
+                            st.warning(warning)
+                    else:
+                        cube, parse_report, saved_meta = STORE.load(saved_key)
+                # Index the counts by category once, so filter changes are cheap
+                st.session_state.ingested = (
+                    FilterIndex(cube),
+                    parse_report,
+                    saved_meta,
+                )
+                st.session_state.ingest_key = ingest_key
+            filter_index, parse_report, saved_meta = st.session_state.ingested
 
         except Exception as e:
             st.error(f"Error reading CSV file: {str(e)}")
             return
 
-        # Check if any dates failed to parse
-        if "arrival_datetime" not in df.columns or df["arrival_datetime"].isna().any():
+        # Check if the dates could be parsed
+        if not filter_index.totals.any():
             st.error(
-                """Some dates could not be parsed. Supported formats include:
+                """The dates could not be parsed. Supported formats include:
             - DD/MM/YYYY HH:MM
             - YYYY-MM-DD HH:MM:SS
             - MM/DD/YYYY HH:MM
@@ -219,33 +690,40 @@ def main():
             )
             return
 
-        # Set arrival_datetime as index before filtering
-        df_with_index = df.copy()
-        df_with_index.set_index("arrival_datetime", inplace=True)
-
-        # Store original dataframe in session state if it's the first load
-        # We store both versions - with and without index
-        if "original_df" not in st.session_state:
-            st.session_state.original_df = df.copy()
-            st.session_state.original_df_with_index = df_with_index.copy()
+        if saved_meta is not None:
+            st.caption(
+                f"Reopened the saved counts for {saved_meta['name']}, "
+                "so no files were parsed again"
+            )
+        elif parse_report is not None:
+            st.caption(
+                f"Parsed {parse_report.rows:,} arrival datetimes in {parse_report.seconds:.2f} seconds "
+                f"({parse_report.rows_per_second:,.0f} rows per second, format: {parse_report.method})"
+            )
+        if parse_report is not None and parse_report.failed:
+            st.warning(
+                f"{parse_report.failed:,} rows were left out because their arrival datetime could not be parsed, "
+                f"for example: {', '.join(parse_report.failed_examples)}"
+            )
 
         # Apply filtering using the dedicated function
-        filtered_df, df = apply_data_filtering(df, df_with_index)
-
-        # Now df contains the filtered dataframe with arrival_datetime as index
-        # This maintains consistency with the variable naming in the rest of the script
+        selection = apply_data_filtering(filter_index)
+        if selection is None:
+            return
+        dates, counts, excluded, filters, date_range = selection
 
-        # More robust date handling
-        df.index = pd.to_datetime(
-            df.index, dayfirst=True
-        )  # Ensure we have a DatetimeIndex
-        start_date = df.index.min()
-        end_date = df.index.max()
-        num_days = len(df.index.normalize().unique())
+        # Aggregate arrivals once; every chart below is drawn from this engine's
+        # memoized results rather than from the raw rows. Counts are kept at the
+        # finest resolution, and hourly or other intervals are summed from them
+        fine_engine = DemandEngine(counts, dates, excluded=excluded)
+        engine = fine_engine.resample(60)
+        start_date = engine.start_date
+        end_date = engine.end_date
+        num_days = engine.num_days
 
         st.write(
             f"""The uploaded dataset starts on {start_date.strftime("%-d %B %Y")} and ends on {end_date.strftime("%-d %B %Y")}, 
-                 and contains {len(df):,} inpatient arrivals over {num_days} days. 
+                 and contains {engine.num_arrivals:,} inpatient arrivals over {num_days} days. 
                  The chart below shows the average number of patients arriving each hour of the day who are later admitted."""
         )
 
@@ -254,21 +732,36 @@ def main():
         start_hour = st.sidebar.slider(
             "Draw charts starting at this hour", min_value=0, max_value=23, value=8
         )
+        # Arrival rates and beds needed can be drawn in shorter intervals than an
+        # hour, at no extra cost, if the upload was counted in them
+        resolutions = fine_engine.resolutions()
+        resolution = st.sidebar.selectbox(
+            "Time interval for arrivals and beds needed",
+            resolutions,
+            index=len(resolutions) - 1,
+            format_func=lambda minutes: "1 hour" if minutes == 60 else f"{minutes} minutes",
+            key="resolution",
+        )
+        rates_engine = fine_engine.resample(resolution)
+        interval = "hour" if resolution == 60 else f"{resolution} minutes"
+        # Interactive charts are drawn in the browser from the hourly values alone
+        st.sidebar.radio(
+            "Chart style", ["Static images", "Interactive"], key="chart_style"
+        )
 
         # Initial arrival rates plot
-        title = f"Hourly arrival rates of admitted patients starting at {start_hour} am from {df.index.date.min()} to {df.index.date.max()}"
-        initial_plot = generate_and_store_plot(
+        title = (
+            f"{'Hourly' if resolution == 60 else f'{resolution} minute'} arrival rates of admitted patients "
+            f"starting at {start_hour} am from {start_date.date()} to {end_date.date()}"
+        )
+        show_plot(
             plot_arrival_rates,
             "initial_plot",
-            df,
+            rates_engine.arrival_rates(),
             title,
-            time_interval=60,
             start_plot_index=start_hour,
-            num_days=num_days,
-            return_figure=True,
+            ylabel=f"Arrival Rate (patients per {interval})",
         )
-        if initial_plot:
-            st.pyplot(initial_plot)
 
         # Sidebar controls for ED performance
         st.sidebar.header("Your aspirations for ED performance")
@@ -300,6 +793,22 @@ def main():
             )
             / 100
         )
+        centile_method = st.sidebar.selectbox(
+            "Consistency target: How to calculate the beds needed",
+            list(CENTILE_METHODS),
+            format_func=CENTILE_METHODS.get,
+        )
+        distribution = st.sidebar.selectbox(
+            "Consistency target: Model of day-to-day variation in arrivals",
+            ["poisson", "best"] + [name for name in MODEL_NAMES if name != "poisson"],
+            format_func=lambda name: "Best fit to your data"
+            if name == "best"
+            else MODEL_NAMES[name],
+            disabled=centile_method in OBSERVED_METHODS,
+        )
+        show_fan = st.sidebar.checkbox(
+            "Show the spread of beds needed across days", value=False
+        )
 
         # Decision-making window controls
         st.sidebar.header("Decision-making window")
@@ -329,7 +838,7 @@ def main():
 
             # Display all Step 2 plots
             title = f"Aspirational curve reflecting a {int(x1)} hour target for {int(y1*100)}% of patients\nand a {int(x2)} hour target for {int(y2*100)}% of patients"
-            curve_plot = generate_and_store_plot(
+            show_plot(
                 plot_curve,
                 "curve_plot",
                 title=title,
@@ -341,8 +850,6 @@ def main():
                 include_titles=True,
                 return_figure=True,
             )
-            if curve_plot:
-                st.pyplot(curve_plot)
 
             # Step 3: Beds needed per hour
             st.subheader(
@@ -353,55 +860,31 @@ def main():
                      The solid line shows the average number of beds needed each hour."""
             )
 
-            hourly_beds_plot = generate_and_store_plot(
+            curve_params = (x1, y1, x2, y2)
+            # Admitting every patient exactly at the main target would need beds later
+            # and in sharper peaks than the curve does
+            show_lagged = st.checkbox(
+                f"Compare with admitting every patient exactly {x1:g} hours after arrival",
+                key="show_lagged",
+            )
+            show_plot(
                 plot_arrival_rates,
                 "hourly_beds_plot",
-                df,
-                title,
-                curve_params=(x1, y1, x2, y2),
-                time_interval=60,
+                rates_engine.arrival_rates(),
+                f"Number of beds needed each {interval} to hit ED targets for admitted patients",
+                bed_demand=rates_engine.bed_demand(curve_params),
+                curve_params=curve_params,
                 start_plot_index=start_hour,
-                num_days=num_days,
-                return_figure=True,
+                ylabel=f"Number of beds needed each {interval}, on average",
+                lagged_rates=rates_engine.lagged_rates(x1) if show_lagged else None,
+                lagged_by=x1 if show_lagged else None,
             )
-            if hourly_beds_plot:
-                ax = hourly_beds_plot.gca()
-                ax.set_ylabel("Number of beds needed each hour, on average")
-                ax.set_title(
-                    "Number of beds needed each hour to hit ED targets for admitted patients"
-                )
-                st.pyplot(hourly_beds_plot)
 
             st.write(
                 """The next chart presents the same information in a different way. Each hour's number of beds has been added cumulatively. 
                      The chart shows how, over the course of a 24 hour period, the total number builds up."""
             )
 
-            cumulative_plot = generate_and_store_plot(
-                plot_cumulative_arrival_rates,
-                "cumulative_plot",
-                df,
-                f"Cumulative number of beds needed, by hour of the day",
-                curve_params=(x1, y1, x2, y2),
-                start_plot_index=start_hour,
-                num_days=num_days,
-                return_figure=True,
-            )
-
-            # # Get the last 5 points from the plot
-            # if cumulative_plot:
-            #     ax = cumulative_plot.gca()
-            #     lines = ax.get_lines()
-            #     if lines:
-            #         line = lines[0]  # Get the first line
-            #         x_data = line.get_xdata()
-            #         y_data = line.get_ydata()
-            #         last_5_points = list(zip(x_data[-5:], y_data[-5:]))
-            #         st.write("Last 5 points (x, y):")
-            #         st.write(last_5_points)
-            # if cumulative_plot:
-            #     st.pyplot(cumulative_plot)
-
             # Step 4: Consistency targets
             st.subheader(
                 "Step 4: Specifying your aspirations for meeting ED targets consistently"
@@ -429,46 +912,36 @@ def main():
             ):
                 st.session_state.step4_completed = True
 
-                consistency_plot = generate_and_store_plot(
-                    plot_cumulative_arrival_rates,
+                # Every consistency target is computed at once, so changing it is a lookup
+                try:
+                    centile_table = engine.centile_table(
+                        curve_params, start_hour, centile_method, distribution=distribution
+                    )
+                except ValueError as e:
+                    # Observed methods need whole days whose neighbours are also selected
+                    st.error(f"{e} Choose another method, or include more days of the week.")
+                    return
+                if centile_method not in OBSERVED_METHODS and distribution != "poisson":
+                    model = engine.count_model(distribution)
+                    st.caption(
+                        f"Beds needed assume a {MODEL_NAMES[model.name].lower()} model of arrivals "
+                        f"(AIC {model.aic:,.0f}; Poisson AIC {engine.count_model('poisson').aic:,.0f})."
+                    )
+                show_plot(
+                    plot_cumulative_demand,
                     "consistency_plot",
-                    df,
+                    engine.cumulative_demand(curve_params, start_hour),
                     f"Cumulative number of beds needed, by hour of day if ED targets are to be met on {percentage_of_days*100:.0f}% of days",
-                    curve_params=(x1, y1, x2, y2),
+                    cumulative_centiles=lookup(centile_table, [percentage_of_days]),
+                    centiles=[percentage_of_days],
                     start_plot_index=start_hour,
-                    num_days=num_days,
-                    return_figure=True,
                     annotation_prefix=f"To hit targets on {percentage_of_days*100:.0f}% of days",
-                    plot_centiles=True,
                     highlight_centile=percentage_of_days,
-                    centiles=[percentage_of_days],
                     markers=["o"],
                     line_styles_centiles=["-.", "--", ":", "-", "-"],
+                    fan=centile_table if show_fan else None,
                 )
 
-                # # Get the last 5 points from both lines in the plot
-                # if consistency_plot:
-                #     ax = consistency_plot.gca()
-                #     lines = ax.get_lines()
-                #     if len(lines) >= 2:
-                #         # Get points from both lines
-                #         line1 = lines[0]
-                #         line2 = lines[1]
-                #         x_data1 = line1.get_xdata()
-                #         y_data1 = line1.get_ydata()
-                #         x_data2 = line2.get_xdata()
-                #         y_data2 = line2.get_ydata()
-
-                #         last_5_points_line1 = list(zip(x_data1[-5:], y_data1[-5:]))
-                #         last_5_points_line2 = list(zip(x_data2[-5:], y_data2[-5:]))
-
-                #         st.write("Last 5 points for first line (x, y):")
-                #         st.write(last_5_points_line1)
-                #         st.write("Last 5 points for second line (x, y):")
-                #         st.write(last_5_points_line2)
-                if consistency_plot:
-                    st.pyplot(consistency_plot)
-
                 # Step 5: Decision-making window
                 st.subheader("Step 5: Specifying your decision-making window")
                 st.write(
@@ -490,27 +963,50 @@ def main():
                 )
 
                 if st.button("Confirm your decision-making window"):
-                    final_plot = generate_and_store_plot(
-                        plot_cumulative_arrival_rates,
+                    show_plot(
+                        plot_cumulative_demand,
                         "final_plot",
-                        df,
+                        engine.cumulative_demand(curve_params, start_hour),
                         f"Cumulative number of beds needed, by hour of day, if ED targets are to be met on {percentage_of_days*100:.0f}% of days",
-                        curve_params=(x1, y1, x2, y2),
+                        cumulative_centiles=lookup(centile_table, [percentage_of_days]),
+                        centiles=[percentage_of_days],
                         start_plot_index=start_hour,
-                        num_days=num_days,
-                        return_figure=True,
                         annotation_prefix=f"To hit targets on {percentage_of_days*100:.0f}% of days",
                         draw_window=(start_of_window, end_of_window),
                         hour_lines=[12, end_of_window],
-                        plot_centiles=True,
                         highlight_centile=percentage_of_days,
-                        centiles=[percentage_of_days],
                         markers=["o"],
                         line_styles_centiles=["-.", "--", ":", "-", "-"],
+                        fan=centile_table if show_fan else None,
                     )
-                    if final_plot:
-                        st.pyplot(final_plot)
+
+                window_search_section(
+                    centile_table,
+                    percentage_of_days,
+                    start_of_window,
+                    end_of_window,
+                    start_hour,
+                )
+
+                compare_sites_section(
+                    filter_index,
+                    filters,
+                    date_range,
+                    curve_params,
+                    percentage_of_days,
+                    start_of_window,
+                    end_of_window,
+                    start_hour,
+                    centile_method,
+                    distribution,
+                )
 
 
 if __name__ == "__main__":
-    main()
+    # Stages are only timed when asked, in this session, so other sessions pay nothing
+    enable(st.session_state.get("instrument_enabled", ENABLED_BY_DEFAULT))
+    start_run()
+    try:
+        main()
+    finally:
+        debug_panel()
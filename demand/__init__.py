@@ -0,0 +1,27 @@
+"""
+Demand computations behind the un-delayed demand app.
+
+Arrivals are aggregated once into arrays of counts; the charts are drawn from
+memoized results derived from those arrays.
+
+The names below are imported on first use, so importing a light module such as
+`demand.instrument` or `demand.store` does not load NumPy, SciPy and the rest of
+the pipeline.
+"""
+
+import importlib
+
+_EXPORTS = {
+    "DemandEngine": "demand.engine",
+    "LRUCache": "demand.cache",
+    "count_matrix": "demand.engine",
+    "fingerprint": "demand.cache",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module 'demand' has no attribute '{name}'")
+    return getattr(importlib.import_module(_EXPORTS[name]), name)
@@ -0,0 +1,400 @@
+"""
+Headless batch runs over a grid of scenarios.
+
+The CSV file is read and aggregated once. Every combination of segment, target
+curve, consistency centile and decision-making window is then computed from that
+aggregate across a pool of worker processes, which also draw and save the charts.
+Workers receive only the small day x hour count matrix of their segment.
+A tidy table with one row per scenario is written alongside the figures, and the
+count models of every segment are fitted together and written to models.csv.
+
+Example:
+
+    python -m demand.batch data-raw/ed_sdec_ct_5.csv --output media/undelayed-demand \\
+        --segment "weekdays:Day type=Weekday" --segment "weekends:Day type=Weekend" \\
+        --curve 4,0.8,12,0.99 --centile 0.9 --window 8,17 --window 8,20
+
+    python -m demand.batch data-raw/ed_sdec_ct_5.csv --by specialty --by site --models-only
+"""
+
+import argparse
+import itertools
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from demand.filters import FilterIndex
+from demand.ingest import candidate_filter_columns, read_columns, stream_arrivals
+from demand.models import MODEL_NAMES, best_model, fit_count_models, summarise_models
+
+DEFAULT_SEGMENTS = ["all_days:", "weekdays:Day type=Weekday", "weekends:Day type=Weekend"]
+
+
+def parse_segment(text):
+    """
+    Parse a segment written as "name:column=value|value;column=value".
+
+    Parameters:
+    text (str): Segment definition; the part after the colon may be empty for all data
+
+    Returns:
+    tuple: (name, filters) where filters maps each column to a list of values
+    """
+    name, _, spec = text.partition(":")
+    filters = {}
+    for clause in filter(None, spec.split(";")):
+        column, _, values = clause.partition("=")
+        filters[column.strip()] = [value.strip() for value in values.split("|")]
+    return name.strip(), filters
+
+
+def segments_by(index, column):
+    """
+    One segment for each category of `column`.
+
+    Parameters:
+    index (FilterIndex): Index holding the categories of each column
+    column (str): Filter column or derived day attribute
+
+    Returns:
+    list of tuple: (name, filters) for each category
+    """
+    return [
+        (re.sub(r"[^\w.-]+", "_", f"{column}_{value}").strip("_"), {column: [value]})
+        for value in index.categories[column]
+    ]
+
+
+def _numbers(text, count, kind=float):
+    values = [kind(value) for value in text.split(",")]
+    if len(values) != count:
+        raise argparse.ArgumentTypeError(f"Expected {count} comma-separated values, got '{text}'")
+    return tuple(values)
+
+
+def _percent(value):
+    return f"{value*100:g}"
+
+
+def _curve_label(curve_params):
+    x1, y1, x2, y2 = curve_params
+    return f"{int(y1*100)}% in {x1:g}h, {int(y2*100)}% in {x2:g}h"
+
+
+def _curve_slug(curve_params):
+    x1, y1, x2, y2 = curve_params
+    return f"{x1:g}h{_percent(y1)}_{x2:g}h{_percent(y2)}"
+
+
+def run_task(task):
+    """
+    Compute one scenario (or one supporting chart) for a segment and save its figure.
+    Runs in a worker process.
+
+    Parameters:
+    task (dict): Segment name, dates, counts and excluded days, its fitted count model (None for
+    Poisson), the kind of task and its parameters
+
+    Returns:
+    list: A dict of results for a scenario task, otherwise an empty list
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from demand.centiles import lookup
+    from demand.engine import DemandEngine, window_requirements
+    from demand.plots import plot_arrival_rates, plot_cumulative_demand
+
+    name, start_hour = task["segment"], task["start_hour"]
+    folder = Path(task["output"]) / name
+    folder.mkdir(parents=True, exist_ok=True)
+    engine = DemandEngine(task["counts"], task["dates"], excluded=task["excluded"])
+    curve_params = task.get("curve")
+
+    if task["kind"] == "arrivals":
+        fig = plot_arrival_rates(
+            engine.arrival_rates(),
+            f"Hourly arrival rates of admitted patients starting at {start_hour} am - "
+            f"{name} from {engine.start_date.date()} to {engine.end_date.date()}",
+            start_plot_index=start_hour,
+        )
+        filename, rows = "1_arrival_rates.png", []
+
+    elif task["kind"] == "hourly":
+        fig = plot_arrival_rates(
+            engine.arrival_rates(),
+            f"Number of beds needed for admitted patients by hour on {name}\n"
+            f"assuming ED targets of {_curve_label(curve_params)} are hit, starting at {start_hour} am",
+            bed_demand=engine.bed_demand(curve_params),
+            curve_params=curve_params,
+            start_plot_index=start_hour,
+        )
+        filename, rows = f"5_hourly_beds_{_curve_slug(curve_params)}.png", []
+
+    else:
+        centile = task["centile"]
+        start_of_window, end_of_window = task["window"]
+        cumulative_mean = engine.cumulative_demand(curve_params, start_hour)
+        model = task["model"]
+        if model is None:
+            distribution = "poisson"
+            cumulative = engine.cumulative_centiles([centile], curve_params, start_hour)
+        else:
+            # The model fitted with every segment in `run_batch`, as written to models.csv
+            distribution = model.name
+            cumulative = lookup(
+                engine.model_table(model, curve_params, start_hour), [centile]
+            )
+        fig = task["figures"] and plot_cumulative_demand(
+            cumulative_mean,
+            f"Cumulative number of beds needed on {name}, by hour of day, "
+            f"to hit ED targets of {_curve_label(curve_params)}\non {centile*100:.0f}% of days, "
+            f"if beds for overnight arrivals are vacated between {start_of_window}:00 and {end_of_window}:00",
+            cumulative_centiles=cumulative,
+            centiles=[centile],
+            highlight_centile=centile,
+            start_plot_index=start_hour,
+            draw_window=task["window"],
+            hour_lines=[12, end_of_window],
+            annotation_prefix=f"To hit targets on {centile*100:.0f}% of days",
+            markers=["o"],
+        )
+        filename = (
+            f"9_cumulative_{_curve_slug(curve_params)}_p{_percent(centile)}"
+            f"_{start_of_window:02d}-{end_of_window:02d}.png"
+        )
+        x1, y1, x2, y2 = curve_params
+        rows = [
+            {
+                "segment": name,
+                "x1": x1,
+                "y1": y1,
+                "x2": x2,
+                "y2": y2,
+                "centile": centile,
+                "distribution": distribution,
+                "start_of_window": start_of_window,
+                "end_of_window": end_of_window,
+                "num_days": engine.num_days,
+                "arrivals_per_day": engine.num_arrivals / engine.num_days,
+                "mean_beds_per_day": float(cumulative_mean[-1]),
+                **window_requirements(
+                    cumulative[0], start_hour, start_of_window, end_of_window
+                ),
+                "figure": str(folder / filename) if task["figures"] else "",
+            }
+        ]
+
+    if fig:
+        fig.savefig(folder / filename, dpi=task["dpi"])
+        plt.close(fig)
+    return rows
+
+
+def run_batch(
+    file,
+    datetime_col="arrival_datetime",
+    segments=DEFAULT_SEGMENTS,
+    curves=((4, 0.8, 12, 0.99),),
+    centiles=(0.9,),
+    windows=((8, 17), (8, 20)),
+    start_hour=8,
+    output="media",
+    workers=None,
+    figures=True,
+    dpi=150,
+    by=(),
+    distribution="poisson",
+    models_only=False,
+):
+    """
+    Run every combination of segment, curve, centile and window, writing figures and a results table.
+
+    Parameters:
+    file (str or path): CSV file of arrivals
+    datetime_col (str): Column containing arrival datetimes
+    segments (list of str): Segment definitions, see `parse_segment`
+    curves (list of tuple): Aspirational curves as (x1, y1, x2, y2)
+    centiles (list of float): Consistency targets between 0 and 1
+    windows (list of tuple): Decision-making windows as (start hour, end hour)
+    start_hour (int): Hour of day at which charts start
+    output (str or path): Folder for figures, results.csv and models.csv; one subfolder per segment
+    workers (int, optional): Number of worker processes; defaults to one per CPU
+    figures (bool): Whether to save figures, or only the results table
+    dpi (int): Resolution of saved figures
+    by (list of str): Columns to add one segment for each category of
+    distribution (str): Count model for centiles: "poisson", a name in `demand.models.MODEL_NAMES`,
+    or "best" for the best fit to each segment
+    models_only (bool): Only fit count models and write models.csv
+
+    Returns:
+    pandas.DataFrame: One row per scenario, or per segment and model if `models_only`
+    """
+    # One pass over the file serves every segment
+    head = read_columns(file)
+    cube, report = stream_arrivals(
+        file, datetime_col, candidate_filter_columns(head, datetime_col)
+    )
+    index = FilterIndex(cube)
+
+    selections = [parse_segment(segment) for segment in segments]
+    for column in by:
+        selections += segments_by(index, column)
+    matrices = []
+    for name, filters in selections:
+        try:
+            matrices.append((name, index.selection(filters)))
+        except ValueError as e:
+            print(f"Skipping segment '{name}': {e}")
+
+    if not matrices:
+        raise ValueError("No segment has any arrivals.")
+
+    # Count models for every segment are fitted together
+    Path(output).mkdir(parents=True, exist_ok=True)
+    fits = fit_count_models([(dates, counts) for _, (dates, counts, _) in matrices])
+    models = summarise_models(fits, [name for name, _ in matrices])
+    models.to_csv(Path(output) / "models.csv", index=False)
+    if models_only:
+        return models
+
+    tasks = []
+    for (name, (dates, counts, excluded)), models in zip(matrices, fits):
+        if distribution == "poisson":
+            model = None
+        else:
+            model = best_model(models) if distribution == "best" else models[distribution]
+        common = {
+            "segment": name,
+            "dates": dates,
+            "counts": counts,
+            "excluded": excluded,
+            "start_hour": start_hour,
+            "output": str(output),
+            "figures": figures,
+            "dpi": dpi,
+            "model": model,
+        }
+        if figures:
+            tasks.append({**common, "kind": "arrivals"})
+        for curve_params in curves:
+            if figures:
+                tasks.append({**common, "kind": "hourly", "curve": tuple(curve_params)})
+            for centile, window in itertools.product(centiles, windows):
+                tasks.append(
+                    {
+                        **common,
+                        "kind": "scenario",
+                        "curve": tuple(curve_params),
+                        "centile": centile,
+                        "window": tuple(window),
+                    }
+                )
+
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        rows = [row for task in tasks for row in run_task(task)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = [
+                row
+                for result in pool.map(run_task, tasks, chunksize=4)
+                for row in result
+            ]
+
+    results = pd.DataFrame(rows)
+    results.to_csv(Path(output) / "results.csv", index=False)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compute un-delayed demand for a grid of scenarios and save charts and a results table."
+    )
+    parser.add_argument("file", help="CSV file of arrivals of admitted patients")
+    parser.add_argument("--datetime-col", default="arrival_datetime")
+    parser.add_argument(
+        "--segment",
+        action="append",
+        help='Segment as "name:column=value|value;column=value" (repeatable). '
+        "Columns include Day type, Day of week, Month and Bank holiday. "
+        "Defaults to all days, weekdays and weekends.",
+    )
+    parser.add_argument(
+        "--curve",
+        action="append",
+        type=lambda text: _numbers(text, 4),
+        help="Aspirational curve as x1,y1,x2,y2 (repeatable, default 4,0.8,12,0.99)",
+    )
+    parser.add_argument(
+        "--centile",
+        action="append",
+        type=float,
+        help="Consistency target between 0 and 1 (repeatable, default 0.9)",
+    )
+    parser.add_argument(
+        "--window",
+        action="append",
+        type=lambda text: _numbers(text, 2, int),
+        help="Decision-making window as start,end hours (repeatable, default 8,17 and 8,20)",
+    )
+    parser.add_argument(
+        "--by",
+        action="append",
+        default=[],
+        help="Add one segment for each category of this column (repeatable)",
+    )
+    parser.add_argument(
+        "--distribution",
+        default="poisson",
+        choices=["poisson", "best", *MODEL_NAMES],
+        help="Count model used for centiles; 'best' picks the best fit for each segment",
+    )
+    parser.add_argument(
+        "--models-only",
+        action="store_true",
+        help="Only fit count models to each segment and write models.csv",
+    )
+    parser.add_argument("--start-hour", type=int, default=8)
+    parser.add_argument("--output", default="media")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument(
+        "--no-figures", action="store_true", help="Only write the results table"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_batch(
+            args.file,
+            datetime_col=args.datetime_col,
+            segments=args.segment or DEFAULT_SEGMENTS,
+            curves=args.curve or [(4, 0.8, 12, 0.99)],
+            centiles=args.centile or [0.9],
+            windows=args.window or [(8, 17), (8, 20)],
+            start_hour=args.start_hour,
+            output=args.output,
+            workers=args.workers,
+            figures=not args.no_figures,
+            dpi=args.dpi,
+            by=args.by,
+            distribution=args.distribution,
+            models_only=args.models_only,
+        )
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if args.models_only:
+        print(f"Wrote {len(results)} model fits to {Path(args.output) / 'models.csv'}")
+    else:
+        print(f"Wrote {len(results)} scenarios to {Path(args.output) / 'results.csv'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Benchmarks of each stage of the demand pipeline.
+
+A CSV file (by default a synthetic one from `demand.synthetic`) is read, parsed
+and aggregated in chunks, as the app does for large uploads, and the demand
+calculations and a chart are then computed from the result. Each stage is timed
+separately, with its throughput in arrivals per second and, unless turned off,
+the peak memory it allocates. Memory is measured with tracemalloc in a separate
+run, since tracing allocations slows the stages down several times. Stages after
+aggregation are repeated and the fastest run is kept, with the result caches
+cleared before each run.
+
+Results can be saved as a baseline and later runs compared with it, so a change
+that slows a stage down is caught before it reaches users. Baselines are only
+comparable on the same machine and with the same number of rows.
+
+Example:
+
+    python -m demand.benchmark --rows 1000000 --save-baseline benchmarks/baseline_1m.json
+    python -m demand.benchmark --rows 1000000 --baseline benchmarks/baseline_1m.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from demand.centiles import CENTILE_METHODS, lookup
+from demand.cube import CubeBuilder
+from demand.engine import RESULT_CACHE, DemandEngine
+from demand.filters import FilterIndex
+from demand.ingest import candidate_filter_columns, parse_datetimes, read_columns
+from demand.plots import FIGURE_CACHE, plot_cumulative_demand, render_png
+from demand.synthetic import write_arrivals
+
+CURVE_PARAMS = (4, 0.8, 12, 0.99)
+START_HOUR = 8
+
+
+class StageTimer:
+    """
+    Wall time and peak allocated memory of each stage, over one or more runs.
+
+    Parameters:
+    track_memory (bool): Whether to measure memory with tracemalloc
+    """
+
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, accumulate=False):
+        """
+        Time a block of code as (part of) a stage.
+
+        Parameters:
+        name (str): Stage name
+        accumulate (bool): Add the time to earlier parts of the same run, for stages done in chunks;
+        otherwise each call is a separate run and the fastest is kept
+        """
+        if self.track_memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] - start_memory if self.track_memory else 0
+
+        stage = self.stages.setdefault(name, {"seconds": None, "peak_bytes": 0})
+        if stage["seconds"] is None:
+            stage["seconds"] = seconds
+        elif accumulate:
+            stage["seconds"] += seconds
+        else:
+            stage["seconds"] = min(stage["seconds"], seconds)
+        stage["peak_bytes"] = max(stage["peak_bytes"], peak)
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_pipeline(file, datetime_col, chunksize, repeat, methods, timer):
+    """Run every stage of the pipeline, timing each with `timer`. Returns (rows, datetime method)."""
+    # Read, parse and aggregate in chunks, timing each step separately
+    filter_columns = candidate_filter_columns(read_columns(file), datetime_col)
+    builder = CubeBuilder(filter_columns)
+    reader = pd.read_csv(
+        file,
+        usecols=[datetime_col, *filter_columns],
+        dtype={col: str for col in filter_columns},
+        chunksize=chunksize,
+    )
+    method, rows = None, 0
+    with reader:
+        while True:
+            with timer.stage("read", accumulate=True):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            with timer.stage("parse", accumulate=True):
+                parsed, report = parse_datetimes(chunk[datetime_col], method)
+            method = method or report.method
+            with timer.stage("aggregate", accumulate=True):
+                builder.add(parsed, chunk)
+            rows += len(chunk)
+            del chunk, parsed
+    with timer.stage("aggregate", accumulate=True):
+        cube = builder.build()
+    del builder
+
+    # Filter on one category of the first column, and on weekdays
+    filters = {"Day type": ["Weekday"]}
+    if filter_columns:
+        column = filter_columns[0]
+        filters[column] = [cube.categories[column][0]]
+    for _ in range(repeat):
+        with timer.stage("filter"):
+            index = FilterIndex(cube)
+            dates, counts = index.select(filters)
+
+    for _ in range(repeat):
+        RESULT_CACHE.clear()
+        with timer.stage("convolution"):
+            engine = DemandEngine(counts, dates)
+            engine.cumulative_demand(CURVE_PARAMS, START_HOUR)
+
+    for centile_method in methods:
+        for _ in range(repeat):
+            RESULT_CACHE.clear()
+            engine = DemandEngine(counts, dates)
+            with timer.stage(f"centiles_{centile_method}"):
+                table = engine.centile_table(CURVE_PARAMS, START_HOUR, centile_method)
+
+    cumulative_mean = engine.cumulative_demand(CURVE_PARAMS, START_HOUR)
+    for _ in range(repeat):
+        FIGURE_CACHE.clear()
+        with timer.stage("render"):
+            render_png(
+                plot_cumulative_demand,
+                cumulative_mean,
+                "Cumulative number of beds needed",
+                cumulative_centiles=lookup(table, [0.9]),
+                centiles=[0.9],
+                start_plot_index=START_HOUR,
+                draw_window=(8, 20),
+                hour_lines=[12, 20],
+                fan=table,
+            )
+    RESULT_CACHE.clear()
+    FIGURE_CACHE.clear()
+    return rows, method
+
+
+def run_benchmark(
+    file,
+    datetime_col="arrival_datetime",
+    chunksize=500_000,
+    repeat=3,
+    track_memory=True,
+    methods=tuple(CENTILE_METHODS),
+):
+    """
+    Time each stage of the pipeline on a CSV file.
+
+    Parameters:
+    file (str or path): CSV file of arrivals
+    datetime_col (str): Column containing arrival datetimes
+    chunksize (int): Number of rows to read at a time
+    repeat (int): Number of runs of each stage after aggregation; the fastest is kept
+    track_memory (bool): Whether to measure the peak memory of each stage, in a second run
+    methods (list of str): Centile methods to time, from `demand.centiles.CENTILE_METHODS`
+
+    Returns:
+    dict: The number of rows, the environment, and the seconds, arrivals per second and
+    peak memory of each stage
+    """
+    started = time.perf_counter()
+    timer = StageTimer(track_memory=False)
+    rows, method = _run_pipeline(file, datetime_col, chunksize, repeat, methods, timer)
+    total_seconds = time.perf_counter() - started
+    peak_rss_bytes = _peak_rss_bytes()
+
+    memory = StageTimer(track_memory=True)
+    if track_memory:
+        tracemalloc.start()
+        try:
+            _run_pipeline(file, datetime_col, chunksize, 1, methods, memory)
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "file": str(file),
+        "file_bytes": os.path.getsize(file),
+        "rows": rows,
+        "datetime_method": method,
+        "repeat": repeat,
+        "total_seconds": total_seconds,
+        "peak_rss_bytes": peak_rss_bytes,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": {
+            name: {
+                "seconds": stage["seconds"],
+                "rows_per_second": rows / stage["seconds"] if stage["seconds"] else None,
+                "peak_mb": (
+                    memory.stages[name]["peak_bytes"] / 1024**2 if track_memory else None
+                ),
+            }
+            for name, stage in timer.stages.items()
+        },
+    }
+
+
+def stage_table(results):
+    """
+    The stage timings of a benchmark as a table.
+
+    Parameters:
+    results (dict): Results from `run_benchmark`
+
+    Returns:
+    pandas.DataFrame: One row per stage
+    """
+    return pd.DataFrame.from_dict(results["stages"], orient="index").rename_axis("stage")
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_seconds=0.005):
+    """
+    Compare the stage timings of a benchmark with those of a baseline.
+
+    Parameters:
+    results (dict): Results from `run_benchmark`
+    baseline (dict): Earlier results from `run_benchmark`
+    tolerance (float): Proportion by which a stage may be slower, or use more memory, than the baseline
+    min_seconds (float): Differences in time smaller than this are never counted as slower
+
+    Returns:
+    pandas.DataFrame: One row per stage, with the ratio to the baseline and whether it has regressed
+    """
+    current, before = stage_table(results), stage_table(baseline)
+    table = current.join(before, rsuffix="_baseline", how="left")
+    table["time_ratio"] = table["seconds"] / table["seconds_baseline"]
+    table["memory_ratio"] = table["peak_mb"] / table["peak_mb_baseline"]
+    slower = (table["time_ratio"] > 1 + tolerance) & (
+        table["seconds"] - table["seconds_baseline"] > min_seconds
+    )
+    more_memory = (table["memory_ratio"] > 1 + tolerance) & (
+        table["peak_mb"] - table["peak_mb_baseline"] > 1
+    )
+    table["regressed"] = slower | more_memory
+    return table[
+        [
+            "seconds",
+            "seconds_baseline",
+            "time_ratio",
+            "peak_mb",
+            "peak_mb_baseline",
+            "memory_ratio",
+            "regressed",
+        ]
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the demand pipeline, optionally against a saved baseline."
+    )
+    parser.add_argument(
+        "file", nargs="?", help="CSV file of arrivals; a synthetic file is generated if omitted"
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Rows of synthetic data")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument("--datetime-col", default="arrival_datetime")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Do not measure the memory of each stage, which takes a second, slower run",
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline for later runs")
+    parser.add_argument("--baseline", help="Compare with a saved baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Proportion by which a stage may be slower than the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as folder:
+        file = args.file
+        if file is None:
+            file = Path(folder) / f"synthetic_{args.rows}.csv"
+            print(f"Generating {args.rows:,} synthetic arrivals...")
+            write_arrivals(file, args.rows, seed=args.seed)
+        results = run_benchmark(
+            file,
+            args.datetime_col,
+            chunksize=args.chunksize,
+            repeat=args.repeat,
+            track_memory=not args.no_memory,
+        )
+
+    print(
+        f"{results['rows']:,} rows ({results['file_bytes'] / 1024**2:,.0f} MB) "
+        f"in {results['total_seconds']:.1f} seconds"
+    )
+    if results["peak_rss_bytes"]:
+        print(f"Peak memory of the process: {results['peak_rss_bytes'] / 1024**2:,.0f} MB")
+    print(stage_table(results).round(4).to_string())
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(results, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline["rows"] != results["rows"]:
+            print(
+                f"Warning: the baseline has {baseline['rows']:,} rows, "
+                f"so its timings are not comparable"
+            )
+        comparison = compare_to_baseline(results, baseline, args.tolerance)
+        print(f"\nCompared with {args.baseline}:")
+        print(comparison.round(3).to_string())
+        if comparison["regressed"].any():
+            regressed = ", ".join(comparison.index[comparison["regressed"]])
+            print(f"\nSlower or larger than the baseline: {regressed}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Small in-process caches shared by the demand computations.
+
+Results are keyed by a fingerprint of the data they were derived from, so the
+same cache can safely serve several datasets (for example, different filter
+selections) at once.
+"""
+
+import functools
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from demand.instrument import CACHES, stage
+
+
+class LRUCache:
+    """
+    A thread-safe mapping that evicts the least recently used entry once it holds
+    more than `maxsize` items.
+
+    Parameters:
+    maxsize (int): Maximum number of entries to keep
+    name (str, optional): Name under which the cache's hit rate is reported, see `demand.instrument`
+    """
+
+    def __init__(self, maxsize=256, name=None):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive.")
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name is not None:
+            CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_MISSING = object()
+
+
+def fingerprint(*arrays, extra=()):
+    """
+    Return a short content hash for one or more NumPy arrays.
+
+    Parameters:
+    *arrays (numpy.ndarray): Arrays whose contents identify the data
+    extra (tuple): Additional hashable values mixed into the hash (e.g. the time interval)
+
+    Returns:
+    str: Hex digest identifying the inputs
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.dtype).encode())
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+def _freeze(value):
+    """Convert lists, dicts and arrays into hashable equivalents for use in cache keys."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return fingerprint(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def make_key(*parts):
+    """
+    Hashable cache key for arbitrary arguments, with arrays replaced by their fingerprint.
+
+    Parameters:
+    *parts: Values identifying a result, such as a function name and its arguments
+
+    Returns:
+    tuple: The key
+    """
+    return _freeze(parts)
+
+
+def _read_only(result):
+    """Mark cached arrays read-only so callers cannot corrupt shared results."""
+    if isinstance(result, np.ndarray):
+        result.setflags(write=False)
+    elif isinstance(result, tuple):
+        for item in result:
+            _read_only(item)
+    elif isinstance(result, dict):
+        for item in result.values():
+            _read_only(item)
+    return result
+
+
+def memoize_method(cache):
+    """
+    Decorator that memoizes a method in `cache`, keyed by the instance's `fingerprint`
+    attribute, the method name and the (normalised) call arguments. Each call is
+    recorded as a stage named after the method, see `demand.instrument`.
+
+    Parameters:
+    cache (LRUCache): Cache in which to store results
+
+    Returns:
+    callable: The decorator
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = tuple(
+                (name, _freeze(value))
+                for name, value in bound.arguments.items()
+                if name != "self"
+            )
+            key = (self.fingerprint, method.__qualname__, arguments)
+            with stage(method.__name__):
+                result = cache.get(key, _MISSING)
+                if result is _MISSING:
+                    result = _read_only(method(self, *args, **kwargs))
+                    cache[key] = result
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,210 @@
+"""
+Centiles of bed demand for every consistency target at once.
+
+A centile table holds the cumulative number of beds needed by each hour of the
+day for every whole-number percentage of days from 1 to 100, so changing the
+consistency target is a lookup. Four methods are available:
+
+- "hourly": the sum over hours of each hour's Poisson centile, as drawn by
+  `patientflow.viz.arrival_rates.plot_cumulative_arrival_rates`
+- "analytic": centiles of the cumulative demand itself. Arrivals thinned by the
+  aspirational curve stay Poisson, so cumulative demand is Poisson with the
+  cumulative mean
+- "bootstrap": centiles of the demand observed on each day, with the arrivals
+  of each day spread over the following hours by the curve weights, averaged
+  over bootstrap resamples of the days
+- "empirical": centiles of the demand observed on each day, read directly from
+  the same days without resampling
+
+The last two use the matrix of demand on each day from
+`demand.convolution.daily_demand`, so they ignore the model of arrivals.
+"""
+
+import numpy as np
+import scipy.stats as stats
+
+CENTILE_METHODS = {
+    "hourly": "Sum of hourly centiles",
+    "analytic": "Distribution of cumulative demand (Poisson)",
+    "bootstrap": "Observed days (bootstrap)",
+    "empirical": "Observed days (empirical)",
+}
+
+# Methods read from the demand observed on each day rather than a model of arrivals
+OBSERVED_METHODS = ("bootstrap", "empirical")
+
+# Every whole-number percentage of days; 100% is represented as 99.99%
+# because no finite number of beds meets Poisson demand with certainty
+PERCENTAGES = np.arange(1, 101)
+LEVELS = np.minimum(PERCENTAGES / 100, 0.9999)
+
+
+def _start(start_hour, values):
+    """Position of the first interval of the hour `start_hour`, in per-interval values (last axis)."""
+    return start_hour * (np.shape(values)[-1] // 24)
+
+
+def poisson_centiles(rates, centiles):
+    """
+    Number of arrivals in each interval that will not be exceeded with the given probabilities,
+    assuming Poisson arrivals at the given rates.
+
+    Parameters:
+    rates (numpy.ndarray): Mean arrivals per interval
+    centiles (list of float): Probabilities between 0 and 1; values of 1.0 are treated as 0.9999
+
+    Returns:
+    numpy.ndarray: Array of shape (len(centiles), len(rates))
+    """
+    rates = np.asarray(rates, dtype=float)
+    centiles = np.minimum(np.asarray(centiles, dtype=float), 0.9999)
+    with np.errstate(invalid="ignore"):
+        values = stats.poisson.ppf(centiles[:, None], rates[None, :])
+    # Guard against degenerate ppf values in the same way as the plotting library
+    fallback = np.broadcast_to(10 * rates, values.shape)
+    bad = ~np.isfinite(values) | (values > 1000 * rates)
+    values = np.where(bad & (rates > 0), fallback, values)
+    return np.where(rates > 0, values, 0.0)
+
+
+def mixture_centiles(rates, weights, dispersion, centiles):
+    """
+    Centiles of demand in each interval when days fall into strata (such as days of the week)
+    and demand on a day of stratum c has mean `rates[c]`, allowing for day-level overdispersion.
+
+    Parameters:
+    rates (numpy.ndarray): Mean demand per interval in each stratum, shape (strata, intervals)
+    weights (numpy.ndarray): Share of days in each stratum
+    dispersion (float): Negative binomial shape of the day-level variation; infinite for Poisson
+    centiles (list of float): Probabilities between 0 and 1; values of 1.0 are treated as 0.9999
+
+    Returns:
+    numpy.ndarray: Array of shape (len(centiles), intervals)
+    """
+    rates = np.atleast_2d(np.asarray(rates, dtype=float))
+    weights = np.asarray(weights, dtype=float)
+    levels = np.minimum(np.asarray(centiles, dtype=float), 0.9999)
+    if np.isinf(dispersion):
+        distribution = stats.poisson(rates)
+    else:
+        distribution = stats.nbinom(dispersion, dispersion / (dispersion + rates))
+    # Evaluate the mixture's distribution function on every count up to the largest centile needed
+    upper = int(np.nanmax(distribution.ppf(levels.max()), initial=0))
+    grid = np.arange(upper + 1)[:, None, None]
+    cdf = np.tensordot(weights, distribution.cdf(grid).transpose(1, 0, 2), axes=1)
+    return (cdf[None, :, :] < levels[:, None, None] - 1e-12).sum(axis=1).astype(float)
+
+
+def hourly_table(rates, start_hour, weights=None, dispersion=np.inf):
+    """
+    Centile table from the running sum of each hour's centile.
+
+    With the default arguments demand in each hour is Poisson with mean `rates`. Otherwise `rates`
+    has one row per stratum of days, mixed by `weights`, with day-level overdispersion `dispersion`.
+    """
+    if weights is None and np.isinf(dispersion):
+        centiles = poisson_centiles(rates, LEVELS)
+    else:
+        weights = np.ones(1) if weights is None else weights
+        centiles = mixture_centiles(rates, weights, dispersion, LEVELS)
+    return np.cumsum(np.roll(centiles, -_start(start_hour, rates), axis=1), axis=1)
+
+
+def analytic_table(rates, start_hour, weights=None, dispersion=np.inf):
+    """
+    Centile table of cumulative demand.
+
+    Arrivals thinned by the aspirational curve stay Poisson, so cumulative demand is Poisson with
+    the cumulative mean; see `hourly_table` for strata and overdispersion.
+    """
+    cumulative_mean = np.cumsum(np.roll(rates, -_start(start_hour, rates), axis=-1), axis=-1)
+    if weights is None and np.isinf(dispersion):
+        return poisson_centiles(cumulative_mean, LEVELS)
+    weights = np.ones(1) if weights is None else weights
+    return mixture_centiles(cumulative_mean, weights, dispersion, LEVELS)
+
+
+def observed_cumulative(demand, observed, start_hour, warmup=0, excluded=None):
+    """
+    Cumulative demand over each observed 24-hour period starting at `start_hour`.
+
+    Only periods starting on days with arrivals are kept, matching how the mean is calculated.
+    Periods that start within the first `warmup` intervals of the timeline, or run past its
+    end, are incomplete and dropped, as are periods that run into an excluded day or whose
+    previous `warmup` intervals do, since the demand carried over from that day is missing.
+
+    Parameters:
+    demand (numpy.ndarray): Demand of shape (days, intervals per day), for consecutive days
+    observed (numpy.ndarray): Whether each day had any arrivals
+    start_hour (int): Hour of day at which each period starts
+    warmup (int): Number of intervals at the start of the timeline missing the demand of earlier arrivals
+    excluded (numpy.ndarray, optional): Whether each day was left out of the selection
+
+    Returns:
+    numpy.ndarray: Array of shape (periods, intervals per day)
+    """
+    num_days, num_slots = demand.shape
+    starts = np.arange(num_days) * num_slots + _start(start_hour, demand)
+    demand = demand.ravel()
+    keep = observed & (starts >= warmup) & (starts + num_slots <= len(demand))
+    if excluded is not None and np.any(excluded):
+        # Number of excluded intervals before each point of the timeline
+        gaps = np.concatenate([[0], np.cumsum(np.repeat(excluded, num_slots))])
+        first = np.clip(starts - warmup, 0, len(demand))
+        last = np.clip(starts + num_slots, 0, len(demand))
+        keep &= gaps[last] == gaps[first]
+    periods = demand[starts[keep][:, None] + np.arange(num_slots)]
+    return np.cumsum(periods, axis=1)
+
+
+def bootstrap_table(cumulative, n_boot=200, seed=0, batch=20):
+    """
+    Centile table from bootstrap resamples of the observed days.
+
+    Parameters:
+    cumulative (numpy.ndarray): Cumulative demand over each observed period, see `observed_cumulative`
+    n_boot (int): Number of bootstrap resamples
+    seed (int): Seed for the random number generator, so results are repeatable
+    batch (int): Number of resamples evaluated together
+
+    Returns:
+    numpy.ndarray: Array of shape (100, intervals per day)
+    """
+    if len(cumulative) == 0:
+        raise ValueError("There are no complete days to resample.")
+    rng = np.random.default_rng(seed)
+    total = np.zeros((len(LEVELS), cumulative.shape[1]))
+    for size in np.diff(np.r_[np.arange(0, n_boot, batch), n_boot]):
+        samples = cumulative[rng.integers(0, len(cumulative), (size, len(cumulative)))]
+        total += np.quantile(samples, LEVELS, axis=1).sum(axis=1)
+    return total / n_boot
+
+
+def empirical_table(cumulative):
+    """
+    Centile table read directly from the observed days.
+
+    Parameters:
+    cumulative (numpy.ndarray): Cumulative demand over each observed period, see `observed_cumulative`
+
+    Returns:
+    numpy.ndarray: Array of shape (100, intervals per day)
+    """
+    if len(cumulative) == 0:
+        raise ValueError("There are no complete days to read centiles from.")
+    return np.quantile(cumulative, LEVELS, axis=0)
+
+
+def lookup(table, centiles):
+    """
+    Rows of a centile table for the given probabilities.
+
+    Parameters:
+    table (numpy.ndarray): Centile table of shape (100, intervals per day)
+    centiles (list of float): Probabilities between 0.01 and 1
+
+    Returns:
+    numpy.ndarray: Array of shape (len(centiles), intervals per day)
+    """
+    rows = np.clip(np.rint(np.asarray(centiles) * 100).astype(int), 1, 100) - 1
+    return table[rows]
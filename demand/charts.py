@@ -0,0 +1,547 @@
+"""
+Interactive charts drawn in the browser from precomputed demand arrays.
+
+These take the same arguments as the matplotlib charts in `demand.plots` (and
+`plot_curve`), so either can be used for any step of the app. Only the small
+table of hourly values behind each chart is sent to the browser, which draws
+it as a Vega-Lite chart. Styling arguments that only apply to the matplotlib
+charts are accepted and ignored. The `*_table` functions return the same
+values as a DataFrame, for downloading.
+"""
+
+import inspect
+
+import altair as alt
+import numpy as np
+import pandas as pd
+
+from patientflow.calculate.admission_in_prediction_window import create_curve
+
+from demand.engine import hour_labels, rotate, window_requirements
+from demand.instrument import timed
+
+
+def _hours(start_plot_index, num_intervals=24):
+    return [
+        label.replace("\n", "") for label in hour_labels(start_plot_index, num_intervals)
+    ]
+
+
+def _title(title):
+    return alt.TitleParams(title.split("\n"), anchor="start")
+
+
+def _percent(centile):
+    return f"{min(centile, 0.9999)*100:.2f}".rstrip("0").rstrip(".")
+
+
+def arrival_rates_table(
+    arrival_rates, bed_demand=None, start_plot_index=0, lagged_rates=None
+):
+    """
+    Arrival rates (and bed demand) for each interval of the day, in the order they are charted.
+
+    Parameters:
+    arrival_rates (numpy.ndarray): Mean arrivals for each interval, starting at midnight
+    bed_demand (numpy.ndarray, optional): Mean beds needed for each interval, starting at midnight
+    start_plot_index (int): Hour of day at which the table starts
+    lagged_rates (numpy.ndarray, optional): Mean beds needed for each interval with a fixed delay
+    from arrival to admission, starting at midnight
+
+    Returns:
+    pandas.DataFrame: One row per interval
+    """
+    table = pd.DataFrame(
+        {
+            "hour": _hours(start_plot_index, len(arrival_rates)),
+            "arrival_rate": rotate(arrival_rates, start_plot_index),
+        }
+    )
+    if lagged_rates is not None:
+        table["beds_needed_lagged"] = rotate(lagged_rates, start_plot_index)
+    if bed_demand is not None:
+        table["beds_needed"] = rotate(bed_demand, start_plot_index)
+    return table
+
+
+def cumulative_demand_table(
+    cumulative_mean,
+    cumulative_centiles=None,
+    centiles=None,
+    start_plot_index=0,
+    fan=None,
+    fan_bands=((5, 95), (10, 90), (25, 75)),
+):
+    """
+    Cumulative beds needed by hour, on average and for each centile, in the order they are charted.
+
+    Parameters:
+    cumulative_mean (numpy.ndarray): Running total of mean demand, already starting at `start_plot_index`
+    cumulative_centiles (numpy.ndarray, optional): Running totals for each centile, shape (len(centiles), 24)
+    centiles (list of float, optional): The centiles in `cumulative_centiles`
+    start_plot_index (int): Hour of day at which the running totals start
+    fan (numpy.ndarray, optional): Centile table of shape (100, 24), from which the band edges are added
+    fan_bands (list of tuple): Pairs of percentages of days bounding each band
+
+    Returns:
+    pandas.DataFrame: One row per hour
+    """
+    table = pd.DataFrame(
+        {"hour": _hours(start_plot_index), "mean_beds": np.asarray(cumulative_mean)}
+    )
+    if cumulative_centiles is not None:
+        for centile, values in zip(centiles, cumulative_centiles):
+            table[f"beds_p{_percent(centile)}"] = values
+    if fan is not None:
+        for percentage in sorted({p for band in fan_bands for p in band}):
+            table[f"beds_p{percentage}"] = fan[percentage - 1]
+    return table
+
+
+def aspirational_curve_table(x1, y1, x2, y2):
+    """
+    Points on the aspirational curve.
+
+    Returns:
+    pandas.DataFrame: Hours since arrival and the probability of having been admitted by then
+    """
+    _, _, _, x_values, y_values = create_curve(x1, y1, x2, y2, generate_values=True)
+    return pd.DataFrame(
+        {"hours_since_arrival": x_values, "probability_admitted": y_values}
+    )
+
+
+def arrival_rates_chart(
+    arrival_rates,
+    title,
+    bed_demand=None,
+    curve_params=None,
+    start_plot_index=0,
+    ylabel="Arrival Rate (patients per hour)",
+    lagged_rates=None,
+    lagged_by=None,
+    **styling,
+):
+    """
+    Interactive version of `demand.plots.plot_arrival_rates`.
+
+    Returns:
+    altair.Chart: The chart
+    """
+    table = arrival_rates_table(arrival_rates, bed_demand, start_plot_index, lagged_rates)
+    names = {"arrival_rate": "Arrival rates of admitted patients"}
+    if lagged_rates is not None:
+        names["beds_needed_lagged"] = (
+            f"Average number of beds needed assuming admission exactly {lagged_by:g} hours after arrival"
+        )
+    if bed_demand is not None:
+        x1, y1, _, _ = curve_params
+        names["beds_needed"] = (
+            f"Average number of beds applying ED targets of {int(y1*100)}% in {int(x1)} hours"
+        )
+    long = table.melt("hour", var_name="series", value_name="value")
+    long["series"] = long["series"].map(names)
+    if len(table) == 24:
+        x = alt.X("hour:O", sort=list(table["hour"]), title="Hour of day")
+    else:
+        # Intervals shorter than an hour are labelled on the hour only
+        x = alt.X(
+            "hour:O",
+            sort=list(table["hour"]),
+            title="Time of day",
+            axis=alt.Axis(labelExpr="slice(datum.value, 3) == '00' ? datum.value : ''"),
+        )
+    return (
+        alt.Chart(long, title=_title(title))
+        .mark_line(point=True)
+        .encode(
+            x=x,
+            y=alt.Y("value:Q", title=ylabel),
+            color=alt.Color("series:N", title=None, legend=alt.Legend(orient="top")),
+            strokeDash=alt.StrokeDash("series:N", legend=None),
+            tooltip=["hour", "series", alt.Tooltip("value:Q", format=".2f")],
+        )
+        .properties(height=400)
+    )
+
+
+def cumulative_demand_chart(
+    cumulative_mean,
+    title,
+    cumulative_centiles=None,
+    centiles=None,
+    highlight_centile=0.9,
+    start_plot_index=0,
+    draw_window=None,
+    hour_lines=[12, 17],
+    annotation_prefix="On average",
+    set_y_lim=None,
+    fan=None,
+    fan_bands=((5, 95), (10, 90), (25, 75)),
+    **styling,
+):
+    """
+    Interactive version of `demand.plots.plot_cumulative_demand`.
+
+    Returns:
+    altair.LayerChart: The chart
+    """
+    table = cumulative_demand_table(
+        cumulative_mean, cumulative_centiles, centiles, start_plot_index, fan, fan_bands
+    )
+    hours = list(table["hour"])
+    x = alt.X("hour:O", sort=hours, title="Hour of day")
+    y_scale = alt.Scale(domain=[0, set_y_lim]) if set_y_lim else alt.Scale()
+
+    names = {"mean_beds": "Average number of beds needed"}
+    highlighted = "mean_beds"
+    for centile in centiles or []:
+        column = f"beds_p{_percent(centile)}"
+        names[column] = f"{_percent(centile)}% probability"
+        if abs(min(centile, 0.9999) - min(highlight_centile, 0.9999)) < 0.0001:
+            highlighted = column
+    long = table[["hour", *names]].melt("hour", var_name="series", value_name="beds")
+    long["series"] = long["series"].map(names)
+    layers = []
+
+    if fan is not None:
+        for low, high in fan_bands:
+            band = table[["hour", f"beds_p{low}", f"beds_p{high}"]].assign(
+                band=f"{low}% to {high}% of days"
+            )
+            layers.append(
+                alt.Chart(band)
+                .mark_area(opacity=0.12, color="steelblue")
+                .encode(
+                    x=x,
+                    y=alt.Y(f"beds_p{low}:Q", scale=y_scale),
+                    y2=f"beds_p{high}:Q",
+                    tooltip=["band", "hour"],
+                )
+            )
+
+    layers.append(
+        alt.Chart(long)
+        .mark_line(point=True)
+        .encode(
+            x=x,
+            y=alt.Y("beds:Q", title="Cumulative number of beds needed", scale=y_scale),
+            color=alt.Color("series:N", title=None, legend=alt.Legend(orient="top")),
+            tooltip=["hour", "series", alt.Tooltip("beds:Q", format=".1f")],
+        )
+    )
+
+    # Beds needed by each annotated hour: on the highlighted line, or on the line
+    # through the decision-making window if one is drawn
+    positions = [(hour - start_plot_index) % 24 for hour in hour_lines]
+    beds = table[highlighted].to_numpy()[positions]
+    if draw_window:
+        start_of_window, end_of_window = draw_window
+        start = (start_of_window - start_plot_index) % 24
+        end = (end_of_window - start_plot_index) % 24
+        needed = window_requirements(
+            table[highlighted], start_plot_index, start_of_window, end_of_window
+        )
+        slope = needed["beds_per_hour"]
+        beds = needed["beds_by_start_of_window"] + slope * (np.array(positions) - start)
+        window = pd.DataFrame(
+            {
+                "hour": [hours[start], hours[end], hours[-1]],
+                "beds": [
+                    needed["beds_by_start_of_window"],
+                    needed["beds_by_end_of_window"],
+                    needed["beds_by_end_of_window"],
+                ],
+                "label": [
+                    "",
+                    f"{annotation_prefix}, {slope:.0f} beds need to be vacated each hour "
+                    f"between {start_of_window}:00 and {end_of_window}:00",
+                    "",
+                ],
+            }
+        )
+        window_line = alt.Chart(window).encode(x=x, y="beds:Q")
+        layers.append(window_line.mark_line(color="blue", strokeDash=[4, 4]))
+        layers.append(
+            window_line.mark_text(align="right", dx=-6, dy=16, color="blue").encode(
+                text="label:N"
+            )
+        )
+
+    marks = pd.DataFrame(
+        {
+            "hour": [hours[position] for position in positions],
+            "beds": beds,
+            "label": [
+                f"{annotation_prefix}, {int(value)} beds needed by {hour}:00"
+                for hour, value in zip(hour_lines, beds)
+            ],
+        }
+    )
+    rules = alt.Chart(marks).encode(x=x)
+    layers.append(
+        rules.mark_rule(strokeDash=[2, 2], color="gray").encode(
+            y=alt.datum(0), y2="beds:Q"
+        )
+    )
+    layers.append(
+        rules.mark_text(align="right", dx=-4, dy=-8).encode(y="beds:Q", text="label:N")
+    )
+    return alt.layer(*layers, title=_title(title)).properties(height=450)
+
+
+def aspirational_curve_chart(title, x1, y1, x2, y2, **styling):
+    """
+    Interactive version of `patientflow.viz.aspirational_curve_plot.plot_curve`.
+
+    Returns:
+    altair.LayerChart: The chart
+    """
+    table = aspirational_curve_table(x1, y1, x2, y2)
+    x = alt.X("hours_since_arrival:Q", title="Hours since admission")
+    curve = (
+        alt.Chart(table)
+        .mark_line()
+        .encode(
+            x=x,
+            y=alt.Y(
+                "probability_admitted:Q",
+                title="Probability of admission by this point",
+                axis=alt.Axis(format="%"),
+            ),
+            tooltip=[
+                alt.Tooltip("hours_since_arrival:Q", format=".1f"),
+                alt.Tooltip("probability_admitted:Q", format=".1%"),
+            ],
+        )
+    )
+    points = (
+        alt.Chart(
+            pd.DataFrame(
+                {"hours_since_arrival": [x1, x2], "probability_admitted": [y1, y2]}
+            )
+        )
+        .mark_point(color="red", filled=True, size=60)
+        .encode(x=x, y="probability_admitted:Q")
+    )
+    return alt.layer(curve, points, title=_title(title)).properties(height=400)
+
+
+def site_comparison_table(cumulative_by_site, start_plot_index=0):
+    """
+    Cumulative beds needed by hour at each site, in the order they are charted.
+
+    Parameters:
+    cumulative_by_site (dict): Site name to its running total of demand, already starting at `start_plot_index`
+    start_plot_index (int): Hour of day at which the running totals start
+
+    Returns:
+    pandas.DataFrame: One row per hour and one column per site
+    """
+    table = pd.DataFrame({"hour": _hours(start_plot_index)})
+    for site, cumulative in cumulative_by_site.items():
+        table[str(site)] = np.asarray(cumulative)
+    return table
+
+
+def site_comparison_chart(
+    cumulative_by_site,
+    title,
+    start_plot_index=0,
+    draw_window=None,
+    layout="overlay",
+    annotation_prefix="On average",
+    set_y_lim=None,
+    **styling,
+):
+    """
+    Interactive version of `demand.plots.plot_site_comparison`.
+
+    Returns:
+    altair.LayerChart or altair.FacetChart: The chart
+    """
+    table = site_comparison_table(cumulative_by_site, start_plot_index)
+    hours = list(table["hour"])
+    long = table.melt("hour", var_name="site", value_name="beds")
+    x = alt.X("hour:O", sort=hours, title="Hour of day")
+    y_scale = alt.Scale(domain=[0, set_y_lim]) if set_y_lim else alt.Scale()
+    color = alt.Color(
+        "site:N", title=None, sort=list(table.columns[1:]), legend=alt.Legend(orient="top")
+    )
+    layers = [
+        alt.Chart()
+        .mark_line(point=True)
+        .encode(
+            x=x,
+            y=alt.Y("beds:Q", title="Cumulative number of beds needed", scale=y_scale),
+            color=color,
+            tooltip=["site", "hour", alt.Tooltip("beds:Q", format=".1f")],
+        )
+    ]
+    if draw_window:
+        # Points at the start and end of the window, joined by a dashed line; the beds
+        # needed by the end of the window are written on each facet, and shown on hover
+        start_of_window, end_of_window = draw_window
+        window_hours = [hours[(hour - start_plot_index) % 24] for hour in draw_window]
+        long["label"] = np.where(
+            long["hour"] == window_hours[1], long["beds"].round().astype(int).astype(str), ""
+        )
+        window = (
+            alt.Chart()
+            .transform_filter(alt.FieldOneOfPredicate(field="hour", oneOf=window_hours))
+            .encode(x=x, y="beds:Q", color=color)
+        )
+        layers.append(window.mark_line(strokeDash=[4, 4], opacity=0.6))
+        layers.append(
+            window.mark_text(align="right", dx=-6, dy=-8).encode(
+                text="label:N" if layout == "facet" else alt.value(""),
+                tooltip=[
+                    "site",
+                    alt.Tooltip(
+                        "beds:Q",
+                        format=".0f",
+                        title=f"{annotation_prefix}, beds needed by {end_of_window}:00",
+                    ),
+                ],
+            )
+        )
+
+    if layout == "facet":
+        return (
+            alt.layer(*layers, data=long)
+            .properties(width=220, height=180)
+            .facet(facet=alt.Facet("site:N", title=None), columns=3, title=_title(title))
+        )
+    return alt.layer(*layers, data=long, title=_title(title)).properties(height=450)
+
+
+def window_heatmap_table(beds_per_hour, start_plot_index=0):
+    """
+    Beds to vacate each hour of every window in a heatmap, in the order of its axes.
+
+    Parameters:
+    beds_per_hour (numpy.ndarray): Array of shape (24, 24) by start and end hour, NaN for windows not considered
+    start_plot_index (int): Hour of day at which both axes start
+
+    Returns:
+    pandas.DataFrame: One row per window considered
+    """
+    order = (start_plot_index + np.arange(24)) % 24
+    values = np.asarray(beds_per_hour, dtype=float)[np.ix_(order, order)]
+    start, end = np.nonzero(~np.isnan(values))
+    return pd.DataFrame(
+        {
+            "start_of_window": [f"{hour:02d}:00" for hour in order[start]],
+            "end_of_window": [f"{hour:02d}:00" for hour in order[end]],
+            "hours": end - start,
+            "beds_per_hour": values[start, end],
+        }
+    )
+
+
+def window_heatmap_chart(
+    beds_per_hour,
+    title,
+    start_plot_index=0,
+    draw_window=None,
+    best_window=None,
+    **styling,
+):
+    """
+    Interactive version of `demand.plots.plot_window_heatmap`.
+
+    Returns:
+    altair.LayerChart: The chart
+    """
+    table = window_heatmap_table(beds_per_hour, start_plot_index)
+    hours = [f"{hour:02d}:00" for hour in (start_plot_index + np.arange(24)) % 24]
+    x = alt.X(
+        "end_of_window:O",
+        sort=hours,
+        scale=alt.Scale(domain=hours),
+        title="End of window: decision-makers are on wards until this hour",
+    )
+    y = alt.Y(
+        "start_of_window:O",
+        sort=hours[::-1],
+        scale=alt.Scale(domain=hours[::-1]),
+        title="Start of window: decision-makers are on wards from this hour",
+    )
+    layers = [
+        alt.Chart(table)
+        .mark_rect()
+        .encode(
+            x=x,
+            y=y,
+            color=alt.Color(
+                "beds_per_hour:Q",
+                scale=alt.Scale(scheme="viridis", reverse=True),
+                title="Beds to vacate each hour",
+            ),
+            tooltip=[
+                "start_of_window",
+                "end_of_window",
+                "hours",
+                alt.Tooltip("beds_per_hour:Q", format=".1f"),
+            ],
+        )
+    ]
+    # The window chosen in the sidebar is outlined and the best window is marked
+    for window, mark in [
+        (draw_window, {"shape": "square", "filled": False, "color": "red", "size": 250}),
+        (best_window, {"shape": "diamond", "filled": True, "color": "white", "size": 150}),
+    ]:
+        if window:
+            cell = pd.DataFrame(
+                {
+                    "start_of_window": [f"{window[0] % 24:02d}:00"],
+                    "end_of_window": [f"{window[1] % 24:02d}:00"],
+                }
+            )
+            layers.append(alt.Chart(cell).mark_point(**mark).encode(x=x, y=y))
+    return alt.layer(*layers, title=_title(title)).properties(height=500)
+
+
+# Interactive chart and table functions for each matplotlib chart function, by name
+INTERACTIVE_VERSIONS = {
+    "plot_arrival_rates": (arrival_rates_chart, arrival_rates_table),
+    "plot_cumulative_demand": (cumulative_demand_chart, cumulative_demand_table),
+    "plot_curve": (aspirational_curve_chart, aspirational_curve_table),
+    "plot_site_comparison": (site_comparison_chart, site_comparison_table),
+    "plot_window_heatmap": (window_heatmap_chart, window_heatmap_table),
+}
+
+
+@timed("interactive_chart")
+def interactive_chart(plot_function, *args, **kwargs):
+    """
+    Interactive version of a call to a matplotlib chart function.
+
+    Parameters:
+    plot_function (callable): One of the chart functions in INTERACTIVE_VERSIONS
+    *args, **kwargs: The arguments the matplotlib chart would be drawn with
+
+    Returns:
+    altair.Chart or altair.LayerChart: The chart
+    """
+    chart_function, _ = INTERACTIVE_VERSIONS[plot_function.__name__]
+    return chart_function(*args, **kwargs)
+
+
+def chart_table(plot_function, *args, **kwargs):
+    """
+    Values shown by a call to a matplotlib chart function, as a table.
+
+    Parameters:
+    plot_function (callable): One of the chart functions in INTERACTIVE_VERSIONS
+    *args, **kwargs: The arguments the chart would be drawn with
+
+    Returns:
+    pandas.DataFrame: The values
+    """
+    chart_function, table_function = INTERACTIVE_VERSIONS[plot_function.__name__]
+    arguments = inspect.signature(chart_function).bind(*args, **kwargs).arguments
+    wanted = inspect.signature(table_function).parameters
+    return table_function(
+        **{name: value for name, value in arguments.items() if name in wanted}
+    )
@@ -0,0 +1,172 @@
+"""
+Cold-start time of the app, against a budget.
+
+A new container has to start the Streamlit server and then run app.py for the
+first visitor. Each is measured in a fresh Python process, as on a container
+that has just been scaled up from zero:
+
+- server: from launching `streamlit run app.py` until the server answers its
+  health check
+- first render: from the first run of app.py until its landing page has been
+  drawn for one session (with Streamlit's AppTest, so no browser is needed)
+
+Their sum is the cold-start time. The second process also has to import
+Streamlit, which is reported but left out of the sum, since the server has
+already done it. Each is repeated and the median is reported. With --budget,
+the command exits with an error if the cold start takes longer, so it can be
+checked in CI or after building an image:
+
+    python -m demand.coldstart --repeat 5 --budget 4
+"""
+
+import argparse
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+_RENDER_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+app = AppTest.from_file(sys.argv[1], default_timeout=120).run()
+rendered = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - started,
+    "render_seconds": rendered - imported,
+    "errors": [str(e.value) for e in app.exception],
+}))
+"""
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_server_start(app=APP, timeout=60):
+    """
+    Seconds from launching the Streamlit server until it answers its health check.
+
+    Parameters:
+    app (str or path): Streamlit script
+    timeout (float): Seconds to wait before giving up
+
+    Returns:
+    float: Seconds to start
+    """
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            str(app),
+            "--server.headless=true",
+            f"--server.port={port}",
+            "--server.fileWatcherType=none",
+            "--browser.gatherUsageStats=false",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError("The Streamlit server stopped while starting.")
+            try:
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/_stcore/health", timeout=1
+                ):
+                    return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f"The Streamlit server did not start in {timeout} seconds.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def time_first_render(app=APP):
+    """
+    Seconds to import Streamlit and draw the landing page of the app, in a fresh process.
+
+    Parameters:
+    app (str or path): Streamlit script
+
+    Returns:
+    dict: import_seconds and render_seconds
+    """
+    probe = subprocess.run(
+        [sys.executable, "-c", _RENDER_PROBE, str(app)],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(app).parent,
+    )
+    result = json.loads(probe.stdout.strip().splitlines()[-1])
+    if result.pop("errors"):
+        raise RuntimeError(f"The app raised an error while rendering: {probe.stdout}")
+    return result
+
+
+def measure(app=APP, repeat=3):
+    """
+    Median cold-start times of the app over several fresh processes.
+
+    Parameters:
+    app (str or path): Streamlit script
+    repeat (int): Number of times to measure each part
+
+    Returns:
+    dict: Median seconds for server_seconds, import_seconds and render_seconds, the
+    cold-start time (server and render), and every run of each
+    """
+    runs = {"server_seconds": [], "import_seconds": [], "render_seconds": []}
+    for _ in range(repeat):
+        runs["server_seconds"].append(time_server_start(app))
+        for name, seconds in time_first_render(app).items():
+            runs[name].append(seconds)
+    results = {name: statistics.median(values) for name, values in runs.items()}
+    results["cold_start_seconds"] = results["server_seconds"] + results["render_seconds"]
+    results["runs"] = runs
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure how long the app takes to start and draw its first page."
+    )
+    parser.add_argument("--app", default=str(APP), help="Streamlit script")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--budget", type=float, help="Exit with an error if the cold start takes longer (seconds)"
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = measure(args.app, args.repeat)
+    print(f"Server start:      {results['server_seconds']:.2f} s")
+    print(f"First render:      {results['render_seconds']:.2f} s")
+    print(f"(Import Streamlit: {results['import_seconds']:.2f} s, already done by the server)")
+    print(f"Cold start:        {results['cold_start_seconds']:.2f} s")
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.budget is not None and results["cold_start_seconds"] > args.budget:
+        print(f"\nOver the budget of {args.budget:.2f} s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
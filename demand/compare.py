@@ -0,0 +1,222 @@
+"""
+Side-by-side comparison of un-delayed demand across sites.
+
+Sites are the categories of a filter column: a site column in one file, or the
+"Site" column added when several files are combined with `combine_sites`. Each
+site's counts are selected from the same `FilterIndex`, and its cumulative demand
+and consistency centiles are then computed in a pool of worker processes, one
+site per task. Workers receive only the small day x hour count matrix of their
+site. The pool is started once and reused, since the app calls this on every
+rerun, and the comparison is cached, so redrawing it with other chart options does
+not recompute it.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from demand.cache import make_key
+from demand.centiles import lookup
+from demand.engine import RESULT_CACHE, DemandEngine, window_requirements
+from demand.instrument import timed
+
+SITE_COLUMN = "Site"
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def site_name(file_name):
+    """Site name for a file, such as 'uclh' for 'uclh.csv'."""
+    return Path(file_name).stem
+
+
+def combine_sites(cubes, column=SITE_COLUMN):
+    """
+    Combine the counts of several files into one cube, with a column naming the site of each.
+
+    Only the filter columns found in every file are kept.
+
+    Parameters:
+    cubes (dict): Site name to the CountCube of its file
+    column (str): Name of the column holding the site names
+
+    Returns:
+    CountCube: The combined counts
+    """
+    cubes = list(cubes.items())
+    shared = [
+        col
+        for col in cubes[0][1].columns
+        if col != column and all(col in cube.categories for _, cube in cubes)
+    ]
+    combined = None
+    for site, cube in cubes:
+        cube = cube.keep_columns(shared).with_column(column, site)
+        combined = cube if combined is None else combined.merge(cube)
+    return combined
+
+
+def site_selections(index, column, sites=None, filters=None, date_range=None):
+    """
+    Counts by date and hour for each site, with the same filters applied to all.
+
+    Parameters:
+    index (FilterIndex): Aggregated arrivals
+    column (str): Filter column whose categories are the sites
+    sites (list, optional): Sites to include; defaults to every category of `column`
+    filters (dict, optional): Other filters, see `FilterIndex.select`
+    date_range (tuple, optional): (first, last) dates to include
+
+    Returns:
+    list of tuple: (site, (dates, counts, excluded)) for each site with any arrivals, see
+    `FilterIndex.selection`
+    """
+    if sites is None:
+        sites = index.categories[column].tolist()
+    selections = []
+    for site in sites:
+        site_filters = {**(filters or {}), column: [site]}
+        try:
+            selections.append((site, index.selection(site_filters, date_range)))
+        except ValueError:
+            continue  # No arrivals at this site after filtering
+    return selections
+
+
+def worker_pool(workers):
+    """
+    A pool of worker processes, started on first use and then shared.
+
+    Workers are started from a clean server process rather than forked from the
+    caller, which may be running other threads (such as the Streamlit server).
+
+    Parameters:
+    workers (int): Number of worker processes
+
+    Returns:
+    concurrent.futures.ProcessPoolExecutor: The pool
+    """
+    with _POOLS_LOCK:
+        if workers not in _POOLS:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                # Workers are forked from a server that has already imported the demand code
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _POOLS[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=context
+            )
+        return _POOLS[workers]
+
+
+def site_profile(task):
+    """
+    Cumulative demand and the beds needed around the decision-making window at one site.
+    Runs in a worker process.
+
+    Parameters:
+    task (dict): Site name, dates, counts and excluded days, and the targets to apply
+
+    Returns:
+    dict: Cumulative mean and centile demand, and a row for the summary table
+    """
+    engine = DemandEngine(
+        task["counts"], task["dates"], excluded=task["excluded"]
+    ).resample(60)
+    curve_params, start_hour = task["curve"], task["start_hour"]
+    start_of_window, end_of_window = task["window"]
+    cumulative_mean = engine.cumulative_demand(curve_params, start_hour)
+    table = engine.centile_table(
+        curve_params,
+        start_hour,
+        task["method"],
+        distribution=task["distribution"],
+    )
+    cumulative = lookup(table, [task["centile"]])[0]
+    return {
+        "site": task["site"],
+        "cumulative_mean": cumulative_mean,
+        "cumulative": cumulative,
+        "summary": {
+            "site": task["site"],
+            "num_days": engine.num_days,
+            "arrivals_per_day": engine.num_arrivals / engine.num_days,
+            "mean_beds_per_day": float(cumulative_mean[-1]),
+            "mean_beds_by_end_of_window": float(
+                cumulative_mean[(end_of_window - start_hour) % 24]
+            ),
+            **window_requirements(cumulative, start_hour, start_of_window, end_of_window),
+        },
+    }
+
+
+@timed("compare_sites")
+def compare_sites(
+    selections,
+    curve_params,
+    centile=0.9,
+    window=(8, 20),
+    start_hour=8,
+    method="hourly",
+    distribution="poisson",
+    workers=None,
+):
+    """
+    Cumulative demand at each site under the same targets and decision-making window.
+
+    Parameters:
+    selections (list of tuple): (site, (dates, counts, excluded)) for each site, see `site_selections`
+    curve_params (tuple): (x1, y1, x2, y2) defining the aspirational curve
+    centile (float): Consistency target between 0 and 1
+    window (tuple): (start hour, end hour) of the decision-making window
+    start_hour (int): Hour of day at which the running totals start
+    method (str): One of `demand.centiles.CENTILE_METHODS`
+    distribution (str): Count model for the centiles, see `DemandEngine.centile_table`
+    workers (int, optional): Number of worker processes; defaults to one per CPU
+
+    Returns:
+    tuple: (profiles, summary) - a dict of site to its cumulative mean and centile demand,
+    and a DataFrame with one row per site of the beds needed by the end of the window
+    """
+    tasks = [
+        {
+            "site": site,
+            "dates": dates,
+            "counts": counts,
+            "excluded": excluded,
+            "curve": tuple(curve_params),
+            "centile": centile,
+            "window": tuple(window),
+            "start_hour": start_hour,
+            "method": method,
+            "distribution": distribution,
+        }
+        for site, (dates, counts, excluded) in selections
+    ]
+    key = make_key("compare_sites", tasks)
+    cached = RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        results = [site_profile(task) for task in tasks]
+    else:
+        results = list(worker_pool(workers).map(site_profile, tasks))
+
+    profiles = {
+        result["site"]: {
+            "cumulative_mean": result["cumulative_mean"],
+            "cumulative": result["cumulative"],
+        }
+        for result in results
+    }
+    summary = pd.DataFrame([result["summary"] for result in results])
+    RESULT_CACHE[key] = (profiles, summary)
+    return profiles, summary
@@ -0,0 +1,96 @@
+"""
+Spreading arrivals over the following hours with the aspirational curve.
+
+The curve (x1, y1, x2, y2) is discretized once per parameter set and interval
+width into a kernel: the share of arrivals that need a bed 0, 1, 2, ... intervals
+after they arrive. Kernels are cached, so every chart and centile drawn with the
+same targets reuses the same array.
+
+Mean demand over an average day is the kernel applied round the clock, wrapping
+at midnight (`spread`). Demand on each observed day is the kernel applied to the
+whole timeline of consecutive days in one convolution, so arrivals late in the
+evening need beds early the next day (`daily_demand`). The first len(kernel) - 1
+intervals of the timeline are missing the demand of arrivals before the data
+starts, so they understate demand.
+"""
+
+import numpy as np
+from scipy.signal import oaconvolve
+
+from patientflow.calculate.admission_in_prediction_window import (
+    get_y_from_aspirational_curve,
+)
+
+from demand.cache import LRUCache
+
+# Kernels by curve, spreading time and interval width
+KERNEL_CACHE = LRUCache(maxsize=128, name="kernels")
+
+# Kernels longer than this are applied with FFTs; shorter ones directly, which is faster
+FFT_KERNEL_LENGTH = 100
+
+
+def aspirational_weights(x1, y1, x2, y2, max_hours_since_arrival=10, time_interval=60):
+    """
+    Probability that a patient leaves ED in each interval after arrival, read from the aspirational curve.
+
+    Parameters:
+    x1, y1, x2, y2 (float): Points the aspirational curve passes through
+    max_hours_since_arrival (int): Number of hours after arrival to spread demand over
+    time_interval (int): Width of each interval in minutes; must divide an hour
+
+    Returns:
+    numpy.ndarray: Read-only weight for each whole interval since arrival
+    """
+    key = (float(x1), float(y1), float(x2), float(y2), max_hours_since_arrival, time_interval)
+    kernel = KERNEL_CACHE.get(key)
+    if kernel is None:
+        if not (0 <= y1 <= 1 and 0 <= y2 <= 1):
+            raise ValueError("Y-coordinates must be between 0 and 1.")
+        if x1 >= x2:
+            raise ValueError("x1 must be less than x2.")
+        if 60 % time_interval != 0:
+            raise ValueError("Intervals must divide evenly into hours.")
+        per_hour = 60 // time_interval
+        hours_since_arrival = (
+            np.arange(max_hours_since_arrival * per_hour + 1) / per_hour
+        )
+        kernel = np.diff(
+            get_y_from_aspirational_curve(hours_since_arrival, x1, y1, x2, y2)
+        )
+        kernel.setflags(write=False)
+        KERNEL_CACHE[key] = kernel
+    return kernel
+
+
+def spread(rates, weights):
+    """
+    Mean demand in each interval when arrivals in interval i - e need weights[e] of a bed in
+    interval i, wrapping round midnight (last axis).
+    """
+    rates = np.asarray(rates, dtype=float)
+    demand = np.zeros_like(rates)
+    for elapsed, weight in enumerate(weights):
+        demand += weight * np.roll(rates, elapsed, axis=-1)
+    return demand
+
+
+def daily_demand(counts, weights):
+    """
+    Demand in each interval of each day, spreading each interval's arrivals over the following
+    intervals by `weights` and carrying demand over midnight into the next day.
+
+    Parameters:
+    counts (numpy.ndarray): Arrival counts of shape (days, intervals per day), for consecutive days
+    weights (numpy.ndarray): Share of arrivals needing a bed 0, 1, 2, ... intervals after arrival
+
+    Returns:
+    numpy.ndarray: Demand of the same shape as `counts`
+    """
+    timeline = counts.ravel().astype(float)
+    if len(weights) > FFT_KERNEL_LENGTH:
+        demand = oaconvolve(timeline, weights)
+    else:
+        demand = np.convolve(timeline, weights)
+    return demand[: len(timeline)].reshape(counts.shape)
+
@@ -0,0 +1,314 @@
+"""
+Aggregated counts of arrivals by day, interval of the day and category.
+
+A `CountCube` stores one row per distinct combination of (day, interval,
+category of each filter column) that occurs in the data, with the number of
+arrivals in that combination. Its size depends on the number of days and
+categories, not on the number of patients, so the raw rows can be discarded
+once they have been counted.
+"""
+
+import numpy as np
+import pandas as pd
+
+from demand.engine import MINUTES_IN_DAY, day_and_slot
+from demand.instrument import timed
+
+
+def _aggregate(day, slot, codes, count):
+    """Sum `count` over rows sharing the same day, slot and category codes."""
+    frame = pd.DataFrame({"day": day, "slot": slot, "count": count})
+    keys = ["day", "slot"]
+    for i in range(codes.shape[1]):
+        frame[f"c{i}"] = codes[:, i]
+        keys.append(f"c{i}")
+    grouped = frame.groupby(keys, sort=False)["count"].sum().reset_index()
+    return (
+        grouped["day"].to_numpy(np.int32),
+        grouped["slot"].to_numpy(np.int16),
+        grouped[keys[2:]].to_numpy(np.int32).reshape(len(grouped), codes.shape[1]),
+        grouped["count"].to_numpy(np.int64),
+    )
+
+
+def _recode(codes, mapping):
+    """Translate category codes through `mapping`, keeping -1 for missing values."""
+    if len(mapping) == 0:
+        return np.full(len(codes), -1, dtype=np.int32)
+    return np.where(codes >= 0, mapping[np.maximum(codes, 0)], -1).astype(np.int32)
+
+
+def _sorted_labels(labels):
+    try:
+        return sorted(labels)
+    except TypeError:
+        return list(labels)
+
+
+class CountCube:
+    """
+    Sparse count cube of arrivals by day, interval of the day and category.
+
+    Parameters:
+    day (numpy.ndarray): Day number (days since 1970-01-01) of each row
+    slot (numpy.ndarray): Interval of the day of each row
+    codes (numpy.ndarray): Category code of each row for each filter column, shape (rows, columns); -1 if missing
+    count (numpy.ndarray): Number of arrivals in each row
+    categories (dict): Category labels (pandas.Index) for each filter column, in column order
+    time_interval (int): Width of each interval in minutes
+    """
+
+    def __init__(self, day, slot, codes, count, categories, time_interval=60):
+        self.day = day
+        self.slot = slot
+        self.codes = codes
+        self.count = count
+        self.categories = categories
+        self.time_interval = time_interval
+
+    @classmethod
+    @timed("aggregate")
+    def from_frame(cls, df, time_interval=60):
+        """
+        Build a cube from a DataFrame with an `arrival_datetime` column; all other columns are treated as categorical.
+        """
+        columns = [col for col in df.columns if col != "arrival_datetime"]
+        builder = CubeBuilder(columns, time_interval=time_interval)
+        builder.add(df["arrival_datetime"], df)
+        return builder.build()
+
+    @property
+    def columns(self):
+        return list(self.categories)
+
+    @property
+    def num_slots(self):
+        return MINUTES_IN_DAY // self.time_interval
+
+    @property
+    def num_arrivals(self):
+        return int(self.count.sum())
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.day, self.slot, self.codes, self.count))
+
+    def merge(self, other):
+        """
+        Add the arrivals counted in another cube to those in this one.
+
+        Categories are combined, so the other cube may contain labels this one has not seen.
+        The cost depends on the number of rows of the two cubes, not the number of arrivals.
+
+        Parameters:
+        other (CountCube): Cube with the same filter columns and time interval
+
+        Returns:
+        CountCube: A new cube counting the arrivals of both
+        """
+        if other.columns != self.columns or other.time_interval != self.time_interval:
+            raise ValueError(
+                "Cubes can only be merged if they have the same filter columns "
+                "and time interval."
+            )
+        categories = {}
+        codes = np.empty((len(self.day) + len(other.day), len(self.columns)), np.int32)
+        for j, col in enumerate(self.columns):
+            labels = pd.Index(
+                _sorted_labels(set(self.categories[col]) | set(other.categories[col])),
+                dtype=object,
+            )
+            categories[col] = labels
+            codes[:, j] = np.concatenate(
+                [
+                    _recode(cube.codes[:, j], labels.get_indexer(cube.categories[col]))
+                    for cube in (self, other)
+                ]
+            )
+        day, slot, codes, count = _aggregate(
+            np.concatenate([self.day, other.day]),
+            np.concatenate([self.slot, other.slot]),
+            codes,
+            np.concatenate([self.count, other.count]),
+        )
+        return CountCube(day, slot, codes, count, categories, self.time_interval)
+
+    def keep_columns(self, columns):
+        """
+        Count by a subset of the filter columns only.
+
+        Parameters:
+        columns (list): Filter columns to keep, in the order to keep them
+
+        Returns:
+        CountCube: A new cube with the other columns summed over
+        """
+        positions = [self.columns.index(col) for col in columns]
+        day, slot, codes, count = _aggregate(
+            self.day, self.slot, self.codes[:, positions], self.count
+        )
+        categories = {col: self.categories[col] for col in columns}
+        return CountCube(day, slot, codes, count, categories, self.time_interval)
+
+    def with_column(self, column, label):
+        """
+        Add a filter column with the same category for every arrival, such as the site a file came from.
+
+        Parameters:
+        column (str): Name of the new column, which is placed first
+        label: Category of every arrival
+
+        Returns:
+        CountCube: A new cube with the extra column
+        """
+        codes = np.column_stack([np.zeros(len(self.day), np.int32), self.codes])
+        categories = {column: pd.Index([label], dtype=object), **self.categories}
+        return CountCube(
+            self.day, self.slot, codes, self.count, categories, self.time_interval
+        )
+
+    def since(self, first_day):
+        """
+        Keep only arrivals on or after a given day.
+
+        Parameters:
+        first_day (int or numpy.datetime64): First day to keep
+
+        Returns:
+        CountCube: A new cube without the earlier days
+        """
+        first_day = np.datetime64(first_day, "D").astype(np.int64)
+        keep = self.day >= first_day
+        return CountCube(
+            self.day[keep],
+            self.slot[keep],
+            self.codes[keep],
+            self.count[keep],
+            self.categories,
+            self.time_interval,
+        )
+
+    def mask(self, column, values):
+        """
+        Rows of the cube whose category in `column` is one of `values`.
+
+        Parameters:
+        column (str): Filter column
+        values (list): Category labels to keep
+
+        Returns:
+        numpy.ndarray: Boolean mask over the rows of the cube
+        """
+        j = self.columns.index(column)
+        selected = self.categories[column].get_indexer(list(values))
+        return np.isin(self.codes[:, j], selected[selected >= 0])
+
+    def matrix(self, row_mask=None):
+        """
+        Dense counts by date and interval, optionally for a subset of the cube's rows.
+
+        Parameters:
+        row_mask (numpy.ndarray, optional): Boolean mask over the rows of the cube
+
+        Returns:
+        tuple: (dates, counts) - every date from the first to the last selected arrival, and
+        an integer array of shape (len(dates), intervals per day)
+        """
+        day, slot, count = self.day, self.slot, self.count
+        if row_mask is not None:
+            day, slot, count = day[row_mask], slot[row_mask], count[row_mask]
+        if len(day) == 0:
+            raise ValueError("There are no arrivals in the selection.")
+        first_day = int(day.min())
+        num_dates = int(day.max()) - first_day + 1
+        counts = np.bincount(
+            (day.astype(np.int64) - first_day) * self.num_slots + slot,
+            weights=count,
+            minlength=num_dates * self.num_slots,
+        ).astype(np.int64)
+        dates = np.datetime64(first_day, "D") + np.arange(num_dates)
+        return dates, counts.reshape(num_dates, self.num_slots)
+
+
+class CubeBuilder:
+    """
+    Incrementally folds batches of arrivals into a CountCube.
+
+    Category codes are kept consistent across batches, and partial aggregates are
+    compacted whenever they grow beyond `compact_every` rows, so memory stays
+    bounded however many batches are added.
+
+    Parameters:
+    columns (list): Filter columns to count by
+    time_interval (int): Width of each interval in minutes
+    compact_every (int): Number of partial rows after which partial aggregates are merged
+    """
+
+    def __init__(self, columns=(), time_interval=60, compact_every=2_000_000):
+        self.columns = list(columns)
+        self.time_interval = time_interval
+        self.compact_every = compact_every
+        self._labels = {col: {} for col in self.columns}
+        self._parts = []
+        self._part_rows = 0
+
+    def _global_codes(self, column, values):
+        """Map a batch of raw values to codes that are stable across batches."""
+        categorical = pd.Categorical(values)
+        lookup = self._labels[column]
+        mapping = np.array(
+            [lookup.setdefault(label, len(lookup)) for label in categorical.categories],
+            dtype=np.int32,
+        )
+        return _recode(categorical.codes, mapping)
+
+    def add(self, arrival_datetimes, frame=None):
+        """
+        Count a batch of arrivals.
+
+        Parameters:
+        arrival_datetimes (pandas.Series): Parsed arrival datetimes; missing values are skipped
+        frame (pandas.DataFrame, optional): Rows aligned with `arrival_datetimes` holding the filter columns
+        """
+        valid = np.asarray(pd.notna(arrival_datetimes))
+        day, slot = day_and_slot(arrival_datetimes, self.time_interval)
+        codes = np.empty((len(day), len(self.columns)), dtype=np.int32)
+        for j, col in enumerate(self.columns):
+            codes[:, j] = self._global_codes(col, np.asarray(frame[col])[valid])
+        part = _aggregate(day, slot, codes, np.ones(len(day), dtype=np.int64))
+        self._parts.append(part)
+        self._part_rows += len(part[0])
+        if self._part_rows > self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        if len(self._parts) > 1:
+            self._parts = [_aggregate(*(np.concatenate(a) for a in zip(*self._parts)))]
+        self._part_rows = len(self._parts[0][0]) if self._parts else 0
+
+    def build(self):
+        """
+        Return the CountCube of everything added so far, with categories sorted by label.
+        """
+        self._compact()
+        if self._parts:
+            day, slot, codes, count = self._parts[0]
+        else:
+            day = np.empty(0, np.int32)
+            slot = np.empty(0, np.int16)
+            codes = np.empty((0, len(self.columns)), np.int32)
+            count = np.empty(0, np.int64)
+
+        categories = {}
+        codes = codes.copy()
+        for j, col in enumerate(self.columns):
+            labels = list(self._labels[col])
+            try:
+                order = sorted(range(len(labels)), key=lambda i: labels[i])
+            except TypeError:
+                order = list(range(len(labels)))
+            remap = np.empty(len(labels), dtype=np.int32)
+            remap[order] = np.arange(len(labels), dtype=np.int32)
+            codes[:, j] = _recode(codes[:, j], remap)
+            categories[col] = pd.Index([labels[i] for i in order], dtype=object)
+        return CountCube(day, slot, codes, count, categories, self.time_interval)
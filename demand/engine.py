@@ -0,0 +1,448 @@
+"""
+Array-backed computation of un-delayed demand.
+
+Arrivals are reduced once to a matrix of counts with one row per calendar day and
+one column per time interval. Everything the app plots (mean arrival rates, bed
+demand after applying the aspirational curve, cumulative demand and centiles) is
+derived from that matrix and memoized, so redrawing a chart after a widget change
+does not touch the raw arrivals again.
+
+Uploads are counted once at a fine resolution (BASE_INTERVAL minutes). Coarser
+intervals are derived from those counts by summing neighbouring columns (see
+`DemandEngine.resample`), so changing the resolution never re-reads the file.
+Hours of the day, such as the hour a chart starts at, are whole hours at any
+resolution.
+
+The aspirational curve is applied by `demand.convolution`: mean demand spreads the
+mean arrival rates round the clock, and the demand on each observed day spreads
+the whole timeline of counts at once, carrying demand over midnight.
+"""
+
+import numpy as np
+import pandas as pd
+
+from demand.cache import LRUCache, fingerprint, memoize_method
+from demand.centiles import (
+    analytic_table,
+    bootstrap_table,
+    empirical_table,
+    hourly_table,
+    observed_cumulative,
+    poisson_centiles,
+)
+from demand.convolution import aspirational_weights, daily_demand, spread
+from demand.models import best_model, fit_count_models
+
+MINUTES_IN_DAY = 24 * 60
+
+# Width in minutes of the intervals uploads are counted in; any interval that is a
+# multiple of this and divides an hour can be derived from the counts
+BASE_INTERVAL = 15
+
+# Derived results for all engines live here, keyed by data fingerprint
+RESULT_CACHE = LRUCache(maxsize=512, name="results")
+
+
+def day_and_slot(arrival_datetimes, time_interval=60):
+    """
+    Day number (days since 1970-01-01) and interval of the day for each arrival.
+
+    Parameters:
+    arrival_datetimes (array-like): Arrival datetimes; missing values are dropped
+    time_interval (int): Width of each interval in minutes
+
+    Returns:
+    tuple: (day, slot) - integer arrays with one entry per non-missing arrival
+    """
+    values = pd.DatetimeIndex(arrival_datetimes)
+    if values.tz is not None:
+        # Work in local wall-clock time, as the hour-of-day charts do
+        values = values.tz_localize(None)
+    values = values[~values.isna()]
+    minutes = values.values.astype("datetime64[m]").astype(np.int64)
+    day = minutes // MINUTES_IN_DAY
+    slot = (minutes % MINUTES_IN_DAY) // time_interval
+    return day, slot
+
+
+def count_matrix(arrival_datetimes, time_interval=60):
+    """
+    Count arrivals per calendar day and time interval.
+
+    Parameters:
+    arrival_datetimes (array-like): Arrival datetimes (DatetimeIndex, Series or array); missing values are ignored
+    time_interval (int): Width of each interval in minutes; must divide evenly into 24 hours
+
+    Returns:
+    tuple: (dates, counts) - a datetime64[D] array of every date from the first to the last arrival,
+    and an integer array of shape (len(dates), intervals per day)
+    """
+    if time_interval <= 0 or MINUTES_IN_DAY % time_interval != 0:
+        raise ValueError(
+            f"Time interval ({time_interval} minutes) must divide evenly into 24 hours."
+        )
+
+    day, slot = day_and_slot(arrival_datetimes, time_interval)
+    if len(day) == 0:
+        raise ValueError("There are no arrivals to count.")
+
+    first_day = day.min()
+    num_dates = int(day.max() - first_day + 1)
+    num_slots = MINUTES_IN_DAY // time_interval
+
+    counts = np.bincount(
+        (day - first_day) * num_slots + slot, minlength=num_dates * num_slots
+    ).reshape(num_dates, num_slots)
+    dates = np.datetime64(int(first_day), "D") + np.arange(num_dates)
+    return dates, counts
+
+
+def intervals_per_hour(num_intervals):
+    """Number of intervals in an hour, for a day divided into `num_intervals` intervals."""
+    if num_intervals % 24 != 0:
+        raise ValueError("Intervals must divide evenly into hours.")
+    return num_intervals // 24
+
+
+def rotate(values, start_hour):
+    """Reorder per-interval values so the day starts at the hour `start_hour` (last axis)."""
+    values = np.asarray(values)
+    return np.roll(values, -start_hour * intervals_per_hour(values.shape[-1]), axis=-1)
+
+
+def hour_labels(start_hour=0, num_intervals=24):
+    """
+    Axis labels for each interval of the day, starting at `start_hour`: '08-\\n09' for hours,
+    or the start time, such as '08:15', for shorter intervals.
+    """
+    if num_intervals == 24:
+        labels = [f"{hour:02d}-\n{(hour + 1) % 24:02d}" for hour in range(24)]
+    else:
+        minutes = np.arange(num_intervals) * (MINUTES_IN_DAY // num_intervals)
+        labels = [f"{m // 60:02d}:{m % 60:02d}" for m in minutes]
+    start = start_hour * intervals_per_hour(num_intervals)
+    return labels[start:] + labels[:start]
+
+
+def window_requirements(cumulative, start_hour, start_of_window, end_of_window):
+    """
+    Beds needed around a decision-making window, read from a cumulative demand curve.
+
+    All beds for arrivals over the whole day must be ready by the end of the window, and
+    the beds needed between the start and end of the window must be freed at a steady rate.
+    This matches the window drawn on the cumulative charts.
+
+    Parameters:
+    cumulative (numpy.ndarray): Cumulative demand over the day, starting at `start_hour`
+    start_hour (int): Hour of day at which `cumulative` starts
+    start_of_window (int): Hour at which decision-makers arrive
+    end_of_window (int): Hour at which decision-makers leave
+
+    Returns:
+    dict: beds_by_start_of_window, beds_by_end_of_window and beds_per_hour in the window
+    """
+    cumulative = np.asarray(cumulative)
+    per_hour = intervals_per_hour(len(cumulative))
+    # Each hour is read at its last interval, which at hourly resolution is the hour itself
+    start, end = (
+        ((hour - start_hour) % 24 + 1) * per_hour - 1
+        for hour in (start_of_window, end_of_window)
+    )
+    hours = (end - start) / per_hour
+    beds_by_start = float(cumulative[start])
+    beds_by_end = float(cumulative[-1])
+    return {
+        "beds_by_start_of_window": beds_by_start,
+        "beds_by_end_of_window": beds_by_end,
+        "beds_per_hour": (beds_by_end - beds_by_start) / hours if hours else np.nan,
+    }
+
+
+class DemandEngine:
+    """
+    Memoized demand calculations over a day x interval matrix of arrival counts.
+
+    Parameters:
+    counts (numpy.ndarray): Arrival counts of shape (days, intervals per day)
+    dates (numpy.ndarray): Date of each row of `counts`
+    time_interval (int, optional): Width of each interval in minutes; defaults to a day divided
+    by the number of columns of `counts`
+    num_days (int, optional): Number of days to average over; defaults to the number of days with any arrivals
+    excluded (numpy.ndarray, optional): Whether each day was left out of the selection, such as
+    weekends when only weekdays are selected; see `FilterIndex.selection`
+    """
+
+    def __init__(self, counts, dates, time_interval=None, num_days=None, excluded=None):
+        counts = np.asarray(counts)
+        if time_interval is None and counts.ndim == 2 and counts.shape[1]:
+            time_interval = MINUTES_IN_DAY // counts.shape[1]
+        if counts.ndim != 2 or counts.shape[1] * time_interval != MINUTES_IN_DAY:
+            raise ValueError(
+                "counts must have one column per time interval in the day."
+            )
+        self.counts = counts
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.time_interval = time_interval
+        if num_days is None:
+            num_days = int(np.count_nonzero(counts.sum(axis=1)))
+        if num_days == 0:
+            raise ValueError("There are no arrivals to calculate demand from.")
+        self.num_days = num_days
+        if excluded is None:
+            excluded = np.zeros(len(counts), dtype=bool)
+        self.excluded = np.asarray(excluded, dtype=bool)
+        self.fingerprint = fingerprint(
+            counts, self.dates, self.excluded, extra=(time_interval, num_days)
+        )
+
+    @classmethod
+    def from_datetimes(cls, arrival_datetimes, time_interval=60, num_days=None):
+        """Build an engine directly from a collection of arrival datetimes."""
+        dates, counts = count_matrix(arrival_datetimes, time_interval)
+        return cls(counts, dates, time_interval=time_interval, num_days=num_days)
+
+    @property
+    def num_arrivals(self):
+        return int(self.counts.sum())
+
+    @property
+    def start_date(self):
+        return pd.Timestamp(self.dates[0])
+
+    @property
+    def end_date(self):
+        return pd.Timestamp(self.dates[-1])
+
+    @property
+    def intervals_per_hour(self):
+        return intervals_per_hour(self.counts.shape[1])
+
+    def resolutions(self):
+        """Widths in minutes of the intervals this engine can be resampled to, finest first."""
+        return [
+            minutes
+            for minutes in range(self.time_interval, 61, self.time_interval)
+            if 60 % minutes == 0
+        ]
+
+    @memoize_method(RESULT_CACHE)
+    def resample(self, time_interval):
+        """
+        The same arrivals counted in wider intervals, each the sum of neighbouring intervals.
+
+        Parameters:
+        time_interval (int): Width of the new intervals in minutes; a multiple of this engine's
+        interval that divides an hour
+
+        Returns:
+        DemandEngine: An engine over the wider intervals, averaging over the same days
+        """
+        if time_interval == self.time_interval:
+            return self
+        if time_interval not in self.resolutions():
+            raise ValueError(
+                f"Arrivals counted every {self.time_interval} minutes cannot be "
+                f"grouped into {time_interval} minute intervals."
+            )
+        factor = time_interval // self.time_interval
+        counts = self.counts.reshape(len(self.counts), -1, factor).sum(axis=2)
+        return DemandEngine(
+            counts, self.dates, time_interval, self.num_days, self.excluded
+        )
+
+    @memoize_method(RESULT_CACHE)
+    def arrival_rates(self):
+        """Mean number of arrivals in each interval of the day."""
+        return self.counts.sum(axis=0) / self.num_days
+
+    @memoize_method(RESULT_CACHE)
+    def lagged_rates(self, lagged_by):
+        """
+        Mean number of beds needed in each interval if every patient is admitted exactly
+        `lagged_by` hours after arrival.
+
+        Parameters:
+        lagged_by (float): Hours from arrival to admission, a whole number of intervals
+
+        Returns:
+        numpy.ndarray: Mean beds needed for each interval of the day
+        """
+        return np.roll(
+            self.arrival_rates(), int(round(lagged_by * self.intervals_per_hour))
+        )
+
+    @memoize_method(RESULT_CACHE)
+    def bed_demand(self, curve_params, max_hours_since_arrival=10):
+        """
+        Mean number of beds needed in each interval if patients leave ED according to the aspirational curve.
+
+        Parameters:
+        curve_params (tuple): (x1, y1, x2, y2) defining the aspirational curve
+        max_hours_since_arrival (int): Number of hours after arrival to spread demand over
+
+        Returns:
+        numpy.ndarray: Mean beds needed for each interval of the day
+        """
+        return spread(
+            self.arrival_rates(), self.weights(curve_params, max_hours_since_arrival)
+        )
+
+    def weights(self, curve_params=None, max_hours_since_arrival=10):
+        """
+        Share of arrivals needing a bed in each interval after arrival, at this engine's interval.
+
+        Parameters:
+        curve_params (tuple, optional): (x1, y1, x2, y2); if omitted, arrivals need a bed on arrival
+        max_hours_since_arrival (int): Number of hours after arrival to spread demand over
+
+        Returns:
+        numpy.ndarray: Weight for each whole interval since arrival
+        """
+        if curve_params is None:
+            return np.ones(1)
+        return aspirational_weights(
+            *curve_params, max_hours_since_arrival, self.time_interval
+        )
+
+    @memoize_method(RESULT_CACHE)
+    def daily_demand(self, curve_params=None):
+        """
+        Beds needed in each interval of each day, with demand from arrivals late in the day
+        carried over midnight into the next.
+
+        Parameters:
+        curve_params (tuple, optional): (x1, y1, x2, y2); if omitted, arrivals are returned
+
+        Returns:
+        numpy.ndarray: Array of the same shape as `counts`
+        """
+        return daily_demand(self.counts, self.weights(curve_params))
+
+    @memoize_method(RESULT_CACHE)
+    def observed_cumulative(self, curve_params=None, start_hour=0):
+        """
+        Cumulative demand over each complete 24-hour period starting at `start_hour` on a day
+        with arrivals, from `daily_demand`; periods touching an excluded day are left out.
+
+        Returns:
+        numpy.ndarray: Array of shape (periods, intervals per day)
+        """
+        return observed_cumulative(
+            self.daily_demand(curve_params),
+            self.counts.sum(axis=1) > 0,
+            start_hour,
+            warmup=len(self.weights(curve_params)) - 1,
+            excluded=self.excluded,
+        )
+
+    def rates(self, curve_params=None):
+        """Arrival rates, or bed demand if `curve_params` are given."""
+        if curve_params is None:
+            return self.arrival_rates()
+        return self.bed_demand(tuple(curve_params))
+
+    @memoize_method(RESULT_CACHE)
+    def cumulative_demand(self, curve_params=None, start_hour=0):
+        """Running total of mean demand over the day, starting at `start_hour`."""
+        return np.cumsum(rotate(self.rates(curve_params), start_hour))
+
+    @memoize_method(RESULT_CACHE)
+    def centiles(self, centiles, curve_params=None):
+        """
+        Demand in each hour that is not exceeded on the given proportions of days (Poisson assumption).
+
+        Parameters:
+        centiles (list of float): Probabilities between 0 and 1
+        curve_params (tuple, optional): (x1, y1, x2, y2); if omitted, centiles of raw arrivals are returned
+
+        Returns:
+        numpy.ndarray: Array of shape (len(centiles), intervals per day)
+        """
+        return poisson_centiles(self.rates(curve_params), list(centiles))
+
+    @memoize_method(RESULT_CACHE)
+    def cumulative_centiles(self, centiles, curve_params=None, start_hour=0):
+        """Running totals of `centiles` over the day, starting at `start_hour`."""
+        return np.cumsum(
+            rotate(self.centiles(centiles, curve_params), start_hour), axis=-1
+        )
+
+    @memoize_method(RESULT_CACHE)
+    def count_models(self, stratify=True):
+        """
+        Poisson and negative binomial models fitted to the arrivals in each interval.
+
+        Parameters:
+        stratify (bool): Whether to also fit models with separate rates for each day of the week
+
+        Returns:
+        dict: Model name to CountModel (see `demand.models`)
+        """
+        return fit_count_models([(self.dates, self.counts)], stratify)[0]
+
+    def count_model(self, name="best"):
+        """The fitted model called `name`, or the one with the lowest AIC if `name` is "best"."""
+        models = self.count_models()
+        return best_model(models) if name == "best" else models[name]
+
+    @memoize_method(RESULT_CACHE)
+    def centile_table(
+        self,
+        curve_params=None,
+        start_hour=0,
+        method="hourly",
+        n_boot=200,
+        seed=0,
+        distribution="poisson",
+    ):
+        """
+        Cumulative demand over the day that is not exceeded on 1%, 2%, ... 100% of days.
+
+        The whole table is computed in one pass and cached, so changing the proportion of
+        days is a lookup (see `demand.centiles.lookup`).
+
+        Parameters:
+        curve_params (tuple, optional): (x1, y1, x2, y2); if omitted, centiles of raw arrivals are returned
+        start_hour (int): Hour of day at which the running totals start
+        method (str): One of `demand.centiles.CENTILE_METHODS`
+        n_boot (int): Number of bootstrap resamples, for the "bootstrap" method
+        seed (int): Random seed, for the "bootstrap" method
+        distribution (str): Count model for the "hourly" and "analytic" methods: "poisson" with a
+        single rate for all days, one of `demand.models.MODEL_NAMES`, or "best" for the best fit
+
+        Returns:
+        numpy.ndarray: Array of shape (100, intervals per day); row i is for (i + 1)% of days
+        """
+        if method == "bootstrap":
+            return bootstrap_table(
+                self.observed_cumulative(curve_params, start_hour), n_boot, seed
+            )
+        if method == "empirical":
+            return empirical_table(self.observed_cumulative(curve_params, start_hour))
+        if method not in ("hourly", "analytic"):
+            raise ValueError(f"Unknown centile method '{method}'.")
+        table = hourly_table if method == "hourly" else analytic_table
+        if distribution == "poisson":
+            return table(self.rates(curve_params), start_hour)
+        return self.model_table(self.count_model(distribution), curve_params, start_hour, method)
+
+    def model_table(self, model, curve_params=None, start_hour=0, method="hourly"):
+        """
+        Centile table of cumulative demand under a fitted count model.
+
+        Parameters:
+        model (CountModel): Model of arrivals per interval, such as one from `count_model`
+        curve_params (tuple, optional): (x1, y1, x2, y2); if omitted, centiles of raw arrivals are returned
+        start_hour (int): Hour of day at which the running totals start
+        method (str): "hourly" or "analytic"
+
+        Returns:
+        numpy.ndarray: Array of shape (100, intervals per day); row i is for (i + 1)% of days
+        """
+        table = hourly_table if method == "hourly" else analytic_table
+        return table(
+            spread(model.means, self.weights(curve_params)),
+            start_hour,
+            model.weights,
+            model.dispersion,
+        )
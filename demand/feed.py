@@ -0,0 +1,197 @@
+"""
+Incremental updates of a saved dataset from a rolling feed of extracts.
+
+A feed is an entry in the `CubeStore` that grows as new files arrive. Each new
+file (a daily drop, say) is read and counted on its own and then merged into
+the saved count cube, so a refresh costs time in proportion to the new rows
+rather than the whole history. Files already folded in are recognised by their
+contents and skipped, so a folder can be rescanned safely. With a rolling
+window, days older than the last N weeks are dropped after each update.
+
+Everything the app shows is derived from the cube's day x interval counts, so
+reopening the feed reflects the new days without reading any old files.
+
+Example:
+
+    python -m demand.feed ed-daily data-raw/drops --rolling-weeks 104 --watch
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from demand.engine import BASE_INTERVAL
+from demand.ingest import (
+    candidate_filter_columns,
+    combine_reports,
+    read_columns,
+    stream_arrivals,
+)
+from demand.store import CubeStore, content_key
+
+
+def feed_key(name):
+    """Store key for the feed called `name`."""
+    return "feed-" + re.sub(r"[^\w.-]+", "_", name).strip("_")
+
+
+def _signature(path):
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime]
+
+
+def feed_files(paths, pattern="*.csv"):
+    """
+    CSV files to fold into a feed, in name order.
+
+    Parameters:
+    paths (list of str or path): Files, or folders to search for files matching `pattern`
+    pattern (str): File name pattern for folders
+
+    Returns:
+    list of pathlib.Path: The files
+    """
+    files = []
+    for path in map(Path, paths):
+        files += sorted(path.glob(pattern)) if path.is_dir() else [path]
+    return files
+
+
+def update_feed(
+    name,
+    paths,
+    datetime_col="arrival_datetime",
+    rolling_weeks=None,
+    store=None,
+):
+    """
+    Fold any new files into a feed, creating it if necessary.
+
+    The filter columns are fixed when the feed is created, from the first file.
+
+    Parameters:
+    name (str): Name of the feed
+    paths (list of str or path): New files, or folders of files
+    datetime_col (str): Column containing arrival datetimes
+    rolling_weeks (int, optional): Keep only the last this many weeks, counting back from the latest day
+    store (CubeStore, optional): Store holding the feed; defaults to the app's store
+
+    Returns:
+    list of pathlib.Path: The files that were added
+    """
+    store = store or CubeStore()
+    key = feed_key(name)
+    if key in store:
+        cube, report, meta = store.load(key)
+        datetime_col = meta["datetime_col"]
+        filter_columns = meta["filter_columns"]
+        folded = meta["files"]
+        if rolling_weeks is None:
+            rolling_weeks = meta.get("rolling_weeks")
+        changed = rolling_weeks != meta.get("rolling_weeks")
+    else:
+        cube, report, folded, filter_columns = None, None, {}, None
+        changed = True
+
+    # Files seen before are recognised by name, size and modification time without
+    # reading them, and by their contents if those have changed
+    seen = {tuple(signature) for signature in folded.values()}
+    added, reports = [], []
+    for path in feed_files(paths):
+        if tuple(_signature(path)) in seen:
+            continue
+        file_key = content_key(path)
+        if file_key in folded:
+            folded[file_key] = _signature(path)
+            changed = True
+            continue
+        if filter_columns is None:
+            filter_columns = candidate_filter_columns(read_columns(path), datetime_col)
+        delta, delta_report = stream_arrivals(
+            path,
+            datetime_col,
+            filter_columns,
+            time_interval=BASE_INTERVAL if cube is None else cube.time_interval,
+        )
+        cube = delta if cube is None else cube.merge(delta)
+        reports.append(delta_report)
+        folded[file_key] = _signature(path)
+        added.append(path)
+        changed = True
+
+    if cube is None:
+        raise ValueError(f"No files were found for the feed '{name}'.")
+    # The saved report covers the files added in this update
+    if reports:
+        report = combine_reports(reports)
+    if not cube.num_arrivals:
+        raise ValueError(
+            f"No datetimes in '{datetime_col}' could be parsed for the feed '{name}'."
+        )
+    if rolling_weeks and len(cube.day):
+        last_day = np.datetime64(int(cube.day.max()), "D")
+        cube = cube.since(last_day - 7 * rolling_weeks + 1)
+    if changed:
+        store.save(
+            key,
+            cube,
+            f"{name} (feed)",
+            report,
+            datetime_col=datetime_col,
+            filter_columns=list(filter_columns),
+            files=folded,
+            rolling_weeks=rolling_weeks,
+        )
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Add new extracts of arrivals to a saved dataset that the app can reopen."
+    )
+    parser.add_argument("name", help="Name of the feed")
+    parser.add_argument("paths", nargs="+", help="New CSV files, or folders of CSV files")
+    parser.add_argument("--datetime-col", default="arrival_datetime")
+    parser.add_argument(
+        "--rolling-weeks",
+        type=int,
+        default=None,
+        help="Keep only the last this many weeks of arrivals",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep checking the folders for new files",
+    )
+    parser.add_argument("--poll-seconds", type=float, default=60)
+    args = parser.parse_args(argv)
+
+    while True:
+        # Until the first file arrives there is nothing to watch for but more files
+        if args.watch and not feed_files(args.paths):
+            time.sleep(args.poll_seconds)
+            continue
+        try:
+            added = update_feed(
+                args.name, args.paths, args.datetime_col, args.rolling_weeks
+            )
+        except (OSError, ValueError) as e:
+            if not args.watch:
+                print(e)
+                sys.exit(1)
+            # A file may still be being copied; it is read again on the next poll
+            print(f"{e} Trying again in {args.poll_seconds:g} seconds.")
+            added = []
+        for path in added:
+            print(f"Added {path} to {args.name}")
+        if not args.watch:
+            break
+        time.sleep(args.poll_seconds)
+
+
+if __name__ == "__main__":
+    main()
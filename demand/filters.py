@@ -0,0 +1,307 @@
+"""
+Fast filtering of aggregated arrivals by category and date.
+
+A `FilterIndex` is built once per upload. For every filter column it holds a
+dense array of arrival counts per category, day and interval, so filtering on a
+single column is a sum over the selected categories' precomputed counts.
+Combinations of columns are answered by narrowing the count cube one filter at a
+time, reusing the aggregate already narrowed by the earlier filters. Filters on
+derived attributes of the day (weekday or weekend, month, bank holiday) and on
+date ranges act on whole days of the resulting matrix.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from demand.cache import LRUCache
+from demand.instrument import timed
+
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MONTH_NAMES = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+]  # fmt: skip
+
+# One-off changes to the regular England and Wales bank holidays
+EXTRA_BANK_HOLIDAYS = [
+    date(1999, 12, 31),
+    date(2002, 6, 3),
+    date(2011, 4, 29),
+    date(2012, 6, 5),
+    date(2022, 6, 3),
+    date(2022, 9, 19),
+    date(2023, 5, 8),
+]
+MOVED_BANK_HOLIDAYS = {
+    date(1995, 5, 1): date(1995, 5, 8),
+    date(2002, 5, 27): date(2002, 6, 4),
+    date(2012, 5, 28): date(2012, 6, 4),
+    date(2020, 5, 4): date(2020, 5, 8),
+    date(2022, 5, 30): date(2022, 6, 2),
+}
+
+
+def _easter_sunday(year):
+    """Date of Easter Sunday (anonymous Gregorian algorithm)."""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    day = (h + l - 7 * m + 33 * month + 19) % 32
+    return date(year, month, day)
+
+
+def england_bank_holidays(years):
+    """
+    Bank holidays in England and Wales for the given years.
+
+    Parameters:
+    years (iterable of int): Years to list bank holidays for
+
+    Returns:
+    numpy.ndarray: datetime64[D] array of bank holiday dates
+    """
+    holidays = []
+    for year in years:
+        days = pd.date_range(date(year, 1, 1), date(year, 12, 31), freq="D")
+        mondays = days[days.weekday == 0]
+        new_year = pd.Timestamp(year, 1, 1)
+        if new_year.weekday() >= 5:
+            new_year += pd.Timedelta(days=7 - new_year.weekday())
+        easter = pd.Timestamp(_easter_sunday(year))
+        christmas, boxing_day = pd.Timestamp(year, 12, 25), pd.Timestamp(year, 12, 26)
+        if christmas.weekday() >= 5:
+            christmas = pd.Timestamp(year, 12, 27)
+        if boxing_day.weekday() >= 5:
+            boxing_day = pd.Timestamp(year, 12, 28)
+        regular = [
+            new_year,
+            easter - pd.Timedelta(days=2),
+            easter + pd.Timedelta(days=1),
+            mondays[mondays.month == 5][0],
+            mondays[mondays.month == 5][-1],
+            mondays[mondays.month == 8][-1],
+            christmas,
+            boxing_day,
+        ]
+        holidays += [MOVED_BANK_HOLIDAYS.get(day.date(), day.date()) for day in regular]
+        holidays += [day for day in EXTRA_BANK_HOLIDAYS if day.year == year]
+    return np.array(sorted(holidays), dtype="datetime64[D]")
+
+
+def day_attributes(dates, holidays=None):
+    """
+    Derived attributes of each date that can be used as filters.
+
+    Parameters:
+    dates (numpy.ndarray): datetime64[D] array of dates
+    holidays (array-like, optional): Bank holiday dates; defaults to those of England and Wales
+
+    Returns:
+    dict: Attribute name to a pandas.Categorical with one value per date
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    # 1970-01-01 was a Thursday
+    weekday = (dates.astype(np.int64) + 3) % 7
+    month = dates.astype("datetime64[M]").astype(np.int64) % 12
+    if holidays is None:
+        years = np.unique(dates.astype("datetime64[Y]").astype(np.int64) + 1970)
+        holidays = england_bank_holidays(years)
+    is_holiday = np.isin(dates, np.asarray(holidays, dtype="datetime64[D]"))
+    return {
+        "Day type": pd.Categorical.from_codes(
+            (weekday >= 5).astype(np.int8), ["Weekday", "Weekend"]
+        ),
+        "Day of week": pd.Categorical.from_codes(weekday, DAY_NAMES),
+        "Month": pd.Categorical.from_codes(month, MONTH_NAMES),
+        "Bank holiday": pd.Categorical.from_codes(
+            is_holiday.astype(np.int8), ["No", "Yes"]
+        ),
+    }
+
+
+def _trim(dates, counts, excluded):
+    """Drop leading and trailing days with no arrivals."""
+    busy = np.flatnonzero(counts.sum(axis=1))
+    if len(busy) == 0:
+        raise ValueError("There are no arrivals in the selection.")
+    keep = slice(busy[0], busy[-1] + 1)
+    return dates[keep], counts[keep], excluded[keep]
+
+
+class FilterIndex:
+    """
+    Per-category count matrices for each filter column of a CountCube.
+
+    Parameters:
+    cube (CountCube): The aggregated arrivals to index
+    holidays (array-like, optional): Bank holiday dates; defaults to those of England and Wales
+    """
+
+    @timed("index")
+    def __init__(self, cube, holidays=None):
+        self.cube = cube
+        if len(cube.day):
+            first_day = int(cube.day.min())
+            num_dates = int(cube.day.max()) - first_day + 1
+        else:
+            first_day, num_dates = 0, 0
+        self.dates = np.datetime64(first_day, "D") + np.arange(num_dates)
+        self._shape = (num_dates, cube.num_slots)
+
+        # Position of each cube row in a flattened day x interval matrix
+        cell = (cube.day.astype(np.int64) - first_day) * cube.num_slots + cube.slot
+        cells = num_dates * cube.num_slots
+        self._cell = cell
+        self.totals = self._bincount(cell, cube.count, cells).reshape(self._shape)
+
+        self.by_column = {}
+        for j, column in enumerate(cube.columns):
+            num_categories = len(cube.categories[column])
+            codes = cube.codes[:, j]
+            present = codes >= 0
+            self.by_column[column] = self._bincount(
+                codes[present] * cells + cell[present],
+                cube.count[present],
+                num_categories * cells,
+            ).reshape(num_categories, *self._shape)
+
+        # Attributes of each day (unless the data has a column of the same name),
+        # and all filterable categories
+        self.day_attributes = {
+            name: values
+            for name, values in day_attributes(self.dates, holidays).items()
+            if name not in cube.categories
+        }
+        self.categories = dict(cube.categories)
+        for name, values in self.day_attributes.items():
+            self.categories[name] = values.categories
+
+        # Cube rows narrowed by successive filters, keyed by the filters applied so far
+        self._narrowed = LRUCache(maxsize=64)
+
+    @staticmethod
+    def _bincount(index, weights, length):
+        return np.bincount(index, weights=weights, minlength=length).astype(np.int32)
+
+    @property
+    def columns(self):
+        """Filter columns from the data, followed by the derived day attributes."""
+        return list(self.categories)
+
+    @property
+    def nbytes(self):
+        return self.totals.nbytes + sum(a.nbytes for a in self.by_column.values())
+
+    def _narrow(self, filters):
+        """
+        Cube rows (cell, codes, count) that pass `filters`, a tuple of (column, codes) pairs.
+
+        The aggregate for all but the last filter is looked up (or built) first and
+        then narrowed by the last one, so adding a filter only scans rows that
+        passed the earlier ones.
+        """
+        if not filters:
+            return self._cell, self.cube.codes, self.cube.count
+        narrowed = self._narrowed.get(filters)
+        if narrowed is None:
+            cell, codes, count = self._narrow(filters[:-1])
+            column, selected = filters[-1]
+            keep = np.isin(codes[:, self.cube.columns.index(column)], selected)
+            narrowed = (cell[keep], codes[keep], count[keep])
+            self._narrowed[filters] = narrowed
+        return narrowed
+
+    def _codes(self, column, values):
+        codes = self.categories[column].get_indexer(list(values))
+        return np.unique(codes[codes >= 0])
+
+    def select(self, filters=None, date_range=None):
+        """
+        Counts by date and interval for the arrivals that pass every filter.
+
+        Parameters:
+        filters (dict, optional): Column (or derived day attribute) to the category labels to keep,
+        applied in order; columns with no values selected are ignored
+        date_range (tuple, optional): (first, last) dates to include
+
+        Returns:
+        tuple: (dates, counts) - dates from the first to the last selected arrival, and an
+        array of shape (len(dates), intervals per day)
+        """
+        dates, counts, _ = self.selection(filters, date_range)
+        return dates, counts
+
+    @timed("filter")
+    def selection(self, filters=None, date_range=None):
+        """
+        Counts by date and interval for the arrivals that pass every filter, and the days
+        the filters left out.
+
+        Days left out by a filter on days (such as weekdays only) stay in the timeline with no
+        arrivals, so they can be told apart from days that simply had none; see `DemandEngine`.
+        A ValueError is raised if a filter names an unknown column or no arrivals pass the filters.
+
+        Parameters:
+        filters (dict, optional): Column (or derived day attribute) to the category labels to keep,
+        applied in order; columns with no values selected are ignored
+        date_range (tuple, optional): (first, last) dates to include
+
+        Returns:
+        tuple: (dates, counts, excluded) - as for `select`, and whether each date was left out
+        """
+        unknown = set(filters or {}) - set(self.categories)
+        if unknown:
+            raise ValueError(f"Unknown filter columns: {', '.join(sorted(unknown))}.")
+        filters = {column: values for column, values in (filters or {}).items() if values}
+        row_filters = tuple(
+            (column, tuple(self._codes(column, values)))
+            for column, values in filters.items()
+            if column in self.by_column
+        )
+
+        if not row_filters:
+            counts = self.totals
+        elif len(row_filters) == 1:
+            column, codes = row_filters[0]
+            counts = self.by_column[column][list(codes)].sum(axis=0)
+        else:
+            cell, _, count = self._narrow(row_filters)
+            counts = self._bincount(cell, count, self.totals.size).reshape(self._shape)
+
+        keep_days = np.ones(len(self.dates), dtype=bool)
+        for column, values in filters.items():
+            if column in self.day_attributes:
+                keep_days &= np.isin(self.day_attributes[column], list(values))
+        if date_range is not None:
+            first, last = (np.datetime64(d, "D") for d in date_range)
+            keep_days &= (self.dates >= first) & (self.dates <= last)
+        if not keep_days.all():
+            counts = np.where(keep_days[:, None], counts, 0)
+        return _trim(self.dates, counts, ~keep_days)
+
+    def counts(self, column=None, values=None):
+        """
+        Counts by date and interval for arrivals whose `column` is one of `values`.
+
+        Parameters:
+        column (str, optional): Filter column; if omitted, all arrivals are counted
+        values (list, optional): Category labels to keep
+
+        Returns:
+        tuple: (dates, counts) - dates from the first to the last selected arrival, and an
+        array of shape (len(dates), intervals per day)
+        """
+        if column is None:
+            return self.select()
+        return self.select({column: values})
+
+    def category_totals(self, column):
+        """Total number of arrivals in each category of `column`."""
+        return self.by_column[column].sum(axis=(1, 2))
@@ -0,0 +1,314 @@
+"""
+Reading arrival datetimes from uploaded CSV files.
+
+The datetime format is inferred once from a small sample of the column and the
+whole column is then parsed in a single vectorized pass with that format. ISO
+timestamps are parsed by the CSV reader itself when pyarrow is available, and
+numeric columns are treated as Unix epoch times.
+
+Files can either be loaded whole (`load_arrivals`) or streamed in chunks
+straight into a count cube (`stream_arrivals`), for extracts too large to hold
+in memory.
+"""
+
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from demand.cube import CubeBuilder
+from demand.instrument import stage
+
+try:
+    import pyarrow  # noqa: F401
+
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+# Formats tried, in order of preference, against a sample of the column.
+# Day-first formats come before month-first ones, so ambiguous samples
+# (all days <= 12) are read as UK dates.
+DATETIME_FORMATS = [
+    "ISO8601",
+    "%d/%m/%Y %H:%M:%S",  # UK/European with seconds
+    "%d/%m/%Y %H:%M",  # UK/European: 01/03/2024 14:30
+    "%m/%d/%Y %H:%M:%S",  # US with seconds
+    "%m/%d/%Y %H:%M",  # US: 03/01/2024 14:30
+    "%d-%m-%Y %H:%M:%S",  # Dash separated UK/European
+    "%d-%m-%Y %H:%M",
+    "%d.%m.%Y %H:%M:%S",  # Dot separated European
+    "%d.%m.%Y %H:%M",
+    "%d/%m/%y %H:%M:%S",  # Two-digit year UK/European
+    "%d/%m/%y %H:%M",
+]
+
+# Magnitudes above which an epoch value is taken to be in ns, us or ms rather than seconds
+EPOCH_UNITS = [(1e17, "ns"), (1e14, "us"), (1e11, "ms"), (0, "s")]
+
+SAMPLE_SIZE = 1000
+MAX_FAILED_EXAMPLES = 5
+
+
+@dataclass
+class ParseReport:
+    """Summary of how a datetime column was parsed."""
+
+    rows: int
+    failed: int
+    method: str
+    seconds: float
+    failed_examples: list = field(default_factory=list)
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else float("inf")
+
+
+def combine_reports(reports):
+    """
+    One report for several files parsed separately.
+
+    Parameters:
+    reports (list of ParseReport): Report for each file; None for files that were not parsed
+
+    Returns:
+    ParseReport or None: Totals over the parsed files, or None if none were parsed
+    """
+    reports = [report for report in reports if report is not None]
+    if not reports:
+        return None
+    return ParseReport(
+        rows=sum(report.rows for report in reports),
+        failed=sum(report.failed for report in reports),
+        method=", ".join(dict.fromkeys(report.method for report in reports)),
+        seconds=sum(report.seconds for report in reports),
+        failed_examples=[
+            example for report in reports for example in report.failed_examples
+        ][:MAX_FAILED_EXAMPLES],
+    )
+
+
+def _sample(values, size=SAMPLE_SIZE):
+    """Evenly spaced non-null values from across the column, so a sample is not all one day."""
+    values = values.dropna()
+    if len(values) <= size:
+        return values
+    return values.iloc[np.linspace(0, len(values) - 1, size).astype(int)]
+
+
+def infer_datetime_format(values):
+    """
+    Choose how to parse a column of datetimes by trying candidate formats on a sample.
+
+    Parameters:
+    values (pandas.Series): Raw datetime values (strings or numbers)
+
+    Returns:
+    str: A strftime format, "ISO8601", "epoch[<unit>]" for numeric values, or "mixed" if
+    no single format fits the sample
+    """
+    sample = _sample(values)
+    if len(sample) == 0:
+        raise ValueError("The datetime column is empty.")
+
+    if pd.api.types.is_numeric_dtype(sample):
+        magnitude = np.abs(sample.astype(float)).median()
+        unit = next(unit for threshold, unit in EPOCH_UNITS if magnitude >= threshold)
+        return f"epoch[{unit}]"
+
+    sample = sample.astype(str).str.strip()
+    best_format, fewest_failures = "mixed", len(sample)
+    for date_format in DATETIME_FORMATS:
+        parsed = pd.to_datetime(sample, format=date_format, errors="coerce")
+        failures = int(parsed.isna().sum())
+        if failures == 0:
+            return date_format
+        if failures < fewest_failures:
+            best_format, fewest_failures = date_format, failures
+    # If most of the sample fits one format, use it and report the rest as failures
+    if fewest_failures <= len(sample) // 10:
+        return best_format
+    return "mixed"
+
+
+def parse_datetimes(values, method=None):
+    """
+    Parse a column of arrival datetimes in one pass.
+
+    Parameters:
+    values (pandas.Series): Raw datetime values; columns already of datetime type are returned unchanged
+    method (str, optional): Parsing method as returned by `infer_datetime_format`; inferred if omitted
+
+    Returns:
+    tuple: (parsed, report) - a datetime64 Series (NaT where parsing failed) and a ParseReport
+    """
+    started = time.perf_counter()
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed, method = values, "native"
+    else:
+        if method is None:
+            method = infer_datetime_format(values)
+        if method.startswith("epoch["):
+            parsed = pd.to_datetime(
+                pd.to_numeric(values, errors="coerce"), unit=method[6:-1], errors="coerce"
+            )
+        elif method == "mixed":
+            parsed = pd.to_datetime(
+                values, format="mixed", dayfirst=True, errors="coerce"
+            )
+        else:
+            parsed = pd.to_datetime(values, format=method, errors="coerce")
+
+    if getattr(parsed.dt, "tz", None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    failed_mask = parsed.isna() & values.notna()
+    failed = int(failed_mask.sum())
+    report = ParseReport(
+        rows=len(values),
+        failed=failed,
+        method=method,
+        seconds=time.perf_counter() - started,
+        failed_examples=(
+            values[failed_mask].head(MAX_FAILED_EXAMPLES).astype(str).tolist()
+            if failed
+            else []
+        ),
+    )
+    return parsed, report
+
+
+def read_columns(file, nrows=10000):
+    """
+    Read the first rows of a CSV file, to offer a choice of columns before the full read.
+
+    Parameters:
+    file (str, path or file-like): The CSV file; file-like objects are rewound afterwards
+    nrows (int): Number of rows to read
+
+    Returns:
+    pandas.DataFrame: The first `nrows` rows
+    """
+    head = pd.read_csv(file, nrows=nrows)
+    if hasattr(file, "seek"):
+        file.seek(0)
+    return head
+
+
+def candidate_filter_columns(head, datetime_col, max_categories=50):
+    """
+    Columns that are worth offering as filters: those with few distinct values in the first rows.
+
+    Parameters:
+    head (pandas.DataFrame): The first rows of the file
+    datetime_col (str): The arrival datetime column, which is excluded
+    max_categories (int): Maximum number of distinct values for a column to count as categorical
+
+    Returns:
+    list: Column names
+    """
+    return [
+        col
+        for col in head.columns
+        if col != datetime_col and head[col].nunique(dropna=True) <= max_categories
+    ]
+
+
+def load_arrivals(file, datetime_col, filter_columns=()):
+    """
+    Read only the arrival datetime column and the filter columns of a CSV file, and parse the datetimes.
+
+    Rows whose datetime cannot be parsed are dropped and reported.
+
+    Parameters:
+    file (str, path or file-like): The CSV file
+    datetime_col (str): Column containing arrival datetimes
+    filter_columns (list): Categorical columns to keep for filtering
+
+    Returns:
+    tuple: (df, report) - a DataFrame with an `arrival_datetime` column and the filter columns
+    (as categoricals), and the ParseReport for the datetime column
+    """
+    filter_columns = [
+        col for col in filter_columns if col not in (datetime_col, "arrival_datetime")
+    ]
+    with stage("read_csv"):
+        # Filter columns are read as text, as in `stream_arrivals`, so their categories are the
+        # same however a file is read, rather than the dates or numbers pyarrow infers
+        df = pd.read_csv(
+            file,
+            usecols=[datetime_col, *filter_columns],
+            dtype={col: str for col in filter_columns},
+            engine=CSV_ENGINE,
+        )
+        df = df.astype({col: "category" for col in filter_columns})
+    if hasattr(file, "seek"):
+        file.seek(0)
+
+    with stage("parse_datetimes"):
+        parsed, report = parse_datetimes(df[datetime_col])
+    df = df.drop(columns=[datetime_col])
+    df.insert(0, "arrival_datetime", parsed)
+    if report.failed:
+        df = df[df["arrival_datetime"].notna()]
+    return df, report
+
+
+def stream_arrivals(
+    file, datetime_col, filter_columns=(), time_interval=60, chunksize=500_000
+):
+    """
+    Read a CSV file in chunks and fold each chunk into a CountCube, without keeping the raw rows.
+
+    The datetime format is inferred from the first chunk and reused for the rest.
+    Peak memory depends on `chunksize` and on the number of days and categories,
+    not on the size of the file.
+
+    Parameters:
+    file (str, path or file-like): The CSV file
+    datetime_col (str): Column containing arrival datetimes
+    filter_columns (list): Categorical columns to count by
+    time_interval (int): Width of each interval in minutes
+    chunksize (int): Number of rows to read at a time
+
+    Returns:
+    tuple: (cube, report) - the CountCube and a ParseReport covering all chunks
+    """
+    filter_columns = [col for col in filter_columns if col != datetime_col]
+    builder = CubeBuilder(filter_columns, time_interval=time_interval)
+    report = ParseReport(rows=0, failed=0, method=None, seconds=0.0)
+
+    reader = pd.read_csv(
+        file,
+        usecols=[datetime_col, *filter_columns],
+        dtype={col: str for col in filter_columns},
+        chunksize=chunksize,
+    )
+    with reader:
+        while True:
+            with stage("read_csv"):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            with stage("parse_datetimes"):
+                parsed, chunk_report = parse_datetimes(
+                    chunk[datetime_col],
+                    None if report.method in (None, "native") else report.method,
+                )
+            with stage("aggregate"):
+                builder.add(parsed, chunk)
+            report.rows += chunk_report.rows
+            report.failed += chunk_report.failed
+            report.seconds += chunk_report.seconds
+            report.method = report.method or chunk_report.method
+            report.failed_examples.extend(
+                chunk_report.failed_examples[
+                    : MAX_FAILED_EXAMPLES - len(report.failed_examples)
+                ]
+            )
+    if hasattr(file, "seek"):
+        file.seek(0)
+    with stage("aggregate"):
+        cube = builder.build()
+    return cube, report
@@ -0,0 +1,338 @@
+"""
+Timing and memory instrumentation of the stages of the demand pipeline.
+
+Code marks a stage with `with stage("parse"):`. When instrumentation is on, each
+stage records its wall time, CPU time, peak allocated memory (if tracemalloc is
+tracing) and the hits and misses of the named caches (see `demand.cache.LRUCache`)
+while it ran. Totals are kept for the process and exposed in the Prometheus text
+format, each stage is logged as a line of JSON to the "demand.instrument" logger,
+and the stages of the current run (one rerun of the app, say) are kept per thread
+for display.
+
+Instrumentation is off unless DEMAND_INSTRUMENT is set ("1" for times, "memory" to
+also trace memory, which slows everything down) or it is turned on for the
+current thread with `enable`. When off, `stage` returns a shared no-op context, so
+marking a stage costs one function call. Set DEMAND_METRICS_PORT to serve the
+metrics over HTTP at /metrics.
+
+Times are per thread, but tracemalloc counts the allocations of the whole
+process, so the memory of a stage includes that of any other stage running at the
+same time in another session.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+_SETTING = os.environ.get("DEMAND_INSTRUMENT", "").strip().lower()
+ENABLED_BY_DEFAULT = _SETTING not in ("", "0", "false", "no", "off")
+if _SETTING == "memory":
+    tracemalloc.start()
+if ENABLED_BY_DEFAULT and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+# Caches created with a name, by name; filled in by `demand.cache.LRUCache`
+CACHES = {}
+
+_NULL = nullcontext()
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def enabled():
+    """Whether stages are recorded in the current thread."""
+    return getattr(_local, "enabled", ENABLED_BY_DEFAULT)
+
+
+def enable(on=True):
+    """
+    Turn instrumentation on or off for the current thread, overriding DEMAND_INSTRUMENT.
+
+    Parameters:
+    on (bool): Whether to record stages
+    """
+    _local.enabled = on
+
+
+def trace_memory(on=True):
+    """
+    Start or stop tracing memory allocations, for the whole process.
+
+    Parameters:
+    on (bool): Whether to trace allocations, which slows everything down
+    """
+    if on and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not on and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _cache_counts():
+    hits = misses = 0
+    for cache in list(CACHES.values()):
+        hits += cache.hits
+        misses += cache.misses
+    return hits, misses
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.inner_peak = 0
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            # tracemalloc has a single peak, which this stage resets, so the peak of
+            # the enclosing stage so far is handed back to it on exit
+            self.start_memory, self.outer_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        self.parent = getattr(_local, "current", None)
+        _local.current = self
+        self.hits, self.misses = _cache_counts()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        hits, misses = _cache_counts()
+        _local.current = self.parent
+        peak = None
+        if self.tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.inner_peak)
+            if self.parent is not None:
+                self.parent.inner_peak = max(self.parent.inner_peak, self.outer_peak, peak)
+            peak -= self.start_memory
+        record(
+            self.name,
+            wall,
+            cpu,
+            peak_bytes=peak,
+            cache_hits=hits - self.hits,
+            cache_misses=misses - self.misses,
+        )
+        return False
+
+
+def stage(name):
+    """
+    Context manager that records a stage of the pipeline, if instrumentation is on.
+
+    Parameters:
+    name (str): Stage name, such as "parse" or "render"
+
+    Returns:
+    context manager: Records the stage on exit, or does nothing if instrumentation is off
+    """
+    if not enabled():
+        return _NULL
+    return _Stage(name)
+
+
+def timed(name):
+    """
+    Decorator that records every call of a function as a stage.
+
+    Parameters:
+    name (str): Stage name
+
+    Returns:
+    callable: The decorator
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name, wall, cpu, peak_bytes=None, cache_hits=0, cache_misses=0):
+    """
+    Record one run of a stage: add it to the totals, the current run and the log.
+
+    Parameters:
+    name (str): Stage name
+    wall (float): Wall time in seconds
+    cpu (float): CPU time of the process in seconds
+    peak_bytes (int, optional): Peak memory allocated during the stage
+    cache_hits (int): Hits of the named caches during the stage
+    cache_misses (int): Misses of the named caches during the stage
+    """
+    entry = {
+        "stage": name,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_bytes": peak_bytes,
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+    }
+    with _totals_lock:
+        total = _totals.setdefault(
+            name,
+            {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_bytes": 0},
+        )
+        total["calls"] += 1
+        total["wall_seconds"] += wall
+        total["cpu_seconds"] += cpu
+        total["peak_bytes"] = max(total["peak_bytes"], peak_bytes or 0)
+    run = getattr(_local, "run", None)
+    if run is not None:
+        run.append(entry)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(entry))
+
+
+def start_run():
+    """Start collecting the stages recorded in the current thread, such as one rerun of the app."""
+    _local.run = []
+
+
+def run_stages():
+    """
+    Stages recorded in the current thread since `start_run`, in the order they finished.
+
+    Returns:
+    list of dict: Stage name, wall and CPU seconds, peak bytes and cache hits and misses of each
+    """
+    return list(getattr(_local, "run", None) or [])
+
+
+def totals():
+    """
+    Totals of every stage recorded in the process.
+
+    Returns:
+    dict: Stage name to its number of calls, total wall and CPU seconds and largest peak in bytes
+    """
+    with _totals_lock:
+        return {name: dict(total) for name, total in _totals.items()}
+
+
+def cache_stats():
+    """
+    Hits, misses and size of each named cache.
+
+    Returns:
+    dict: Cache name to its hits, misses and number of entries
+    """
+    return {
+        name: {"hits": cache.hits, "misses": cache.misses, "entries": len(cache)}
+        for name, cache in list(CACHES.items())
+    }
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def prometheus_text():
+    """
+    Stage totals and cache statistics in the Prometheus text exposition format.
+
+    Returns:
+    str: The metrics
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{{{labels}}} {value}" for labels, value in samples)
+
+    stages = totals()
+    metric(
+        "demand_stage_calls_total",
+        "counter",
+        "Number of times each stage has run.",
+        [(_labels(stage=name), total["calls"]) for name, total in stages.items()],
+    )
+    metric(
+        "demand_stage_seconds_total",
+        "counter",
+        "Wall time spent in each stage.",
+        [(_labels(stage=name), total["wall_seconds"]) for name, total in stages.items()],
+    )
+    metric(
+        "demand_stage_cpu_seconds_total",
+        "counter",
+        "CPU time of the process while each stage ran.",
+        [(_labels(stage=name), total["cpu_seconds"]) for name, total in stages.items()],
+    )
+    metric(
+        "demand_stage_peak_bytes",
+        "gauge",
+        "Largest peak of memory allocated during each stage, while memory is traced.",
+        [(_labels(stage=name), total["peak_bytes"]) for name, total in stages.items()],
+    )
+    caches = cache_stats()
+    for field, kind, help_text in [
+        ("hits", "counter", "Lookups found in each cache."),
+        ("misses", "counter", "Lookups not found in each cache."),
+        ("entries", "gauge", "Number of entries in each cache."),
+    ]:
+        suffix = "_total" if kind == "counter" else ""
+        metric(
+            f"demand_cache_{field}{suffix}",
+            kind,
+            help_text,
+            [(_labels(cache=name), stats[field]) for name, stats in caches.items()],
+        )
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Scrapes are frequent; do not log each one
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def serve_metrics(port=None, host="0.0.0.0"):
+    """
+    Serve the metrics at /metrics from a background thread, once per process.
+
+    Parameters:
+    port (int, optional): Port to listen on; defaults to $DEMAND_METRICS_PORT, and nothing
+    is served if neither is set
+    host (str): Address to listen on
+
+    Returns:
+    http.server.ThreadingHTTPServer or None: The server, if one is running
+    """
+    global _server
+    port = port or os.environ.get("DEMAND_METRICS_PORT")
+    with _server_lock:
+        if _server is None and port:
+            _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
@@ -0,0 +1,208 @@
+"""
+Count models for the number of arrivals in each interval of the day.
+
+`notebooks/Check_distributions.ipynb` compares the variance of daily arrivals
+with their mean one segment at a time. Here Poisson and negative binomial
+models, optionally with separate rates for each day of the week, are fitted to
+every interval's series of daily counts for any number of segments at once, and
+the model with the lowest AIC is chosen for each segment.
+
+Negative binomial models are fitted by the method of moments. The extra
+variation is treated as a day-level effect shared by all intervals
+(arrivals are Poisson given a gamma-distributed busyness of the day), so each
+segment has a single dispersion, which is what the AIC is scored with, and it
+carries through the aspirational curve and running totals unchanged: demand
+with mean m is negative binomial with the segment's dispersion and mean m.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+MODEL_NAMES = {
+    "poisson": "Poisson",
+    "negbin": "Negative binomial",
+    "poisson_dow": "Poisson by day of week",
+    "negbin_dow": "Negative binomial by day of week",
+}
+
+
+@dataclass
+class CountModel:
+    """
+    A fitted model of arrivals per interval for one segment.
+
+    Parameters:
+    name (str): One of MODEL_NAMES
+    means (numpy.ndarray): Mean arrivals per interval in each stratum, shape (strata, intervals per day)
+    weights (numpy.ndarray): Share of days in each stratum
+    dispersion (float): Shape of the day-level gamma variation; infinite for Poisson
+    loglik (float): Log-likelihood of the observed counts
+    num_params (int): Number of fitted parameters
+    """
+
+    name: str
+    means: np.ndarray
+    weights: np.ndarray
+    dispersion: float
+    loglik: float
+    num_params: int
+
+    @property
+    def aic(self):
+        return 2 * self.num_params - 2 * self.loglik
+
+
+def _group_moments(rows, key, num_groups):
+    """Number of rows, mean and sample variance of each column for each group of rows."""
+    order = np.argsort(key, kind="stable")
+    rows, key = rows[order].astype(float), key[order]
+    n = np.bincount(key, minlength=num_groups)
+    sums = np.zeros((num_groups, rows.shape[1]))
+    squares = np.zeros_like(sums)
+    present = n > 0
+    starts = np.r_[0, np.cumsum(n)[:-1]][present]
+    sums[present] = np.add.reduceat(rows, starts, axis=0)
+    squares[present] = np.add.reduceat(rows**2, starts, axis=0)
+    safe_n = np.maximum(n, 1)[:, None]
+    means = sums / safe_n
+    variances = (squares - sums * means) / np.maximum(n - 1, 1)[:, None]
+    return n, means, variances
+
+
+def _fit(rows, segment, stratum, num_segments, num_strata, negbin):
+    """Log-likelihood, parameter count, means and dispersion of one model for every segment."""
+    key = segment * num_strata + stratum
+    num_groups = num_segments * num_strata
+    n, means, variances = _group_moments(rows, key, num_groups)
+    seg_of_group = np.arange(num_groups) // num_strata
+
+    # Day-level dispersion pooled over intervals and strata: var = m + m^2 / k
+    if negbin:
+        excess = np.bincount(
+            seg_of_group,
+            weights=(n[:, None] * (variances - means)).sum(axis=1),
+            minlength=num_segments,
+        )
+        scale = np.bincount(
+            seg_of_group,
+            weights=(n[:, None] * means**2).sum(axis=1),
+            minlength=num_segments,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dispersion = np.where(excess > 0, scale / excess, np.inf)
+    else:
+        dispersion = np.full(num_segments, np.inf)
+
+    # Scored with the dispersion that is applied to demand, so the AIC compares the model
+    # actually used; segments that are not overdispersed stay Poisson
+    mu = means[key]
+    logpmf = stats.poisson.logpmf(rows, mu)
+    r = dispersion[segment]
+    finite = np.isfinite(r)
+    if finite.any():
+        k = r[finite, None]
+        logpmf[finite] = stats.nbinom.logpmf(rows[finite], k, k / (k + mu[finite]))
+
+    loglik = np.bincount(segment, weights=logpmf.sum(axis=1), minlength=num_segments)
+    groups_used = np.bincount(seg_of_group, weights=n > 0, minlength=num_segments)
+    # One mean per interval in each stratum, and the segment's dispersion
+    num_params = groups_used * rows.shape[1] + (1 if negbin else 0)
+
+    return (
+        loglik,
+        num_params,
+        n.reshape(num_segments, num_strata),
+        means.reshape(num_segments, num_strata, -1),
+        dispersion,
+    )
+
+
+def fit_count_models(matrices, stratify=True):
+    """
+    Fit Poisson and negative binomial models to the arrivals in each interval, for every segment at once.
+
+    Parameters:
+    matrices (list of tuple): (dates, counts) for each segment, as returned by `FilterIndex.select`;
+    only days with arrivals are used
+    stratify (bool): Whether to also fit models with separate rates for each day of the week
+
+    Returns:
+    list of dict: For each segment, model name to CountModel
+    """
+    if not matrices:
+        return []
+    rows, segment, weekday = [], [], []
+    for i, (dates, counts) in enumerate(matrices):
+        observed = np.asarray(counts).sum(axis=1) > 0
+        rows.append(np.asarray(counts)[observed])
+        segment.append(np.full(observed.sum(), i))
+        # 1970-01-01 was a Thursday
+        days = np.asarray(dates, dtype="datetime64[D]")[observed].astype(np.int64)
+        weekday.append((days + 3) % 7)
+    rows = np.concatenate(rows)
+    segment = np.concatenate(segment)
+    weekday = np.concatenate(weekday)
+    num_segments = len(matrices)
+
+    variants = [("poisson", False, False), ("negbin", True, False)]
+    if stratify:
+        variants += [("poisson_dow", False, True), ("negbin_dow", True, True)]
+
+    fits = [{} for _ in range(num_segments)]
+    for name, negbin, by_weekday in variants:
+        num_strata = 7 if by_weekday else 1
+        stratum = weekday if by_weekday else np.zeros_like(segment)
+        loglik, num_params, n, means, dispersion = _fit(
+            rows, segment, stratum, num_segments, num_strata, negbin
+        )
+        for i in range(num_segments):
+            present = n[i] > 0
+            fits[i][name] = CountModel(
+                name=name,
+                means=means[i][present],
+                weights=n[i][present] / n[i].sum(),
+                dispersion=float(dispersion[i]),
+                loglik=float(loglik[i]),
+                num_params=int(num_params[i]),
+            )
+    return fits
+
+
+def best_model(models):
+    """The model with the lowest AIC."""
+    return min(models.values(), key=lambda model: model.aic)
+
+
+def summarise_models(fits, names=None):
+    """
+    One row per segment and model, with fit statistics and the chosen model flagged.
+
+    Parameters:
+    fits (list of dict): As returned by `fit_count_models`
+    names (list of str, optional): Segment names
+
+    Returns:
+    pandas.DataFrame: Summary table
+    """
+    names = names or list(range(len(fits)))
+    rows = []
+    for name, models in zip(names, fits):
+        chosen = best_model(models).name
+        daily_mean = float(models["poisson"].means.sum())
+        for model in models.values():
+            rows.append(
+                {
+                    "segment": name,
+                    "model": model.name,
+                    "loglik": model.loglik,
+                    "num_params": model.num_params,
+                    "aic": model.aic,
+                    "dispersion": model.dispersion,
+                    "daily_mean": daily_mean,
+                    "chosen": model.name == chosen,
+                }
+            )
+    return pd.DataFrame(rows)
@@ -0,0 +1,485 @@
+"""
+Charts drawn from precomputed demand arrays.
+
+These mirror the layout of `patientflow.viz.arrival_rates`, but take the hourly
+values computed by `demand.engine.DemandEngine` rather than a DataFrame of
+arrivals, so drawing a chart never triggers a recalculation.
+"""
+
+import io
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from patientflow.viz.arrival_rates import (
+    annotate_hour_line,
+    draw_window_visualization,
+    get_window_parameters,
+)
+
+from demand.cache import LRUCache, make_key
+from demand.engine import hour_labels, rotate
+from demand.instrument import timed
+
+# Rendered PNG images, keyed by plot function and every input to it
+FIGURE_CACHE = LRUCache(maxsize=64, name="figures")
+
+
+@timed("render")
+def render_png(plot_function, *args, dpi=200, **kwargs):
+    """
+    Draw a chart and return it as PNG bytes, reusing the image if the same function has
+    already been called with the same inputs.
+
+    The figure is closed as soon as it has been rasterized, so no figures are kept open.
+
+    Parameters:
+    plot_function (callable): Function returning a matplotlib Figure
+    *args: Positional arguments for `plot_function`
+    dpi (int): Resolution of the image
+    **kwargs: Keyword arguments for `plot_function`
+
+    Returns:
+    bytes: The PNG image
+    """
+    key = make_key(
+        plot_function.__module__, plot_function.__qualname__, args, kwargs, dpi
+    )
+    png = FIGURE_CACHE.get(key)
+    if png is None:
+        fig = plot_function(*args, **kwargs)
+        try:
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+            png = buffer.getvalue()
+        finally:
+            plt.close(fig)
+        FIGURE_CACHE[key] = png
+    return png
+
+
+def plot_arrival_rates(
+    arrival_rates,
+    title,
+    bed_demand=None,
+    curve_params=None,
+    start_plot_index=0,
+    x_margin=0.5,
+    figsize=(10, 6),
+    ylabel="Arrival Rate (patients per hour)",
+    lagged_rates=None,
+    lagged_by=None,
+):
+    """
+    Plot arrival rates in each interval of the day, optionally with the bed demand after applying
+    the aspirational curve.
+
+    Parameters:
+    arrival_rates (numpy.ndarray): Mean arrivals for each interval, starting at midnight
+    title (str): Chart title
+    bed_demand (numpy.ndarray, optional): Mean beds needed for each interval, starting at midnight
+    curve_params (tuple, optional): (x1, y1, x2, y2) used to label the bed demand line
+    start_plot_index (int): Hour of day at which to start the x-axis
+    x_margin (float): Margin on the x-axis
+    figsize (tuple): Figure size
+    ylabel (str): Label for the y-axis
+    lagged_rates (numpy.ndarray, optional): Mean beds needed for each interval if every patient is
+    admitted exactly `lagged_by` hours after arrival, starting at midnight
+    lagged_by (float, optional): Hours used to label the lagged line
+
+    Returns:
+    matplotlib.figure.Figure: The figure
+    """
+    labels = hour_labels(start_plot_index, len(arrival_rates))
+    hour_values = list(range(len(labels)))
+    per_hour = len(labels) // 24
+    has_demand = bed_demand is not None
+    has_lag = lagged_rates is not None
+
+    fig = plt.figure(figsize=figsize)
+    plt.plot(
+        hour_values,
+        rotate(arrival_rates, start_plot_index),
+        marker="x",
+        color="C0",
+        markersize=4,
+        linestyle=":" if has_demand or has_lag else "-",
+        linewidth=1 if has_demand or has_lag else None,
+        label="Arrival rates of admitted patients",
+    )
+    max_y = max(arrival_rates)
+
+    if has_lag:
+        plt.plot(
+            hour_values,
+            rotate(lagged_rates, start_plot_index),
+            marker="o",
+            markersize=4,
+            color="C0",
+            linestyle="--",
+            linewidth=1,
+            label=f"Average number of beds needed assuming admission\nexactly {lagged_by:g} hours after arrival",
+        )
+        max_y = max(max_y, max(lagged_rates))
+
+    if has_demand:
+        x1, y1, _, _ = curve_params
+        plt.plot(
+            hour_values,
+            rotate(bed_demand, start_plot_index),
+            marker="o",
+            markersize=None if per_hour == 1 else 3,
+            color="C0",
+            label=f"Average number of beds applying ED targets of {int(y1*100)}% in {int(x1)} hours",
+        )
+        max_y = max(max_y, max(bed_demand))
+
+    if has_demand or has_lag:
+        plt.legend()
+
+    # Shorter intervals are labelled every other hour, so the labels do not overlap
+    step = 1 if per_hour == 1 else 2 * per_hour
+    plt.xticks(hour_values[::step], labels[::step])
+    plt.ylim(0, max_y + 0.25)
+    plt.xlim(hour_values[0] - x_margin, hour_values[-1] + x_margin)
+    plt.xlabel("Hour of day" if per_hour == 1 else "Time of day")
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.grid(True, alpha=0.3)
+    plt.tight_layout()
+    return fig
+
+
+def _centile_label(centile):
+    if centile >= 0.999:
+        return f"{centile*100:.2f}% probability"
+    return f"{centile*100:.0f}% probability"
+
+
+def plot_cumulative_demand(
+    cumulative_mean,
+    title,
+    cumulative_centiles=None,
+    centiles=None,
+    highlight_centile=0.9,
+    start_plot_index=0,
+    draw_window=None,
+    hour_lines=[12, 17],
+    line_styles={12: "--", 17: ":", 20: "--"},
+    annotation_prefix="On average",
+    line_colour="red",
+    markers=["D", "s", "^", "o", "v"],
+    line_styles_centiles=["-.", "--", ":", "-", "-"],
+    set_y_lim=None,
+    x_margin=0.5,
+    text_y_offset=1,
+    figsize=(10, 6),
+    fan=None,
+    fan_bands=((5, 95), (10, 90), (25, 75)),
+):
+    """
+    Plot the cumulative number of beds needed over the day.
+
+    Parameters:
+    cumulative_mean (numpy.ndarray): Running total of mean demand, already starting at `start_plot_index`
+    title (str): Chart title
+    cumulative_centiles (numpy.ndarray, optional): Running totals for each centile, shape (len(centiles), 24)
+    centiles (list of float, optional): The centiles in `cumulative_centiles`
+    highlight_centile (float): Centile to emphasise and annotate
+    start_plot_index (int): Hour of day at which the x-axis starts
+    draw_window (tuple, optional): (start, end) hours of the decision-making window to draw
+    hour_lines (list of int): Hours at which to annotate the number of beds needed
+    line_styles (dict): Line style for each annotated hour
+    annotation_prefix (str): Prefix for annotations
+    line_colour (str): Colour of the mean line
+    markers (list of str): Markers for centile lines
+    line_styles_centiles (list of str): Line styles for centile lines
+    set_y_lim (float, optional): Upper limit for the y-axis
+    x_margin (float): Margin on the x-axis
+    text_y_offset (float): Vertical offset for annotation text
+    figsize (tuple): Figure size
+    fan (numpy.ndarray, optional): Centile table of shape (100, 24) (see `DemandEngine.centile_table`),
+    drawn as shaded bands behind the lines
+    fan_bands (list of tuple): Pairs of percentages of days bounding each shaded band
+
+    Returns:
+    matplotlib.figure.Figure: The figure
+    """
+    labels = hour_labels(start_plot_index)
+    hour_values = list(range(len(labels)))
+    line_styles = {hour: line_styles.get(hour, "--") for hour in hour_lines} | line_styles
+
+    fig = plt.figure(figsize=figsize)
+    ax = plt.gca()
+    if fan is not None:
+        for low, high in fan_bands:
+            plt.fill_between(
+                hour_values,
+                fan[low - 1],
+                fan[high - 1],
+                color="C0",
+                alpha=0.12,
+                linewidth=0,
+                label=f"{low}% to {high}% of days",
+            )
+    plt.plot(
+        labels,
+        cumulative_mean,
+        marker="o",
+        markersize=3,
+        color=line_colour,
+        linewidth=2,
+        alpha=0.7,
+        label="Average number of beds needed",
+    )
+    max_y = cumulative_mean[-1]
+    if fan is not None:
+        max_y = max(max_y, max(fan[high - 1][-1] for _, high in fan_bands))
+    annotated = cumulative_mean
+
+    if cumulative_centiles is not None:
+        highlight_centile = min(highlight_centile, 0.9999)
+        for i, centile in enumerate(centiles):
+            centile = min(centile, 0.9999)
+            is_highlight = abs(centile - highlight_centile) < 0.0001
+            if is_highlight:
+                annotated = cumulative_centiles[i]
+            plt.plot(
+                labels,
+                cumulative_centiles[i],
+                marker=markers[i % len(markers)],
+                markersize=3,
+                linestyle=line_styles_centiles[i % len(line_styles_centiles)],
+                color="C0",
+                linewidth=2 if is_highlight else 1,
+                alpha=1.0 if is_highlight else 0.7,
+                label=_centile_label(centile),
+            )
+        max_y = max(max_y, max(cumulative_centiles[:, -1]))
+        handles, legend_labels = ax.get_legend_handles_labels()
+        plt.legend(handles[::-1], legend_labels[::-1], loc="upper left")
+    else:
+        plt.legend(loc="upper left")
+
+    if draw_window:
+        start_window, end_window = draw_window
+        window_params = get_window_parameters(
+            annotated,
+            (start_window - start_plot_index) % len(annotated),
+            (end_window - start_plot_index) % len(annotated),
+            hour_values,
+        )
+        draw_window_visualization(
+            ax, hour_values, window_params, annotation_prefix, start_window, end_window
+        )
+        slope, x1, y1, _, _ = window_params
+        for hour_line in hour_lines:
+            annotate_hour_line(
+                hour_line=hour_line,
+                y_value=y1,
+                hour_values=hour_values,
+                start_plot_index=start_plot_index,
+                line_styles=line_styles,
+                x_margin=x_margin,
+                annotation_prefix=annotation_prefix,
+                slope=slope,
+                x1=x1,
+                y1=y1,
+            )
+    else:
+        for hour_line in hour_lines:
+            annotate_hour_line(
+                hour_line=hour_line,
+                y_value=annotated[(hour_line - start_plot_index) % len(annotated)],
+                hour_values=hour_values,
+                start_plot_index=start_plot_index,
+                line_styles=line_styles,
+                x_margin=x_margin,
+                annotation_prefix=annotation_prefix,
+                text_y_offset=text_y_offset,
+            )
+
+    plt.xlabel("Hour of day")
+    plt.ylabel("Cumulative number of beds needed")
+    plt.xlim(hour_values[0] - x_margin, hour_values[-1] + x_margin)
+    plt.ylim(0, set_y_lim if set_y_lim else max(max_y + 2, max_y * 1.2))
+    plt.minorticks_on()
+    ax.yaxis.set_minor_locator(plt.MultipleLocator(5))
+    plt.title(title)
+    plt.tight_layout()
+    return fig
+
+
+def plot_site_comparison(
+    cumulative_by_site,
+    title,
+    start_plot_index=0,
+    draw_window=None,
+    layout="overlay",
+    annotation_prefix="On average",
+    set_y_lim=None,
+    x_margin=0.5,
+    figsize=None,
+):
+    """
+    Plot the cumulative number of beds needed over the day at several sites.
+
+    Parameters:
+    cumulative_by_site (dict): Site name to its running total of demand, already starting at `start_plot_index`
+    title (str): Chart title
+    start_plot_index (int): Hour of day at which the x-axis starts
+    draw_window (tuple, optional): (start, end) hours of the decision-making window; the beds needed
+    by the end of the window are marked at each site
+    layout (str): "overlay" to draw every site on one chart, or "facet" for one chart per site
+    annotation_prefix (str): Prefix for annotations
+    set_y_lim (float, optional): Upper limit for the y-axis
+    x_margin (float): Margin on the x-axis
+    figsize (tuple, optional): Figure size; defaults to a size that suits the layout
+
+    Returns:
+    matplotlib.figure.Figure: The figure
+    """
+    labels = hour_labels(start_plot_index)
+    hour_values = list(range(len(labels)))
+    sites = list(cumulative_by_site)
+    max_y = max(cumulative[-1] for cumulative in cumulative_by_site.values())
+    if draw_window:
+        start_window, end_window = draw_window
+        start = (start_window - start_plot_index) % len(labels)
+        end = (end_window - start_plot_index) % len(labels)
+
+    if layout == "facet":
+        ncols = min(3, len(sites))
+        nrows = -(-len(sites) // ncols)
+        fig, axes = plt.subplots(
+            nrows,
+            ncols,
+            figsize=figsize or (5 * ncols, 3.5 * nrows),
+            sharex=True,
+            sharey=True,
+            squeeze=False,
+        )
+        for ax in axes.flat[len(sites):]:
+            ax.set_visible(False)
+        panels = [(ax, [site]) for ax, site in zip(axes.flat, sites)]
+    else:
+        fig, ax = plt.subplots(figsize=figsize or (10, 6))
+        panels = [(ax, sites)]
+
+    for ax, panel_sites in panels:
+        for site in panel_sites:
+            colour = f"C{sites.index(site) % 10}"
+            cumulative = cumulative_by_site[site]
+            label = str(site)
+            if draw_window and layout != "facet":
+                label += f" ({cumulative[end]:.0f} beds by {end_window}:00)"
+            ax.plot(
+                hour_values,
+                cumulative,
+                marker="o",
+                markersize=3,
+                color=colour,
+                label=label,
+            )
+            if draw_window:
+                ax.plot(
+                    [start, end],
+                    [cumulative[start], cumulative[end]],
+                    linestyle="--",
+                    color=colour,
+                    alpha=0.6,
+                )
+            if draw_window and layout == "facet":
+                ax.annotate(
+                    f"{annotation_prefix}, {cumulative[end]:.0f} beds needed by {end_window}:00",
+                    (end, cumulative[end]),
+                    textcoords="offset points",
+                    xytext=(-4, 6),
+                    ha="right",
+                    fontsize=8,
+                    color=colour,
+                )
+        if draw_window:
+            ax.axvspan(start, end, color="gray", alpha=0.08, linewidth=0)
+        if layout == "facet":
+            ax.set_title(str(panel_sites[0]))
+        ax.set_xticks(hour_values)
+        ax.set_xticklabels(labels, fontsize=7 if layout == "facet" else None)
+        ax.set_xlim(hour_values[0] - x_margin, hour_values[-1] + x_margin)
+        ax.set_ylim(0, set_y_lim if set_y_lim else max(max_y + 2, max_y * 1.2))
+        ax.grid(True, alpha=0.3)
+
+    if layout == "facet":
+        fig.supxlabel("Hour of day")
+        fig.supylabel("Cumulative number of beds needed")
+        fig.suptitle(title)
+    else:
+        ax.set_xlabel("Hour of day")
+        ax.set_ylabel("Cumulative number of beds needed")
+        ax.set_title(title)
+        ax.legend(loc="upper left", title=annotation_prefix if draw_window else None)
+    fig.tight_layout()
+    return fig
+
+
+def plot_window_heatmap(
+    beds_per_hour,
+    title,
+    start_plot_index=0,
+    draw_window=None,
+    best_window=None,
+    figsize=(9, 7),
+):
+    """
+    Plot the beds to vacate each hour for every decision-making window, as a heatmap.
+
+    Parameters:
+    beds_per_hour (numpy.ndarray): Array of shape (24, 24) by start and end hour of the window,
+    NaN for windows not considered (see `demand.windows.window_matrix`)
+    title (str): Chart title
+    start_plot_index (int): Hour of day at which both axes start
+    draw_window (tuple, optional): (start, end) hours of the window chosen in the sidebar, outlined
+    best_window (tuple, optional): (start, end) hours of the best window, marked with a star
+    figsize (tuple): Figure size
+
+    Returns:
+    matplotlib.figure.Figure: The figure
+    """
+    order = (start_plot_index + np.arange(24)) % 24
+    values = np.asarray(beds_per_hour, dtype=float)[np.ix_(order, order)]
+    position = {hour: i for i, hour in enumerate(order)}
+
+    fig, ax = plt.subplots(figsize=figsize)
+    image = ax.imshow(
+        np.ma.masked_invalid(values), cmap="viridis_r", origin="lower", aspect="auto"
+    )
+    fig.colorbar(image, ax=ax, label="Beds to vacate each hour of the window")
+    if draw_window:
+        start, end = (position[hour % 24] for hour in draw_window)
+        ax.add_patch(
+            plt.Rectangle(
+                (end - 0.5, start - 0.5), 1, 1, fill=False, edgecolor="red", linewidth=2
+            )
+        )
+    if best_window:
+        start, end = (position[hour % 24] for hour in best_window)
+        ax.plot(end, start, marker="*", markersize=14, color="white", markeredgecolor="black")
+        ax.annotate(
+            f"{values[start, end]:.1f} beds each hour\n"
+            f"from {best_window[0]:02d}:00 to {best_window[1]:02d}:00",
+            (end, start),
+            textcoords="offset points",
+            xytext=(8, -14),
+            fontsize=8,
+            bbox={"boxstyle": "round", "facecolor": "white", "alpha": 0.8},
+        )
+    labels = [f"{hour:02d}:00" for hour in order]
+    ax.set_xticks(range(24))
+    ax.set_xticklabels(labels, rotation=90)
+    ax.set_yticks(range(24))
+    ax.set_yticklabels(labels)
+    ax.set_xlabel("End of window: decision-makers are on wards until this hour")
+    ax.set_ylabel("Start of window: decision-makers are on wards from this hour")
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
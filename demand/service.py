@@ -0,0 +1,396 @@
+"""
+HTTP/JSON service for the bed-demand computations.
+
+A small ASGI app, so dashboards and other systems can fetch the figures the
+Streamlit app shows without a person in the browser. Uploaded files are counted
+once and kept in the same on-disk store as the app's, and all requests share
+the in-process caches of filter indexes and derived results. Computations run
+in a pool of worker threads, so slow requests do not hold up others.
+
+Endpoints (all but /metrics return JSON):
+
+    GET  /datasets                                  saved datasets
+    POST /datasets?datetime_col=...&name=...        ingest a CSV file sent as the request body
+    GET  /datasets/{dataset}/filters                filter columns and their categories
+    GET  /datasets/{dataset}/hourly                 arrival rates and beds needed by hour
+    GET  /datasets/{dataset}/cumulative             cumulative beds needed by hour
+    GET  /datasets/{dataset}/centiles               cumulative beds needed on a share of days
+    GET  /datasets/{dataset}/windows                decision-making windows ranked by beds to vacate each hour
+    GET  /metrics                                   stage timings and cache hit rates, for Prometheus
+
+The last four accept:
+
+    filter=column=value|value   (repeatable) keep only these categories
+    from=YYYY-MM-DD, to=YYYY-MM-DD             keep only these dates
+    x1, y1, x2, y2                              aspirational curve (default 4, 0.8, 12, 0.99)
+    start_hour                                  first hour of the day (default 8)
+    interval                                    minutes in each value (default 60), such as 15
+
+/centiles and /windows also take centile (repeatable, default 0.9), method and
+distribution. /centiles takes window=start,end for the beds needed around one
+window; /windows takes hours=min,max (window lengths, default 1,23),
+between=start,end (hours decision-makers can be on wards) and top (number of
+windows per centile, default 10). Stages are only timed if DEMAND_INSTRUMENT is set (see
+`demand.instrument`). Run with:
+
+    python -m demand.service --port 8000
+"""
+
+import argparse
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from demand.cache import LRUCache
+from demand.centiles import CENTILE_METHODS, lookup
+from demand.engine import (
+    BASE_INTERVAL,
+    DemandEngine,
+    hour_labels,
+    rotate,
+    window_requirements,
+)
+from demand.filters import FilterIndex
+from demand.ingest import candidate_filter_columns, read_columns, stream_arrivals
+from demand.instrument import prometheus_text
+from demand.models import MODEL_NAMES
+from demand.store import CubeStore, content_key
+from demand.windows import rank_windows
+
+DEFAULT_CURVE = (4, 0.8, 12, 0.99)
+
+
+class BadRequest(ValueError):
+    """A request with missing or invalid parameters."""
+
+
+class UnknownDataset(LookupError):
+    """A request for a dataset that is not in the store."""
+
+
+def _number(params, name, default, kind=float):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be a number, not '{value}'.")
+
+
+def _filters(params):
+    """Filters written as repeated `filter=column=value|value` parameters."""
+    filters = {}
+    for clause in params.getlist("filter"):
+        column, sep, values = clause.partition("=")
+        if not sep:
+            raise BadRequest(f"Filters are written column=value|value, not '{clause}'.")
+        filters[column] = values.split("|")
+    return filters
+
+
+def _curve(params):
+    return tuple(
+        _number(params, name, default)
+        for name, default in zip(["x1", "y1", "x2", "y2"], DEFAULT_CURVE)
+    )
+
+
+def _start_hour(params):
+    start_hour = _number(params, "start_hour", 8, int)
+    if not 0 <= start_hour <= 23:
+        raise BadRequest("'start_hour' must be between 0 and 23.")
+    return start_hour
+
+
+def _pair(params, name):
+    """Two whole numbers written start,end, or None if the parameter is not given."""
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        first, second = (int(part) for part in value.split(","))
+    except ValueError:
+        raise BadRequest(f"'{name}' is written as two whole numbers, such as {name}=8,17.")
+    return first, second
+
+
+def _hours(start_hour, num_intervals=24):
+    return [label.replace("\n", "") for label in hour_labels(start_hour, num_intervals)]
+
+
+def _values(array):
+    return np.asarray(array, dtype=float).round(4).tolist()
+
+
+class DemandService:
+    """
+    The computations behind each endpoint, independent of HTTP.
+
+    Parameters:
+    store (CubeStore, optional): Store of datasets; defaults to the app's store
+    """
+
+    def __init__(self, store=None):
+        self.store = store or CubeStore()
+        self._indexes = LRUCache(maxsize=16, name="indexes")
+
+    def index(self, dataset):
+        """Filter index of a saved dataset, loaded once and then shared by all requests."""
+        index = self._indexes.get(dataset)
+        if index is None:
+            # Keys never start with a dot, which also keeps requests inside the store
+            if dataset.startswith(".") or dataset not in self.store:
+                raise UnknownDataset(dataset)
+            cube, _, _ = self.store.load(dataset)
+            index = FilterIndex(cube)
+            self._indexes[dataset] = index
+        return index
+
+    def engine(self, dataset, params):
+        index = self.index(dataset)
+        date_range = None
+        if params.get("from") or params.get("to"):
+            date_range = (
+                params.get("from") or index.dates[0],
+                params.get("to") or index.dates[-1],
+            )
+        # Unknown filter columns raise a ValueError, answered as a bad request
+        dates, counts, excluded = index.selection(_filters(params), date_range)
+        interval = _number(params, "interval", 60, int)
+        return DemandEngine(counts, dates, excluded=excluded).resample(interval)
+
+    def datasets(self, params):
+        return {"datasets": self.store.entries()}
+
+    def ingest(self, body, params):
+        datetime_col = params.get("datetime_col", "arrival_datetime")
+        file = io.BytesIO(body)
+        # Same key as a chunked upload to the app, so either can reuse the other's counts
+        key = content_key(file, datetime_col, True, BASE_INTERVAL)
+        if key not in self.store:
+            filter_columns = candidate_filter_columns(read_columns(file), datetime_col)
+            cube, report = stream_arrivals(
+                file, datetime_col, filter_columns, time_interval=BASE_INTERVAL
+            )
+            if not cube.num_arrivals:
+                raise BadRequest(f"No datetimes in '{datetime_col}' could be parsed.")
+            self.store.save(
+                key,
+                cube,
+                params.get("name", "upload"),
+                report,
+                datetime_col=datetime_col,
+            )
+        return {
+            "dataset": key,
+            **{
+                name: value
+                for name, value in self.store.load(key)[2].items()
+                if name != "categories"
+            },
+        }
+
+    def filters(self, dataset, params):
+        index = self.index(dataset)
+        return {
+            "filters": {
+                column: [str(label) for label in labels]
+                for column, labels in index.categories.items()
+            },
+            "first_date": str(index.dates[0]) if len(index.dates) else None,
+            "last_date": str(index.dates[-1]) if len(index.dates) else None,
+        }
+
+    def _summary(self, engine, start_hour):
+        return {
+            "start_date": str(engine.start_date.date()),
+            "end_date": str(engine.end_date.date()),
+            "num_days": engine.num_days,
+            "num_arrivals": engine.num_arrivals,
+            "interval": engine.time_interval,
+            "hours": _hours(start_hour, engine.counts.shape[1]),
+        }
+
+    def hourly(self, dataset, params):
+        engine = self.engine(dataset, params)
+        start_hour = _start_hour(params)
+        curve_params = _curve(params)
+        return {
+            **self._summary(engine, start_hour),
+            "curve": curve_params,
+            "arrival_rates": _values(rotate(engine.arrival_rates(), start_hour)),
+            "beds_needed": _values(rotate(engine.bed_demand(curve_params), start_hour)),
+        }
+
+    def cumulative(self, dataset, params):
+        engine = self.engine(dataset, params)
+        start_hour = _start_hour(params)
+        curve_params = _curve(params)
+        return {
+            **self._summary(engine, start_hour),
+            "curve": curve_params,
+            "cumulative_beds_needed": _values(
+                engine.cumulative_demand(curve_params, start_hour)
+            ),
+        }
+
+    def _centile_table(self, engine, params, start_hour, curve_params):
+        """Consistency targets asked for, the centile method and the centile table it gives."""
+        centiles = [float(c) for c in params.getlist("centile")] or [0.9]
+        if not all(0 < c <= 1 for c in centiles):
+            raise BadRequest("Centiles must be between 0 and 1.")
+        method = params.get("method", "hourly")
+        if method not in CENTILE_METHODS:
+            raise BadRequest(f"'method' must be one of {', '.join(CENTILE_METHODS)}.")
+        distribution = params.get("distribution", "poisson")
+        distributions = ("poisson", "best", *MODEL_NAMES)
+        if distribution not in distributions:
+            raise BadRequest(
+                f"'distribution' must be one of {', '.join(dict.fromkeys(distributions))}."
+            )
+        table = engine.centile_table(
+            curve_params, start_hour, method, distribution=distribution
+        )
+        return centiles, method, table
+
+    def centiles(self, dataset, params):
+        engine = self.engine(dataset, params)
+        start_hour = _start_hour(params)
+        curve_params = _curve(params)
+        centiles, method, table = self._centile_table(
+            engine, params, start_hour, curve_params
+        )
+        window = _pair(params, "window")
+        if window:
+            start_of_window, end_of_window = window
+            if not all(0 <= hour <= 23 for hour in window):
+                raise BadRequest("'window' hours must be between 0 and 23.")
+            if start_of_window == end_of_window:
+                raise BadRequest("'window' must end at a different hour from its start.")
+
+        results = []
+        for centile, cumulative in zip(centiles, lookup(table, centiles)):
+            result = {"centile": centile, "cumulative_beds_needed": _values(cumulative)}
+            if window:
+                result["window"] = window_requirements(
+                    cumulative, start_hour, start_of_window, end_of_window
+                )
+            results.append(result)
+        return {
+            **self._summary(engine, start_hour),
+            "curve": curve_params,
+            "method": method,
+            "centiles": results,
+        }
+
+    def windows(self, dataset, params):
+        engine = self.engine(dataset, params)
+        start_hour = _start_hour(params)
+        curve_params = _curve(params)
+        centiles, method, table = self._centile_table(
+            engine, params, start_hour, curve_params
+        )
+        min_hours, max_hours = _pair(params, "hours") or (1, 23)
+        earliest_start, latest_end = _pair(params, "between") or (None, None)
+        top = _number(params, "top", 10, int)
+        windows = rank_windows(
+            table, start_hour, centiles, min_hours, max_hours, earliest_start, latest_end
+        )
+        return {
+            **self._summary(engine, start_hour),
+            "curve": curve_params,
+            "method": method,
+            "centiles": [
+                {
+                    "centile": centile,
+                    "windows": windows[windows["centile"] == centile]
+                    .drop(columns="centile")
+                    .head(top)
+                    .round(4)
+                    .to_dict("records"),
+                }
+                for centile in centiles
+            ],
+        }
+
+
+def create_app(store=None, workers=None):
+    """
+    Build the ASGI app.
+
+    Parameters:
+    store (CubeStore, optional): Store of datasets; defaults to the app's store
+    workers (int, optional): Number of worker threads for computations; defaults to one per CPU
+
+    Returns:
+    starlette.applications.Starlette: The app
+    """
+    service = DemandService(store)
+    pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+
+    def endpoint(method, with_dataset=True, with_body=False):
+        async def handle(request):
+            args = [request.path_params["dataset"]] if with_dataset else []
+            if with_body:
+                args.append(await request.body())
+            args.append(request.query_params)
+            loop = asyncio.get_running_loop()
+            # Results are serialised inside the try, so values JSON cannot hold are a bad request
+            try:
+                result = await loop.run_in_executor(pool, lambda: method(*args))
+                return JSONResponse(result)
+            except UnknownDataset as e:
+                return JSONResponse({"error": f"Unknown dataset '{e}'"}, 404)
+            except ValueError as e:
+                return JSONResponse({"error": str(e)}, 400)
+
+        return handle
+
+    async def metrics(request):
+        return PlainTextResponse(prometheus_text(), media_type="text/plain; version=0.0.4")
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        pool.shutdown()
+
+    return Starlette(
+        routes=[
+            Route("/datasets", endpoint(service.datasets, False), methods=["GET"]),
+            Route(
+                "/datasets",
+                endpoint(service.ingest, False, with_body=True),
+                methods=["POST"],
+            ),
+            Route("/datasets/{dataset}/filters", endpoint(service.filters)),
+            Route("/datasets/{dataset}/hourly", endpoint(service.hourly)),
+            Route("/datasets/{dataset}/cumulative", endpoint(service.cumulative)),
+            Route("/datasets/{dataset}/centiles", endpoint(service.centiles)),
+            Route("/datasets/{dataset}/windows", endpoint(service.windows)),
+            Route("/metrics", metrics),
+        ],
+        lifespan=lifespan,
+    )
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the bed-demand computations over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="Worker threads")
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(workers=args.workers), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+On-disk store of aggregated arrivals, so a file only has to be parsed once.
+
+Each entry is a folder holding the arrays of a `CountCube` as `.npy` files,
+which are memory-mapped when loaded, plus a small JSON file describing the
+dataset and how it was parsed. Entries are keyed by a hash of the uploaded
+file's contents and the reading options, and the least recently used entries
+are removed once the store grows beyond its size budget.
+"""
+
+import datetime
+import hashlib
+import json
+import numbers
+import os
+import shutil
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+
+CUBE_ARRAYS = ["day", "slot", "codes", "count"]
+DEFAULT_STORE_DIR = Path.home() / ".cache" / "undelayed-demand"
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def _label_type(labels):
+    """Name of the type of a column's category labels, so they can be saved as text."""
+    import numpy as np
+
+    values = [label for label in labels if label is not None]
+    for name, kind in [
+        ("bool", (bool, np.bool_)),
+        ("int", numbers.Integral),
+        ("float", numbers.Real),
+        ("datetime", datetime.datetime),
+        ("date", datetime.date),
+    ]:
+        if values and all(isinstance(label, kind) for label in values):
+            return name
+    return "str"
+
+
+_PARSE_LABEL = {
+    "bool": lambda label: label == "True",
+    "int": int,
+    "float": float,
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "str": str,
+}
+
+
+def content_key(file, *options, chunk_size=8 * 1024**2):
+    """
+    Hash of a file's contents and the options used to read it.
+
+    Parameters:
+    file (str, path or file-like): The file; file-like objects are rewound afterwards
+    *options: Reading options that change the result, such as the datetime column
+    chunk_size (int): Number of bytes hashed at a time
+
+    Returns:
+    str: Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    handle = file if hasattr(file, "read") else open(file, "rb")
+    try:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    finally:
+        if handle is file:
+            file.seek(0)
+        else:
+            handle.close()
+    digest.update(repr(options).encode())
+    return digest.hexdigest()
+
+
+class CubeStore:
+    """
+    A folder of saved count cubes with a least-recently-used size budget.
+
+    Parameters:
+    root (str or path, optional): Folder to keep entries in; defaults to $DEMAND_STORE_DIR or ~/.cache/undelayed-demand
+    max_bytes (int, optional): Size budget; defaults to $DEMAND_STORE_MAX_MB megabytes or 2 GB
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = Path(
+            root or os.environ.get("DEMAND_STORE_DIR", DEFAULT_STORE_DIR)
+        )
+        if max_bytes is None:
+            max_mb = os.environ.get("DEMAND_STORE_MAX_MB")
+            max_bytes = int(max_mb) * 1024**2 if max_mb else DEFAULT_MAX_BYTES
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _folder(self, key):
+        return self.root / key
+
+    def __contains__(self, key):
+        return (self._folder(key) / "meta.json").exists()
+
+    def save(self, key, cube, name, parse_report=None, **details):
+        """
+        Save a cube, replacing any entry with the same key, then evict old entries.
+
+        Parameters:
+        key (str): Entry key, usually from `content_key`
+        cube (CountCube): The aggregated arrivals
+        name (str): Name to show when listing datasets, such as the file name
+        parse_report (ParseReport, optional): How the datetimes were parsed
+        **details: Other JSON-serialisable facts about the dataset, such as the datetime column
+        """
+        if not cube.num_arrivals:
+            raise ValueError("There are no arrivals to save; were the datetimes parsed?")
+        # Imported here, as in `load`, so that listing the saved datasets does not load NumPy
+        import numpy as np
+
+        # Write to a temporary folder and rename it, so readers never see a partial entry
+        staging = Path(tempfile.mkdtemp(dir=self.root, prefix=".saving-"))
+        try:
+            for array in CUBE_ARRAYS:
+                values = np.ascontiguousarray(getattr(cube, array))
+                np.save(staging / f"{array}.npy", values)
+            meta = {
+                "name": name,
+                "saved": time.time(),
+                "time_interval": cube.time_interval,
+                # Labels are saved as text, with their type, so dates and numbers survive JSON
+                "categories": {
+                    col: [str(label) for label in labels]
+                    for col, labels in cube.categories.items()
+                },
+                "category_types": {
+                    col: _label_type(labels) for col, labels in cube.categories.items()
+                },
+                "num_arrivals": cube.num_arrivals,
+                "first_date": str(np.datetime64(int(cube.day.min()), "D")),
+                "last_date": str(np.datetime64(int(cube.day.max()), "D")),
+                "parse_report": asdict(parse_report) if parse_report else None,
+                **details,
+            }
+            (staging / "meta.json").write_text(json.dumps(meta))
+            folder = self._folder(key)
+            if folder.exists():
+                shutil.rmtree(folder)
+            os.replace(staging, folder)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+
+    def load(self, key):
+        """
+        Load a saved cube, memory-mapping its arrays rather than reading them.
+
+        Parameters:
+        key (str): Entry key
+
+        Returns:
+        tuple: (cube, parse_report, meta) - parse_report is None if it was not saved
+        """
+        # Imported here so that listing the saved datasets does not load NumPy or pandas
+        import numpy as np
+        import pandas as pd
+
+        from demand.cube import CountCube
+        from demand.ingest import ParseReport
+
+        folder = self._folder(key)
+        meta = json.loads((folder / "meta.json").read_text())
+        arrays = {
+            array: np.load(folder / f"{array}.npy", mmap_mode="r")
+            for array in CUBE_ARRAYS
+        }
+        # Entries saved before label types were recorded hold the labels themselves
+        types = meta.get("category_types", {})
+        categories = {
+            col: pd.Index(
+                [_PARSE_LABEL[types[col]](label) for label in labels]
+                if col in types
+                else labels,
+                dtype=object,
+            )
+            for col, labels in meta["categories"].items()
+        }
+        cube = CountCube(
+            **arrays, categories=categories, time_interval=meta["time_interval"]
+        )
+        report = ParseReport(**meta["parse_report"]) if meta["parse_report"] else None
+        # The modification time of the folder records when the entry was last used
+        os.utime(folder)
+        return cube, report, meta
+
+    def entries(self):
+        """
+        Saved datasets, most recently used first.
+
+        Returns:
+        list of dict: The saved details of each entry, with its key, size in bytes and last use
+        """
+        entries = []
+        for folder in self.root.iterdir():
+            if folder.name.startswith(".") or not (folder / "meta.json").exists():
+                continue
+            meta = json.loads((folder / "meta.json").read_text())
+            meta.pop("categories", None)
+            meta["key"] = folder.name
+            meta["bytes"] = sum(f.stat().st_size for f in folder.iterdir())
+            meta["last_used"] = folder.stat().st_mtime
+            entries.append(meta)
+        return sorted(entries, key=lambda entry: entry["last_used"], reverse=True)
+
+    def remove(self, key):
+        shutil.rmtree(self._folder(key), ignore_errors=True)
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits its size budget."""
+        entries = self.entries()
+        total = sum(entry["bytes"] for entry in entries)
+        # Always keep the most recently used entry, even if it alone exceeds the budget
+        for entry in reversed(entries[1:]):
+            if total <= self.max_bytes:
+                break
+            self.remove(entry["key"])
+            total -= entry["bytes"]
@@ -0,0 +1,239 @@
+"""
+Synthetic arrivals of admitted patients, for benchmarks and demonstrations.
+
+Arrivals follow the usual shape of emergency admissions: few overnight, rising
+through the morning to a peak around midday and a second one in the early
+evening, with more on Mondays and fewer at weekends, and a mild winter peak.
+Each day's total is scaled by a gamma-distributed factor, so counts vary more
+from day to day than a Poisson model allows (see `demand.models`). Each arrival
+also has categorical columns to filter on.
+
+Files are written in chunks of days, so files of tens of millions of rows can be
+generated without holding them in memory.
+
+Example:
+
+    python -m demand.synthetic data-raw/synthetic_1m.csv --rows 1000000
+"""
+
+import argparse
+import re
+
+import numpy as np
+import pandas as pd
+
+# Relative arrivals in each hour of the day, starting at midnight
+HOURLY_PROFILE = np.array(
+    [
+        0.50, 0.42, 0.36, 0.32, 0.30, 0.31, 0.38, 0.55,
+        0.80, 1.05, 1.25, 1.35, 1.38, 1.34, 1.28, 1.24,
+        1.22, 1.24, 1.26, 1.22, 1.12, 0.98, 0.82, 0.65,
+    ]
+)
+HOURLY_PROFILE = HOURLY_PROFILE / HOURLY_PROFILE.sum()
+
+# Relative arrivals on each day of the week, starting on Monday
+WEEKDAY_FACTORS = np.array([1.12, 1.03, 1.0, 1.0, 1.01, 0.93, 0.91])
+
+DEFAULT_CATEGORIES = {
+    "specialty": {"medical": 0.62, "surgical": 0.22, "paediatric": 0.1, "haem/onc": 0.06},
+    "site": {"north": 0.55, "south": 0.45},
+    "sex": {"F": 0.51, "M": 0.49},
+    "age_group": {"0-17": 0.1, "18-64": 0.45, "65-79": 0.25, "80+": 0.2},
+}
+
+DATETIME_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+_TIME_DIRECTIVE = re.compile(r"%[HIMSpfXTR]")
+
+
+def format_datetimes(first_day, seconds, datetime_format=DATETIME_FORMAT):
+    """
+    Format datetimes given as seconds since the start of a day.
+
+    Formatting every datetime with strftime is by far the slowest part of writing a
+    file. When the format has its date before its time, as most do, each day and each
+    second of the day is formatted only once, and the two parts are joined.
+
+    Parameters:
+    first_day (pandas.Timestamp): Midnight at the start of the first day
+    seconds (numpy.ndarray): Seconds since `first_day`
+    datetime_format (str): strftime format
+
+    Returns:
+    numpy.ndarray: The formatted datetimes
+    """
+    match = _TIME_DIRECTIVE.search(datetime_format)
+    date_part, time_part = (
+        (datetime_format[: match.start()], datetime_format[match.start():])
+        if match
+        else (datetime_format, "")
+    )
+    if "%" in re.sub(r"%[HIMSp]", "", time_part):
+        # Date directives after the time, or other directives: format every datetime
+        return (first_day + pd.to_timedelta(seconds, unit="s")).strftime(
+            datetime_format
+        ).to_numpy(dtype=object)
+
+    day, second = np.divmod(seconds, 86400)
+    days = pd.date_range(first_day, periods=int(day.max()) + 1 if len(day) else 0, freq="D")
+    dates = days.strftime(date_part).to_numpy(dtype=object)
+    times = _times_of_day(time_part)
+    return dates[day] + times[second]
+
+
+_TIMES_OF_DAY = {}
+
+
+def _times_of_day(time_format):
+    """Every second of the day formatted with `time_format`, computed once per format."""
+    if time_format not in _TIMES_OF_DAY:
+        seconds = pd.Timestamp(0) + pd.to_timedelta(np.arange(86400), unit="s")
+        _TIMES_OF_DAY[time_format] = seconds.strftime(time_format).to_numpy(dtype=object)
+    return _TIMES_OF_DAY[time_format]
+
+
+def daily_rates(dates, arrivals_per_day, dispersion, rng):
+    """
+    Expected arrivals on each day, including the day's random level.
+
+    Parameters:
+    dates (pandas.DatetimeIndex): The days
+    arrivals_per_day (float): Average arrivals per day over the year
+    dispersion (float): Gamma shape of the day-to-day variation; smaller is more variable, inf for none
+    rng (numpy.random.Generator): Random numbers
+
+    Returns:
+    numpy.ndarray: Expected arrivals on each day
+    """
+    season = 1 + 0.08 * np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 15) / 365.25)
+    rates = arrivals_per_day * WEEKDAY_FACTORS[dates.dayofweek.to_numpy()] * season
+    if np.isfinite(dispersion):
+        rates = rates * rng.gamma(dispersion, 1 / dispersion, size=len(dates))
+    return rates
+
+
+def arrival_chunks(
+    num_rows,
+    start_date="2022-01-01",
+    arrivals_per_day=None,
+    dispersion=20,
+    categories=None,
+    seed=0,
+    chunk_days=92,
+    datetime_format=DATETIME_FORMAT,
+):
+    """
+    Generate synthetic arrivals in chunks of consecutive days.
+
+    Parameters:
+    num_rows (int): Total number of arrivals; the last day is cut short to give exactly this many
+    start_date (str): First day of arrivals
+    arrivals_per_day (float, optional): Average arrivals per day; defaults to 150, or enough
+    to fit `num_rows` into two years
+    dispersion (float): Gamma shape of the day-to-day variation; smaller is more variable, inf for none
+    categories (dict, optional): Column name to {category: probability}; defaults to DEFAULT_CATEGORIES
+    seed (int): Random seed
+    chunk_days (int): Number of days in each chunk
+    datetime_format (str or None): strftime format of the arrival datetimes, or None to keep them as datetimes
+
+    Yields:
+    pandas.DataFrame: Arrivals in time order, with an `arrival_datetime` column and one column per category
+    """
+    categories = DEFAULT_CATEGORIES if categories is None else categories
+    if arrivals_per_day is None:
+        arrivals_per_day = max(150, num_rows / 730)
+    rng = np.random.default_rng(seed)
+    first_day = pd.Timestamp(start_date).normalize()
+    remaining = num_rows
+    while remaining > 0:
+        dates = pd.date_range(first_day, periods=chunk_days, freq="D")
+        rates = daily_rates(dates, arrivals_per_day, dispersion, rng)
+        counts = rng.poisson(rates[:, None] * HOURLY_PROFILE).ravel()
+
+        # Seconds since the start of the chunk, uniform within each hour
+        hour_starts = np.repeat(np.arange(counts.size, dtype=np.int64) * 3600, counts)
+        seconds = np.sort(hour_starts + rng.integers(0, 3600, size=hour_starts.size))
+        seconds = seconds[:remaining]
+        if datetime_format:
+            arrivals = format_datetimes(first_day, seconds, datetime_format)
+        else:
+            arrivals = first_day + pd.to_timedelta(seconds, unit="s")
+
+        chunk = pd.DataFrame({"arrival_datetime": arrivals})
+        for column, probabilities in categories.items():
+            labels = np.array(list(probabilities), dtype=object)
+            weights = np.array(list(probabilities.values()), dtype=float)
+            chunk[column] = labels[
+                rng.choice(len(labels), size=len(chunk), p=weights / weights.sum())
+            ]
+        yield chunk
+        remaining -= len(chunk)
+        first_day += pd.Timedelta(days=chunk_days)
+
+
+def generate_arrivals(num_rows, **kwargs):
+    """
+    Synthetic arrivals as one DataFrame; see `arrival_chunks` for the options.
+
+    Returns:
+    pandas.DataFrame: The arrivals
+    """
+    return pd.concat(list(arrival_chunks(num_rows, **kwargs)), ignore_index=True)
+
+
+def write_arrivals(path, num_rows, **kwargs):
+    """
+    Write synthetic arrivals to a CSV file, one chunk at a time; see `arrival_chunks` for the options.
+
+    Parameters:
+    path (str or path): The CSV file to write
+    num_rows (int): Number of arrivals
+
+    Returns:
+    int: Number of rows written
+    """
+    written = 0
+    for chunk in arrival_chunks(num_rows, **kwargs):
+        chunk.to_csv(path, mode="a" if written else "w", header=not written, index=False)
+        written += len(chunk)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write a CSV file of synthetic arrivals of admitted patients."
+    )
+    parser.add_argument("output", help="CSV file to write")
+    parser.add_argument("--rows", type=int, default=100_000, help="Number of arrivals")
+    parser.add_argument("--start-date", default="2022-01-01")
+    parser.add_argument(
+        "--arrivals-per-day",
+        type=float,
+        default=None,
+        help="Average arrivals per day; defaults to 150, or enough to fit the rows into two years",
+    )
+    parser.add_argument(
+        "--dispersion",
+        type=float,
+        default=20,
+        help="Gamma shape of the day-to-day variation; smaller is more variable, inf for Poisson",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--datetime-format", default=DATETIME_FORMAT)
+    args = parser.parse_args(argv)
+
+    written = write_arrivals(
+        args.output,
+        args.rows,
+        start_date=args.start_date,
+        arrivals_per_day=args.arrivals_per_day,
+        dispersion=args.dispersion,
+        seed=args.seed,
+        datetime_format=args.datetime_format,
+    )
+    print(f"Wrote {written:,} arrivals to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
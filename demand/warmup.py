@@ -0,0 +1,88 @@
+"""
+Warming up a new app process before the first upload.
+
+The landing page of the app only needs Streamlit, so the modules that read files
+and compute demand (pandas, SciPy, matplotlib and patientflow, which take a few
+seconds to import) are imported when a file is first chosen. `start` imports
+them in a background thread as soon as the landing page has been drawn, and
+runs the calculations and a chart once on a small synthetic dataset, so that
+SciPy's distributions and matplotlib's fonts are ready by the time a user has
+picked a file.
+
+Run as a module to do the same once, for example while building a container
+image, so matplotlib's font cache is saved in the image:
+
+    python -m demand.warmup
+"""
+
+import io
+import threading
+import time
+
+from demand.instrument import stage
+
+_thread = None
+_lock = threading.Lock()
+
+
+def warm_up(render=True):
+    """
+    Import the pipeline and run it once on a small synthetic dataset.
+
+    Parameters:
+    render (bool): Whether to also draw a chart, which loads matplotlib's fonts
+
+    Returns:
+    float: Seconds taken
+    """
+    started = time.perf_counter()
+    with stage("warm_up"):
+        import matplotlib.pyplot as plt
+        import numpy as np
+
+        # Every module the app imports once a file is chosen
+        import demand.charts  # noqa: F401
+        import demand.compare  # noqa: F401
+        import demand.filters  # noqa: F401
+        import demand.ingest  # noqa: F401
+        import demand.windows  # noqa: F401
+        import patientflow.viz.aspirational_curve_plot  # noqa: F401
+        from demand.centiles import CENTILE_METHODS
+        from demand.engine import DemandEngine
+        from demand.plots import plot_cumulative_demand
+
+        rng = np.random.default_rng(0)
+        counts = rng.poisson(2.0, (28, 24))
+        dates = np.datetime64("2024-01-01") + np.arange(len(counts))
+        engine = DemandEngine(counts, dates)
+        curve_params = (4, 0.8, 12, 0.99)
+        for method in CENTILE_METHODS:
+            engine.centile_table(curve_params, 8, method, n_boot=2)
+        if render:
+            # Drawn directly rather than with render_png, to keep it out of the figure cache
+            fig = plot_cumulative_demand(engine.cumulative_demand(curve_params, 8), "Warm-up")
+            try:
+                fig.savefig(io.BytesIO(), format="png", dpi=50)
+            finally:
+                plt.close(fig)
+    return time.perf_counter() - started
+
+
+def start(render=True):
+    """
+    Warm up in a background thread, once per process.
+
+    Parameters:
+    render (bool): Whether to also draw a chart
+    """
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(
+                target=warm_up, args=(render,), name="demand-warm-up", daemon=True
+            )
+            _thread.start()
+
+
+if __name__ == "__main__":
+    print(f"Warmed up in {warm_up():.2f} seconds")
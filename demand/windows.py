@@ -0,0 +1,128 @@
+"""
+Searching every decision-making window at once.
+
+Step 5 of the app reads the beds needed around one window (see
+`demand.engine.window_requirements`). Here the same quantities are read for
+every window that starts and ends on the hour, at every consistency target, from
+a centile table in one pass: beds needed by the start of the window, beds needed
+by its end (all the beds for the day), and the beds that must be vacated in each
+hour of the window to get from one to the other.
+
+Windows are measured within the day the cumulative demand covers, which starts
+at `start_hour`, so a window ends after it starts in that day. The best window
+is the one with the fewest beds to vacate each hour; since longer windows always
+spread the same beds more thinly, the search is limited to the window lengths
+and hours the staffing allows.
+"""
+
+import numpy as np
+import pandas as pd
+
+from demand.centiles import PERCENTAGES, lookup
+from demand.engine import intervals_per_hour
+
+
+def window_grid(cumulative, start_hour):
+    """
+    Beds needed around every window, from one or more cumulative demand curves.
+
+    Parameters:
+    cumulative (numpy.ndarray): Cumulative demand over the day, starting at `start_hour`; any
+    leading axes (such as one row per consistency target) are kept
+    start_hour (int): Hour of day at which `cumulative` starts
+
+    Returns:
+    dict: Arrays indexed by hour of day:
+    beds_by_start_of_window (..., start), beds_by_end_of_window (...),
+    hours (start, end) and beds_per_hour (..., start, end), which is NaN unless the window
+    ends after it starts
+    """
+    cumulative = np.asarray(cumulative, dtype=float)
+    per_hour = intervals_per_hour(cumulative.shape[-1])
+    # Position of each hour of the day within the cumulative day, read at its last interval
+    position = (np.arange(24) - start_hour) % 24
+    beds_by_hour = cumulative[..., (position + 1) * per_hour - 1]
+    beds_by_end = cumulative[..., -1]
+    hours = position[None, :] - position[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beds_per_hour = (beds_by_end[..., None, None] - beds_by_hour[..., :, None]) / hours
+    return {
+        "beds_by_start_of_window": beds_by_hour,
+        "beds_by_end_of_window": beds_by_end,
+        "hours": hours,
+        "beds_per_hour": np.where(hours > 0, beds_per_hour, np.nan),
+    }
+
+
+def rank_windows(
+    table,
+    start_hour,
+    centiles=None,
+    min_hours=1,
+    max_hours=23,
+    earliest_start=None,
+    latest_end=None,
+):
+    """
+    Every window of an allowed length, ranked by the beds to vacate each hour.
+
+    Parameters:
+    table (numpy.ndarray): Centile table of cumulative demand, see `DemandEngine.centile_table`
+    start_hour (int): Hour of day at which the table starts
+    centiles (list of float, optional): Consistency targets between 0 and 1; defaults to every
+    whole-number percentage
+    min_hours (int): Shortest window to consider, in hours
+    max_hours (int): Longest window to consider, in hours
+    earliest_start (int, optional): Earliest hour a window can start; defaults to `start_hour`
+    latest_end (int, optional): Latest hour a window can end, within the day from `start_hour`
+
+    Returns:
+    pandas.DataFrame: One row per consistency target and window, best first for each target,
+    with its rank, start and end hours, length, beds by the start and end of the window, and
+    beds to vacate each hour
+    """
+    if not 1 <= min_hours <= max_hours <= 23:
+        raise ValueError("Windows must last between 1 and 23 hours.")
+    levels = PERCENTAGES / 100 if centiles is None else np.asarray(centiles, dtype=float)
+    grid = window_grid(lookup(table, levels), start_hour)
+    allowed = (grid["hours"] >= min_hours) & (grid["hours"] <= max_hours)
+    position = (np.arange(24) - start_hour) % 24
+    if earliest_start is not None:
+        allowed &= (position >= position[earliest_start % 24])[:, None]
+    if latest_end is not None:
+        allowed &= (position <= position[latest_end % 24])[None, :]
+    level, start, end = np.nonzero(
+        np.broadcast_to(allowed, grid["beds_per_hour"].shape)
+    )
+    windows = pd.DataFrame(
+        {
+            "centile": levels[level],
+            "start_of_window": start,
+            "end_of_window": end,
+            "hours": grid["hours"][start, end],
+            "beds_by_start_of_window": grid["beds_by_start_of_window"][level, start],
+            "beds_by_end_of_window": grid["beds_by_end_of_window"][level],
+            "beds_per_hour": grid["beds_per_hour"][level, start, end],
+        }
+    )
+    # Ties go to the shorter window
+    windows = windows.sort_values(
+        ["centile", "beds_per_hour", "hours"], kind="stable", ignore_index=True
+    )
+    windows.insert(0, "rank", windows.groupby("centile").cumcount() + 1)
+    return windows
+
+
+def window_matrix(windows):
+    """
+    Beds to vacate each hour of each window in a ranked table, for one consistency target.
+
+    Parameters:
+    windows (pandas.DataFrame): Rows of `rank_windows` for a single consistency target
+
+    Returns:
+    numpy.ndarray: Array of shape (24, 24) by start and end hour; NaN for windows not in the table
+    """
+    matrix = np.full((24, 24), np.nan)
+    matrix[windows["start_of_window"], windows["end_of_window"]] = windows["beds_per_hour"]
+    return matrix